@@ -0,0 +1,5 @@
+"""
+Benchmarks for the document extraction and upload paths
+
+Run with ``python -m benchmarks.run``; see ``benchmarks/run.py`` for options.
+"""
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Functions for generating synthetic Word transcripts to benchmark with
+
+The documents follow the schema document_extract expects: a two column header
+table of key/value rows (tags, researcher, project) followed by the paragraphs
+of the transcription. The XML parts are written directly instead of through
+python-docx so that corpora of large documents can be generated quickly.
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import os
+import random
+import zipfile
+from xml.sax.saxutils import escape
+
+CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+
+RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+    '</Relationships>'
+)
+
+DOCUMENT_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+    '<w:body>'
+)
+
+DOCUMENT_END = '<w:sectPr/></w:body></w:document>'
+
+WORDS = (
+    'the interview participant said we should look into project data research '
+    'field notes coding theme community school family work health time place '
+    'story remember changed people think really important question answer'
+).split()
+
+TAGS = 'education health housing migration labour family youth memory'.split()
+RESEARCHERS = ['Ada Lovelace', 'Grace Hopper', 'Alan Turing', 'Mary Jackson']
+PROJECTS = ['Oral History', 'Neighbourhoods', 'Working Lives']
+
+
+def _paragraph(text):
+    return ('<w:p><w:r><w:t xml:space="preserve">{}</w:t></w:r></w:p>'
+            .format(escape(text)))
+
+
+def _cell(text):
+    return '<w:tc>{}</w:tc>'.format(_paragraph(text))
+
+
+def header_rows(rng):
+    return [
+        ('Tags', ', '.join(rng.sample(TAGS, 3))),
+        ('Researcher', rng.choice(RESEARCHERS)),
+        ('Project', rng.choice(PROJECTS)),
+    ]
+
+
+def document_xml(paragraphs, rng, wordsPerParagraph=(5, 60)):
+    """Yield the XML of word/document.xml in pieces."""
+
+    yield DOCUMENT_START
+    yield '<w:tbl>'
+    for key, value in header_rows(rng):
+        yield '<w:tr>{}{}</w:tr>'.format(_cell(key), _cell(value))
+    yield '</w:tbl>'
+
+    low, high = wordsPerParagraph
+    for n in range(paragraphs):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(low, high))]
+        yield _paragraph(' '.join(words))
+    yield DOCUMENT_END
+
+
+def generate_docx(fn, paragraphs=100, seed=0, wordsPerParagraph=(5, 60)):
+    """Write a synthetic transcript with a header table and `paragraphs`
+    paragraphs to fn, a path or binary file object. The same seed always
+    produces the same document.
+    """
+
+    rng = random.Random(seed)
+    with zipfile.ZipFile(fn, 'w', zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr('[Content_Types].xml', CONTENT_TYPES)
+        docx.writestr('_rels/.rels', RELS)
+        docx.writestr('word/document.xml',
+                      ''.join(document_xml(paragraphs, rng, wordsPerParagraph)))
+
+
+def generate_corpus(targetDir, count, paragraphs=100, seed=0):
+    """Write `count` transcripts to targetDir and return their paths."""
+
+    if not os.path.isdir(targetDir):
+        os.makedirs(targetDir)
+
+    paths = []
+    for n in range(count):
+        fn = os.path.join(targetDir, 'transcript{:05d}.docx'.format(n))
+        generate_docx(fn, paragraphs, seed + n)
+        paths.append(fn)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic Word transcripts.')
+    parser.add_argument('targetDir')
+    parser.add_argument('--count', type=int, default=10)
+    parser.add_argument('--paragraphs', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for fn in generate_corpus(args.targetDir, args.count, args.paragraphs,
+                              args.seed):
+        print(fn)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark runner for the extraction, conversion and upload paths
+
+Each benchmark runs against a synthetic corpus from benchmarks.corpus at the
+requested document sizes. The upload benchmark posts documents to blog.create
+through the Flask test client, with the embedded local backend standing in for
+ElasticSearch and jobs run inline, so it measures the whole request without a
+cluster. Results are written as JSON together with the commit they were taken
+at, and --compare prints the change against an earlier results file.
+
+    python -m benchmarks.run --sizes 100,1000,10000 --output bench.json
+    python -m benchmarks.run --output new.json --compare bench.json
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmarks.corpus import generate_corpus, generate_docx
+
+import searchapp.docx_processing as docx_processing
+from searchapp.word_to_json import word_to_json
+
+
+def timed(fn, repeat):
+    """Call fn repeat times and return the summary statistics in seconds."""
+
+    times = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        'runs': repeat,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'max': max(times),
+    }
+
+
+def bench_extract(fn, repeat):
+    return {
+        'document_extract': timed(lambda: docx_processing.document_extract(fn, ['tags']), repeat),
+    }
+
+
+def bench_word_to_json(corpusDir, workDir, repeat):
+    searchPath = os.path.join(corpusDir, '*.docx')
+
+    def run():
+        targetDir = tempfile.mkdtemp(dir=workDir)
+        word_to_json(targetDir, searchPath, incremental=False)
+
+    return timed(run, repeat)
+
+
+def upload_client(workDir):
+    """Return a test client logged in to an app with an empty database and
+    the local backend in place of ElasticSearch.
+    """
+    from searchapp import create_app
+    from searchapp.db import init_db
+
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': os.path.join(workDir, 'bench.db'),
+        'SEARCH_BACKEND': 'local',
+        'LOCAL_INDEX_PATH': os.path.join(workDir, 'index'),
+        'JOB_WORKERS': 0,
+        'JOB_QUEUE_MAX': 0,
+        # every upload is unique, so the cache would only add writes
+        'EXTRACTION_CACHE_MAX_BYTES': 0,
+    })
+    with app.app_context():
+        init_db()
+
+    client = app.test_client()
+    client.post('/auth/register', data={'username': 'bench', 'password': 'bench'})
+    client.post('/auth/login', data={'username': 'bench', 'password': 'bench'})
+    return client
+
+
+def bench_upload(paragraphs, workDir, repeat):
+    client = upload_client(workDir)
+
+    # a different document every time, so neither cache nor dedup kick in
+    documents = []
+    for seed in range(repeat):
+        data = io.BytesIO()
+        generate_docx(data, paragraphs, seed)
+        documents.append(data.getvalue())
+    documents = iter(documents)
+
+    def run():
+        data = io.BytesIO(next(documents))
+        response = client.post('/create',
+                               data={'file': (data, 'bench.docx')},
+                               content_type='multipart/form-data')
+        assert response.status_code in (200, 302), response.status_code
+
+    return timed(run, repeat)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, repeat, corpusSize):
+    workDir = tempfile.mkdtemp(prefix='searchtool-bench-')
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'repeat': repeat,
+        'benchmarks': {},
+    }
+
+    try:
+        for paragraphs in sizes:
+            print('Benchmarking {} paragraph documents'.format(paragraphs),
+                  file=sys.stderr)
+            sizeDir = os.path.join(workDir, str(paragraphs))
+            corpus = generate_corpus(os.path.join(sizeDir, 'corpus'),
+                                     corpusSize, paragraphs)
+
+            bench = bench_extract(corpus[0], repeat)
+            bench['word_to_json'] = bench_word_to_json(
+                os.path.dirname(corpus[0]), sizeDir, repeat)
+            bench['upload'] = bench_upload(paragraphs, sizeDir, repeat)
+
+            results['benchmarks'][str(paragraphs)] = {
+                'document_bytes': os.path.getsize(corpus[0]),
+                'corpus_documents': corpusSize,
+                'timings': bench,
+            }
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    return results
+
+
+def compare(old, new, out=sys.stdout):
+    """Print the median of every benchmark in new next to old."""
+
+    print('{:>10} {:<18} {:>12} {:>12} {:>8}'.format(
+        'paragraphs', 'benchmark', 'old (ms)', 'new (ms)', 'change'), file=out)
+    for size, bench in sorted(new['benchmarks'].items(), key=lambda i: int(i[0])):
+        oldBench = old['benchmarks'].get(size, {}).get('timings', {})
+        for name, stats in sorted(bench['timings'].items()):
+            newMedian = stats['median'] * 1000
+            if name in oldBench:
+                oldMedian = oldBench[name]['median'] * 1000
+                change = '{:+.1f}%'.format((newMedian / oldMedian - 1) * 100)
+                oldText = '{:.2f}'.format(oldMedian)
+            else:
+                oldText = change = '-'
+            print('{:>10} {:<18} {:>12} {:>12.2f} {:>8}'.format(
+                size, name, oldText, newMedian, change), file=out)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark extraction, conversion and upload.')
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help='comma separated paragraphs per document')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs of each benchmark')
+    parser.add_argument('--corpus-size', type=int, default=10,
+                        help='documents converted by the word_to_json benchmark')
+    parser.add_argument('--output', default='bench_output.json',
+                        help='file the JSON results are written to')
+    parser.add_argument('--compare', default=None,
+                        help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = run(sizes, args.repeat, args.corpus_size)
+
+    with open(args.output, 'w') as outfile:
+        json.dump(results, outfile, indent=2, sort_keys=True)
+    print('Results written to {}'.format(args.output), file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as infile:
+            compare(json.load(infile), results)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of application startup time and memory per gunicorn worker
+
+The import benchmark runs a fresh interpreter that imports searchapp.wsgi,
+which creates the app, and reports the wall time against a bare interpreter,
+the slowest imports from -X importtime, which needs Python 3.7 and is
+reported as null on older interpreters, and whether the heavy optional
+packages were imported. The worker benchmark starts gunicorn with the app on
+a throwaway database and the local backend, with and without preload_app,
+sends every worker a request and reads the resident (RSS) and proportional
+(PSS, shared pages split between the processes sharing them) memory of the
+master and each worker from /proc. It needs Linux and gunicorn and is
+skipped without them.
+
+    python -m benchmarks.startup --output startup.json
+    python -m benchmarks.startup --output new.json --compare startup.json
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmarks.run import git_commit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# imported lazily by the app, they should not show up at startup
+HEAVY_MODULES = ('elasticsearch', 'urllib3', 'docx', 'lxml')
+
+# module creating the app on a throwaway database for the worker benchmark
+BENCH_WSGI = '''
+from searchapp import create_app
+
+application = create_app({{
+    'DATABASE': {database!r},
+    'SEARCH_BACKEND': 'local',
+    'LOCAL_INDEX_PATH': {index!r},
+    'METRICS_DIR': {metrics!r},
+}})
+'''
+
+
+def _python(code, *flags):
+    return subprocess.run([sys.executable] + list(flags) + ['-c', code],
+                          cwd=ROOT, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True,
+                          check=True)
+
+
+def _wall(code, repeat):
+    times = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        _python(code)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def bench_import(repeat, top=10):
+    """Time a fresh interpreter importing searchapp.wsgi and list its
+    slowest imports, cumulative microseconds by module, or None before
+    Python 3.7, which has no -X importtime.
+    """
+    code = 'import searchapp.wsgi'
+    baseline = _wall('pass', repeat)
+    total = _wall(code, repeat)
+
+    slowest = None
+    if sys.version_info >= (3, 7):
+        cumulative = {}
+        for line in _python(code, '-X', 'importtime').stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            name = name.strip()
+            if '.' not in name:
+                cumulative[name] = cumulative.get(name, 0) + int(cumulative_us)
+        slowest = dict(sorted(cumulative.items(), key=lambda i: -i[1])[:top])
+    else:
+        print('Import breakdown unavailable, -X importtime needs Python 3.7',
+              file=sys.stderr)
+
+    check = ('import sys, searchapp.wsgi; '
+             'print(",".join(m for m in {!r} if m in sys.modules))').format(HEAVY_MODULES)
+    heavy = [m for m in _python(check).stdout.strip().split(',') if m]
+
+    return {
+        'interpreter_seconds': baseline,
+        'import_seconds': total,
+        'app_seconds': total - baseline,
+        'heavy_modules_imported': heavy,
+        'slowest_imports_us': slowest,
+    }
+
+
+def _memory(pid):
+    """Return the RSS and PSS of a process in KB, PSS None when the kernel
+    does not report it.
+    """
+    rss = pss = None
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    pss = int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return {'rss_kb': rss, 'pss_kb': pss}
+
+
+def _children(pid):
+    try:
+        with open('/proc/{0}/task/{0}/children'.format(pid)) as f:
+            return [int(child) for child in f.read().split()]
+    except (IOError, OSError):
+        return []
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _get(port, path, timeout=1.0):
+    from urllib.request import urlopen
+
+    return urlopen('http://127.0.0.1:{}{}'.format(port, path), timeout=timeout).read()
+
+
+def bench_workers(workers, preload, workDir, timeout=30.0):
+    """Start gunicorn, wait until every worker is up and has served a
+    request, and return the memory of the master and each worker.
+    """
+    port = _free_port()
+    args = [sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+            '--bind', '127.0.0.1:{}'.format(port),
+            '--pythonpath', '{},{}'.format(ROOT, workDir)]
+    if preload:
+        # the deployed settings, which preload the app
+        args += ['--config', os.path.join(ROOT, 'gunicorn.conf.py')]
+    args.append('bench_wsgi:application')
+
+    start = time.perf_counter()
+    server = subprocess.Popen(args, cwd=workDir, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + timeout
+        ready = None
+        while time.time() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError('gunicorn exited with {}'.format(server.returncode))
+            try:
+                _get(port, '/hello')
+                if len(_children(server.pid)) >= workers:
+                    ready = time.perf_counter() - start
+                    break
+            except (IOError, OSError):
+                pass
+            time.sleep(0.05)
+        if ready is None:
+            raise RuntimeError('gunicorn did not start in {}s'.format(timeout))
+
+        # new connections are spread over the workers, enough requests
+        # reach every one of them
+        for n in range(workers * 20):
+            _get(port, '/')
+
+        pids = _children(server.pid)
+        result = {'ready_seconds': ready, 'master': _memory(server.pid),
+                  'workers': [_memory(pid) for pid in pids]}
+        for key in ('rss_kb', 'pss_kb'):
+            values = [w[key] for w in result['workers'] if w[key] is not None]
+            result['worker_mean_' + key] = statistics.mean(values) if values else None
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run(repeat, workers):
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'repeat': repeat,
+        'benchmarks': {},
+    }
+
+    print('Benchmarking import time', file=sys.stderr)
+    results['benchmarks']['import'] = bench_import(repeat)
+
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        gunicorn = None
+    if gunicorn is None or not os.path.isdir('/proc/self'):
+        print('Skipping the worker benchmark, it needs gunicorn and /proc',
+              file=sys.stderr)
+        return results
+
+    workDir = tempfile.mkdtemp(prefix='searchtool-startup-')
+    try:
+        database = os.path.join(workDir, 'bench.db')
+        with open(os.path.join(workDir, 'bench_wsgi.py'), 'w') as f:
+            f.write(BENCH_WSGI.format(database=database,
+                                      index=os.path.join(workDir, 'index'),
+                                      metrics=os.path.join(workDir, 'metrics')))
+        _python('import sys; sys.path.insert(0, {!r}); import bench_wsgi; '
+                'from searchapp.db import init_db; '
+                'bench_wsgi.application.app_context().push(); init_db()'.format(workDir))
+
+        for preload in (False, True):
+            name = 'workers_preload' if preload else 'workers'
+            print('Benchmarking {} gunicorn workers{}'.format(
+                workers, ' with preload' if preload else ''), file=sys.stderr)
+            results['benchmarks'][name] = bench_workers(workers, preload, workDir)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    return results
+
+
+def summary(results):
+    """Flatten the figures worth tracking into name: value pairs."""
+    bench = results['benchmarks']
+    figures = {
+        'import_seconds': bench['import']['import_seconds'],
+        'app_seconds': bench['import']['app_seconds'],
+    }
+    for name in ('workers', 'workers_preload'):
+        if name in bench:
+            figures[name + '_ready_seconds'] = bench[name]['ready_seconds']
+            figures[name + '_master_rss_kb'] = bench[name]['master']['rss_kb']
+            figures[name + '_mean_rss_kb'] = bench[name]['worker_mean_rss_kb']
+            figures[name + '_mean_pss_kb'] = bench[name]['worker_mean_pss_kb']
+    return figures
+
+
+def compare(old, new, out=sys.stdout):
+    """Print every tracked figure of new next to old."""
+
+    oldFigures = summary(old)
+    print('{:<32} {:>12} {:>12} {:>8}'.format('figure', 'old', 'new', 'change'), file=out)
+    for name, value in sorted(summary(new).items()):
+        oldValue = oldFigures.get(name)
+        if value is None:
+            continue
+        if oldValue:
+            change = '{:+.1f}%'.format((value / oldValue - 1) * 100)
+            oldText = '{:.3f}'.format(oldValue)
+        else:
+            oldText = change = '-'
+        print('{:<32} {:>12} {:>12.3f} {:>8}'.format(name, oldText, value, change), file=out)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark app import time and memory per gunicorn worker.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='interpreter starts timed for the import benchmark')
+    parser.add_argument('--workers', type=int, default=3,
+                        help='gunicorn workers started for the memory benchmark')
+    parser.add_argument('--output', default='startup_output.json',
+                        help='file the JSON results are written to')
+    parser.add_argument('--compare', default=None,
+                        help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.workers)
+
+    with open(args.output, 'w') as outfile:
+        json.dump(results, outfile, indent=2, sort_keys=True)
+    print('Results written to {}'.format(args.output), file=sys.stderr)
+
+    for name, value in sorted(summary(results).items()):
+        if value is not None:
+            print('{:<32} {:>12.3f}'.format(name, value))
+
+    if args.compare:
+        with open(args.compare) as infile:
+            compare(json.load(infile), results)
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn settings for the app, read by `gunicorn -c gunicorn.conf.py`
+"""
+
+import gc
+
+wsgi_app = 'searchapp.wsgi:application'
+bind = '0.0.0.0:8000'
+workers = 3
+
+# import and create the app once in the master; create_app opens nothing that
+# cannot be shared, connections and job threads are made in each worker
+preload_app = True
+
+
+def pre_fork(server, worker):
+    # keep the preloaded objects out of the workers' garbage collections,
+    # which would otherwise touch and copy the pages shared with the master
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
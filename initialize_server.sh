@@ -28,12 +28,13 @@ pip install flask --user
 python setup.py .
 pip install -e . --user
 export FLASK_APP=searchapp
+flask migrate-db
 sudo apt-get install kibana
 
 sudo service elasticsearch restart
 sudo service kibana restart
 sudo service nginx restart
-gunicorn --workers 3 --bind 0.0.0.0:8000 searchapp &
+gunicorn -c gunicorn.conf.py &
 
 # ok, this is too confusing ><
 # basically, make sure elasticsearch and kibana are upgraded
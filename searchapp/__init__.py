@@ -5,6 +5,11 @@ Created on Mon Jan  7 10:49:59 2019
 @author: Cosmo Zen
 
 Script to initiate the app
+
+Importing the package does not create an app, searchapp.wsgi does. create_app
+opens no connections and starts no threads: SQLite connections, the search
+backend and the job workers are created per process on first use, so an app
+created in a preloading gunicorn master is safe to fork.
 """
 
 import os
@@ -18,12 +23,63 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.root_path, 'searchapp.db'),
-	    UPLOAD_FOLDER=os.path.join(app.root_path, 'upload'),
+        SQLITE_BUSY_TIMEOUT=30,
+        USER_CACHE_SIZE=1024,
+        USER_CACHE_TTL=30,
+        ENTRIES_PAGE_SIZE=50,
+        MAX_CONTENT_LENGTH=32 * 1024 * 1024,
+        UPLOAD_SPOOL_MAX_SIZE=8 * 1024 * 1024,
+        BATCH_MAX_FILES=200,
+        BATCH_MAX_BYTES=256 * 1024 * 1024,
+        BATCH_EXTRACT_WORKERS=4,
+        ELASTICSEARCH_HOSTS=None,
+        ELASTICSEARCH_MAXSIZE=10,
+        ELASTICSEARCH_TIMEOUT=10,
+        ELASTICSEARCH_RETRY_ATTEMPTS=3,
+        ELASTICSEARCH_RETRY_DELAY=0.1,
+        ELASTICSEARCH_RETRY_MAX_DELAY=2.0,
+        ELASTICSEARCH_BREAKER_THRESHOLD=5,
+        ELASTICSEARCH_BREAKER_RESET=30,
+        SEARCH_BACKEND='elasticsearch',
+        LOCAL_INDEX_PATH=os.path.join(app.instance_path, 'local_index'),
+        INDEX_SHARDS=1,
+        INDEX_REPLICAS=1,
+        INDEX_ROUTING=None,
+        JOB_WORKERS=2,
+        JOB_QUEUE_MAX=100,
+        JOB_MAX_ATTEMPTS=3,
+        JOB_RETRY_DELAY=5,
+        JOB_POLL_INTERVAL=1,
+        JOB_LEASE=300,
+        OUTBOX_BATCH_SIZE=500,
+        OUTBOX_LEASE=60,
+        OUTBOX_RETRY_DELAY=5,
+        OUTBOX_RETRY_MAX=300,
+        OUTBOX_MAX_ATTEMPTS=10,
+        EXTRACTION_CACHE_MAX_BYTES=256 * 1024 * 1024,
+        DEDUP_POLICY='reuse',
+        SEARCH_PAGE_SIZE=10,
+        SEARCH_MAX_PAGE_SIZE=100,
+        SEARCH_CACHE_SIZE=256,
+        SEARCH_CACHE_TTL=60,
+        PASSAGE_TOKENS=0,
+        PASSAGE_OVERLAP_TOKENS=40,
+        SEARCH_PASSAGES_PER_RESULT=3,
+        SUGGEST_LIMIT=10,
+        SUGGEST_MAX_LIMIT=50,
+        SUGGEST_SCAN=1000,
+        SUGGEST_LOG_MAX=10000,
+        FACETS_SIZE=10,
+        FACETS_MAX_SIZE=100,
+        FACETS_RECONCILE_INTERVAL=3600,
+        NEAR_DUP_THRESHOLD=0.8,
+        NEAR_DUP_PERMUTATIONS=128,
+        NEAR_DUP_BANDS=16,
+        NEAR_DUP_SHINGLE=5,
+        METRICS_DIR=os.path.join(app.instance_path, 'metrics'),
+        METRICS_FLUSH_INTERVAL=5,
     )
 
-    if not os.path.exists(app.config['UPLOAD_FOLDER']):
-        os.makedirs(app.config['UPLOAD_FOLDER'])
-
     if test_config is None:
         # load the instance config, if it exists, when not testing
         app.config.from_pyfile('config.py', silent=True)
@@ -38,6 +94,15 @@ def create_app(test_config=None):
     
     from . import db
     db.init_app(app)
+
+    from . import metrics
+    metrics.init_app(app)
+
+    from . import uploads
+    uploads.init_app(app)
+
+    from . import elastic_loader
+    elastic_loader.init_app(app)
     
     from . import auth
     app.register_blueprint(auth.bp)
@@ -46,7 +111,32 @@ def create_app(test_config=None):
     app.register_blueprint(blog.bp)
     app.add_url_rule('/', endpoint='index')
 
-    return app
+    from . import jobs
+    jobs.init_app(app)
+
+    from . import outbox
+    outbox.init_app(app)
+    app.register_blueprint(jobs.bp)
 
+    from . import extraction_cache
+    extraction_cache.init_app(app)
+    app.register_blueprint(extraction_cache.bp)
 
-application = create_app()
\ No newline at end of file
+    from . import api
+    app.register_blueprint(api.bp)
+
+    from . import suggest
+    suggest.init_app(app)
+    app.register_blueprint(suggest.bp)
+
+    from . import facets
+    facets.init_app(app)
+    app.register_blueprint(facets.bp)
+
+    from . import near_duplicates
+    near_duplicates.init_app(app)
+
+    from . import reindex
+    reindex.init_app(app)
+
+    return app
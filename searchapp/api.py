@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for querying the transcript index from the app
+
+Searches return whole transcripts by default. With mode=passages the query
+runs against the passage index instead, and each transcript comes with the
+passages that matched best, grouped in the order of their best score.
+
+When the index is routed by author or project (INDEX_ROUTING), a search for
+the user's own uploads (mine=1) or for one project is only sent to the shard
+holding them.
+
+A search the backend cannot answer, because it is down, the circuit breaker
+is open or the index does not exist yet, gets a 503.
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import Blueprint, current_app, g, jsonify, request
+from werkzeug.exceptions import abort
+
+from searchapp import metrics
+from searchapp.auth import login_required
+from searchapp.db import get_db
+from searchapp.elastic_loader import ElasticLoader, get_breaker
+from searchapp.search_cache import ResultCache, generation
+from searchapp.word_to_elastic import INDEX_NAME, PASSAGE_INDEX_NAME, routing_key
+
+bp = Blueprint('api', __name__, url_prefix='/api')
+
+_results = None
+
+
+def get_result_cache():
+    global _results
+
+    if _results is None:
+        _results = ResultCache(current_app.config['SEARCH_CACHE_SIZE'],
+                               current_app.config['SEARCH_CACHE_TTL'])
+    return _results
+
+
+def run_search(idxName, body, routing=None):
+    """Send a search to the backend, or abort with 503 when it is unavailable.
+    While the circuit breaker is open the backend is not asked at all.
+    """
+    if get_breaker().state == 'open':
+        abort(503, 'Search is unavailable, try again later')
+    try:
+        return ElasticLoader().search(idxName, body, routing)
+    except Exception as e:
+        current_app.logger.warning('Search of %s failed: %s: %s',
+                                   idxName, type(e).__name__, e)
+        abort(503, 'Search is unavailable, try again later')
+
+
+def parse_date(value, name):
+    """Return a YYYY-MM-DD date argument, '' when it is not given, or abort
+    with 400.
+    """
+    value = value.strip()
+    if value:
+        try:
+            datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            abort(400, '{} must be a date formatted YYYY-MM-DD'.format(name))
+    return value
+
+
+def build_query(q, tags, researcher, project, date_from, date_to, page, size,
+                author_id=None, field='transcription'):
+    """Translate the search parameters into an Elasticsearch query body. The
+    text query on field is scored, the other parameters only filter.
+    """
+    must = [{'match': {field: q}}] if q else [{'match_all': {}}]
+
+    filters = []
+    if author_id is not None:
+        filters.append({'term': {'author_id': author_id}})
+    if tags:
+        filters.append({'terms': {'tags': [t.lower() for t in tags]}})
+    if researcher:
+        filters.append({'match': {'researcher': {'query': researcher, 'operator': 'and'}}})
+    if project:
+        filters.append({'match': {'project': {'query': project, 'operator': 'and'}}})
+    if date_from or date_to:
+        dates = {}
+        if date_from:
+            dates['gte'] = date_from
+        if date_to:
+            dates['lte'] = date_to
+        filters.append({'range': {'date': dates}})
+
+    body = {
+        'query': {'bool': {'must': must, 'filter': filters}},
+        'from': (page - 1) * size,
+        'size': size,
+        # the transcription is only needed for scoring and highlighting
+        '_source': {'excludes': ['transcription']},
+    }
+    if q:
+        body['highlight'] = {'fields': {field: {}}}
+    return body
+
+
+def search_routing(project, author_id):
+    """The routing key of a search, when the index is routed by a field the
+    search filters on, otherwise None to search every shard.
+    """
+    mode = current_app.config['INDEX_ROUTING']
+    if mode == 'author' and author_id is not None:
+        return routing_key({'author_id': author_id}, mode)
+    if mode == 'project' and project:
+        return routing_key({'project': project}, mode)
+    return None
+
+
+def search_passages(q, tags, researcher, project, date_from, date_to, page, size,
+                    author_id=None):
+    """Search the passage index and group the passages by transcript. Only
+    the best scoring passages are grouped, enough to fill the requested page
+    several times over, so total counts the transcripts among those.
+    """
+    perResult = current_app.config['SEARCH_PASSAGES_PER_RESULT']
+    window = min(page * size * 5, 1000)
+    body = build_query(q, tags, researcher, project, date_from, date_to,
+                       1, window, author_id, field='text')
+    hits = run_search(PASSAGE_INDEX_NAME, body,
+                      search_routing(project, author_id))['hits']
+
+    groups = OrderedDict()
+    for hit in hits['hits']:
+        source = dict(hit.get('_source', {}))
+        entryID = source.pop('entry_id')
+        passage = {
+            'passage': source.pop('passage'),
+            'score': hit['_score'],
+            'text': source.pop('text'),
+            'highlight': hit.get('highlight', {}).get('text', []),
+        }
+        group = groups.get(entryID)
+        if group is None:
+            group = groups[entryID] = {'id': str(entryID), 'score': hit['_score'],
+                                       'source': source, 'passages': []}
+        if len(group['passages']) < perResult:
+            group['passages'].append(passage)
+
+    total = hits['total']
+    return {
+        'total': len(groups),
+        'total_passages': total['value'] if isinstance(total, dict) else total,
+        'page': page,
+        'size': size,
+        'hits': list(groups.values())[(page - 1) * size:page * size],
+    }
+
+
+@bp.route('/search')
+@login_required
+def search():
+    args = request.args
+    try:
+        page = max(int(args.get('page', 1)), 1)
+        size = min(max(int(args.get('size', current_app.config['SEARCH_PAGE_SIZE'])), 1),
+                   current_app.config['SEARCH_MAX_PAGE_SIZE'])
+    except ValueError:
+        abort(400, 'page and size must be integers')
+
+    mode = args.get('mode', 'documents')
+    if mode not in ('documents', 'passages'):
+        abort(400, 'mode must be documents or passages')
+    if mode == 'passages':
+        if not current_app.config['PASSAGE_TOKENS']:
+            abort(400, 'Passage search is turned off')
+        if not args.get('q', '').strip():
+            abort(400, 'Passage search needs a query')
+
+    project = args.get('project', '').strip()
+    # mine=1 searches only the user's own uploads
+    author_id = g.user['id'] if args.get('mine') in ('1', 'true') else None
+    params = (
+        args.get('q', '').strip(),
+        tuple(sorted(args.getlist('tags'))),
+        args.get('researcher', '').strip(),
+        project,
+        parse_date(args.get('date_from', ''), 'date_from'),
+        parse_date(args.get('date_to', ''), 'date_to'),
+        page,
+        size,
+        author_id,
+    )
+
+    cache = get_result_cache()
+    gen = generation(get_db())
+    result = cache.get(gen, params + (mode,))
+    metrics.inc('search_cache_requests_total',
+                result='miss' if result is None else 'hit')
+    if result is None and mode == 'passages':
+        result = search_passages(*params)
+        cache.put(gen, params + (mode,), result)
+    elif result is None:
+        response = run_search(INDEX_NAME, build_query(*params),
+                              search_routing(project, author_id))
+        hits = response['hits']
+        total = hits['total']
+        result = {
+            'total': total['value'] if isinstance(total, dict) else total,
+            'page': page,
+            'size': size,
+            'hits': [{
+                'id': hit['_id'],
+                'score': hit['_score'],
+                'source': hit.get('_source', {}),
+                'highlight': hit.get('highlight', {}).get('transcription', []),
+            } for hit in hits['hits']],
+        }
+        cache.put(gen, params + (mode,), result)
+
+    return jsonify(result)
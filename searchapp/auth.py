@@ -8,9 +8,10 @@ Functions for handling user authorization
 """
 
 import functools
+import time
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for
+    Blueprint, current_app, flash, g, redirect, render_template, request, session, url_for
 )
 from werkzeug.security import check_password_hash, generate_password_hash
 
@@ -18,6 +19,31 @@ from searchapp.db import get_db
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
+# (database, user id) -> (time loaded, row), per worker
+_users = {}
+
+
+def get_user(user_id):
+    """The id and username of a user, cached for USER_CACHE_TTL seconds. The
+    key includes the database, so apps with different databases never share
+    rows.
+    """
+    config = current_app.config
+    key = (config['DATABASE'], user_id)
+    now = time.time()
+    cached = _users.get(key)
+    if cached is not None and now - cached[0] < config['USER_CACHE_TTL']:
+        return cached[1]
+
+    user = get_db().execute(
+        'SELECT id, username FROM user WHERE id = ?', (user_id,)
+    ).fetchone()
+    if user is not None:
+        if len(_users) >= config['USER_CACHE_SIZE']:
+            _users.clear()
+        _users[key] = (now, user)
+    return user
+
 
 @bp.route('/register', methods=('GET', 'POST'))
 def register():
@@ -77,12 +103,11 @@ def login():
 def load_logged_in_user():
     user_id = session.get('user_id')
 
-    if user_id is None:
+    # static files look the same to everyone
+    if user_id is None or request.endpoint == 'static':
         g.user = None
     else:
-        g.user = get_db().execute(
-            'SELECT * FROM user WHERE id = ?', (user_id,)
-        ).fetchone()
+        g.user = get_user(user_id)
 
 @bp.route('/logout')
 def logout():
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for uploading many documents in one request
+
+A batch is a set of uploaded documents in any registered format, with any
+.zip uploads expanded to the documents they contain. The documents are
+extracted in a thread pool, then their entries, jobs and outbox operations
+are written in one short transaction, and the outbox sends them to the
+index in bulk requests. Every file gets a result, so one bad file is
+reported without holding back the rest of the batch.
+"""
+
+import os
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from werkzeug.utils import secure_filename
+
+from searchapp import (
+    extraction_cache, extractors, jobs, metrics, near_duplicates, outbox, suggest
+)
+
+
+def _extension(filename):
+    return os.path.splitext(filename)[1].lower()
+
+
+def _read(stream, limit):
+    """Read at most limit bytes of a stream, or all of it when limit is None.
+    Returns None when the stream holds more than that.
+    """
+    if limit is None:
+        return stream.read()
+    data = stream.read(limit + 1)
+    return data if len(data) <= limit else None
+
+
+def collect_uploads(files, maxFiles, maxBytes, maxTotalBytes=None):
+    """Return a result dictionary for every document in a list of uploaded
+    files. The members of .zip uploads in a registered format take the place
+    of the archive. Whatever the archive claims their sizes are, a member is
+    decompressed no further than maxBytes, the whole batch no further than
+    maxTotalBytes, and no more than maxFiles documents are read. Documents
+    that can be processed carry their bytes under 'document' and their format
+    under 'format', the others an error.
+    """
+    uploads = []
+    collected = [0, 0]  # documents, bytes
+
+    def add(filename, document=None, extractor=None, error=None):
+        uploads.append({'filename': filename, 'document': document,
+                        'format': extractor.name if extractor else None,
+                        'status': 'failed' if error else None, 'error': error,
+                        'entry_id': None})
+        if document is not None:
+            collected[0] += 1
+            collected[1] += len(document)
+
+    def full(filename):
+        """Report filename as failed when the batch cannot take any more."""
+        if collected[0] >= maxFiles:
+            add(filename, error='Batches are limited to {} documents'.format(maxFiles))
+        elif maxTotalBytes and collected[1] >= maxTotalBytes:
+            add(filename, error='Batches are limited to {} bytes'.format(maxTotalBytes))
+        else:
+            return False
+        return True
+
+    def read(filename, stream):
+        """Read a document within the limits, or report it as failed and
+        return None.
+        """
+        remaining = maxTotalBytes - collected[1] if maxTotalBytes else None
+        limits = [n for n in (maxBytes, remaining) if n]
+        document = _read(stream, min(limits) if limits else None)
+        if document is None and maxBytes and (remaining is None or maxBytes <= remaining):
+            add(filename, error='Document is larger than the upload limit')
+        elif document is None:
+            add(filename, error='Batches are limited to {} bytes'.format(maxTotalBytes))
+            collected[1] = maxTotalBytes
+        return document
+
+    for f in files:
+        filename = secure_filename(f.filename or '')
+        if not filename:
+            continue
+
+        if _extension(filename) == '.zip':
+            try:
+                with zipfile.ZipFile(f.stream) as archive:
+                    for info in archive.infolist():
+                        basename = os.path.basename(info.filename)
+                        name = secure_filename(basename)
+                        extractor = extractors.find(name)
+                        # Word's lock files start with ~$, which
+                        # secure_filename strips
+                        if (info.is_dir() or info.filename.startswith('__MACOSX/')
+                                or basename.startswith('~$') or extractor is None):
+                            continue
+                        if full(name):
+                            continue
+                        if maxBytes and info.file_size > maxBytes:
+                            add(name, error='Document is larger than the upload limit')
+                            continue
+                        with archive.open(info) as member:
+                            document = read(name, member)
+                        if document is not None:
+                            add(name, document, extractor)
+            except (zipfile.BadZipFile, zlib.error, EOFError):
+                add(filename, error='Not a valid .zip archive')
+            continue
+
+        if full(filename):
+            continue
+        document = read(filename, f)
+        if document is None:
+            continue
+        extractor = extractors.find(filename, document)
+        if extractor is not None:
+            add(filename, document, extractor)
+        else:
+            add(filename, error='Only {} and .zip files are allowed'.format(
+                ', '.join(extractors.extensions())))
+    return uploads
+
+
+def ingest(db, uploads, userID):
+    """Add the documents collected by collect_uploads as entries and index
+    them. Each upload is updated with its status, one of indexed, duplicate,
+    queued (not indexed yet, the outbox keeps retrying) or failed, and the id
+    of its entry. Returns the uploads.
+    """
+    config = current_app.config
+    pending = [upload for upload in uploads if upload['status'] is None]
+
+    # look up and deduplicate by content before anything is extracted
+    seen = {}
+    for upload in pending:
+        key = upload['key'] = extraction_cache.content_hash(upload['document'])
+        if config['DEDUP_POLICY'] != 'link':
+            continue
+        existing = db.execute('select id from entries where content_hash = ?'
+                              ' order by id limit 1', [key]).fetchone()
+        if existing is not None:
+            upload.update(status='duplicate', document=None, entry_id=existing['id'],
+                          error='Already uploaded as entry {}'.format(existing['id']))
+        elif key in seen:
+            upload.update(status='duplicate', document=None,
+                          error='Same document as {}'.format(seen[key]['filename']))
+        else:
+            seen[key] = upload
+    pending = [upload for upload in pending if upload['status'] is None]
+
+    passages = (config['PASSAGE_TOKENS'], config['PASSAGE_OVERLAP_TOKENS'])
+    for upload in pending:
+        upload['json'] = extraction_cache.get(db, upload['key'], commit=False)
+        if upload['json'] is not None:
+            jobs.add_passages(upload['json'], upload['document'], upload['format'],
+                              *passages)
+    # the lookups are counted now, so that no write lock is held while the
+    # documents are extracted
+    db.commit()
+    misses = [upload for upload in pending if upload['json'] is None]
+
+    with metrics.stage('batch_extract'):
+        with ThreadPoolExecutor(max_workers=config['BATCH_EXTRACT_WORKERS']) as pool:
+            futures = [(upload, pool.submit(jobs.extract, upload['document'],
+                                            upload['format'], *passages))
+                       for upload in misses]
+            for upload, future in futures:
+                try:
+                    upload['json'] = future.result()
+                except Exception as e:
+                    upload.update(status='failed', document=None,
+                                  error='{}: {}'.format(type(e).__name__, e))
+    pending = [upload for upload in pending if upload['status'] is None]
+
+    with metrics.stage('minhash'):
+        for upload in pending:
+            upload['signature'] = near_duplicates.document_signature(upload['json'])
+
+    # the new extractions and every entry, its job and its index operation in
+    # one transaction, so the documents still get indexed if this request
+    # does not finish
+    with metrics.stage('db_insert'):
+        for upload in misses:
+            if upload['status'] is None:
+                extraction_cache.put(db, upload['key'], upload['json'],
+                                     config['EXTRACTION_CACHE_MAX_BYTES'], commit=False)
+        for upload in pending:
+            upload['entry_id'] = db.execute(
+                'insert into entries(title, body, author_id, content_hash) values(?, ?, ?, ?)',
+                [upload['filename'], upload['filename'], userID, upload['key']]
+            ).lastrowid
+            upload['job_id'] = jobs.enqueue(db, upload['entry_id'], upload['document'],
+                                            upload['key'], claimed=True,
+                                            format_name=upload['format'])
+            outbox.add(db, upload['entry_id'], 'index', upload['json'])
+            suggest.record(db, upload['entry_id'],
+                           dict(suggest.header_values(upload['json']),
+                                title=[upload['filename']]))
+            near_duplicates.record(db, upload['entry_id'], upload['signature'])
+    with metrics.stage('db_commit'):
+        db.commit()
+
+    outbox.drain(db)
+
+    for upload in pending:
+        job = db.execute('SELECT status, error FROM jobs WHERE id = ?',
+                         (upload['job_id'],)).fetchone()
+        if job['status'] == 'done':
+            upload['status'] = 'indexed'
+        else:
+            upload.update(status='queued', error=job['error'])
+        upload['document'] = upload['json'] = None
+    return uploads
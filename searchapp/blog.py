@@ -10,69 +10,129 @@ Functions for handling document insert and delete
 from flask import (
         current_app, Blueprint, flash, g, redirect, render_template, request, url_for
 )
-from werkzeug.exceptions import abort
 from werkzeug.utils import secure_filename
-from datetime import datetime
 
 from searchapp.auth import login_required
 from searchapp.db import get_db
 
-from searchapp.word_to_elastic import word_to_elastic, delete_from_index
+from searchapp import (
+        batch, extraction_cache, extractors, jobs, metrics, near_duplicates, outbox, suggest
+)
 
-import os
 import sys
 
 bp = Blueprint('blog', __name__)
 
 
+def entry_url(entry_id):
+    """URL of the index page that shows an entry, with its anchor."""
+    return url_for('blog.index', before=entry_id + 1,
+                   _anchor='entry-{}'.format(entry_id))
+
 @bp.route('/')
 def index():
+    # keyset pagination, newest first: each page starts below the lowest id
+    # of the previous one, so it costs the same however deep it is
+    before = request.args.get('before', type=int)
+    size = current_app.config['ENTRIES_PAGE_SIZE']
+
     db = get_db()
     entries = db.execute(
-            	'select id, title, body'
-            	' FROM entries order by id'
+            	'select e.id, e.title, e.body, e.duplicate_of, e.similarity, j.id as job_id, j.status'
+            	' FROM entries e left join jobs j'
+            	' on j.id = (select max(id) from jobs where entry_id = e.id)'
+            	' where e.id < ?'
+            	' order by e.id desc limit ?',
+            	(before if before is not None else sys.maxsize, size + 1)
     ).fetchall()
-    return render_template('blog/index.html', entries=entries)
+
+    older = None
+    if len(entries) > size:
+        entries = entries[:size]
+        older = entries[-1]['id']
+    return render_template('blog/index.html', entries=entries, before=before, older=older,
+                           accept=','.join(extractors.extensions()))
 
 @bp.route('/create', methods=('GET', 'POST'))
 @login_required
 def create():
     if request.method == 'POST':
         f = request.files['file']
-        
-        if f and f.filename.rsplit('.', 1)[1] == 'docx':
-            filename = secure_filename(f.filename)
+        filename = secure_filename(f.filename or '')
 
-            fullpath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-            f.save(fullpath)
-            
-            db = get_db()
-            db.execute('insert into entries(title, body, author_id) values(?, ?, ?)',
-						[filename, filename, g.user['id']])
-            docID = db.execute('select max(id) from entries where title=?', [filename]).fetchone()['max(id)']
-            db.commit()
+        # the upload is held in memory unless it is larger than
+        # UPLOAD_SPOOL_MAX_SIZE, and the job keeps its own copy
+        with metrics.stage('upload_read'):
+            document = f.read() if filename else None
+        extractor = extractors.find(filename, document) if filename else None
 
-            #print(docID, file=sys.stderr)
-            word_to_elastic(fullpath, docID)
-            os.remove(fullpath)
+        if extractor is not None:
+            db = get_db()
 
-            flash('New entry was successfully posted')
+            with metrics.stage('upload_hash'):
+                key = extraction_cache.content_hash(document)
+            if current_app.config['DEDUP_POLICY'] == 'link':
+                existing = db.execute('select id, title from entries where content_hash = ?'
+                                      ' order by id limit 1', [key]).fetchone()
+                if existing is not None:
+                    flash('This document was already uploaded as {}'.format(existing['title']))
+                    return redirect(entry_url(existing['id']))
+
+            with metrics.stage('db_insert'):
+                docID = db.execute('insert into entries(title, body, author_id, content_hash) values(?, ?, ?, ?)',
+						[filename, filename, g.user['id'], key]).lastrowid
+                suggest.record(db, docID, {'title': [filename]})
+
+            try:
+                jobs.enqueue(db, docID, document, key, format_name=extractor.name)
+            except jobs.QueueFull as e:
+                db.rollback()
+                flash(str(e))
+                return redirect(url_for('blog.index'))
+            with metrics.stage('db_commit'):
+                db.commit()
+
+            if current_app.config['JOB_WORKERS'] == 0:
+                jobs.run_pending()
+
+            flash('New entry was queued for indexing')
         
         else:
-            flash('Could not post file, only .docx allowed')
+            flash('Could not post file, only {} files are allowed'.format(
+                ', '.join(extractors.extensions())))
         
         return redirect(url_for('blog.index'))
     
     return render_template('blog/create.html')
 
+@bp.route('/create_batch', methods=('POST',))
+@login_required
+def create_batch():
+    config = current_app.config
+    uploads = batch.collect_uploads(request.files.getlist('file'),
+                                    config['BATCH_MAX_FILES'],
+                                    config['MAX_CONTENT_LENGTH'],
+                                    config['BATCH_MAX_BYTES'])
+    if not uploads:
+        flash('Could not post files, no documents or .zip files were selected')
+        return redirect(url_for('blog.index'))
+
+    batch.ingest(get_db(), uploads, g.user['id'])
+    return render_template('blog/batch.html', uploads=uploads)
+
 @bp.route('/<int:id>/delete', methods=('POST',))
 @login_required
 def delete(id):
     db = get_db()
-    db.execute('DELETE FROM entries WHERE id = ?', (id,))
-    db.commit()
-
-    delete_from_index(id)
+    with metrics.stage('db_delete'):
+        # the delete is routed by the key kept with the entry
+        outbox.add(db, id, 'delete')
+        suggest.forget(db, id)
+        near_duplicates.forget(db, id)
+        db.execute('DELETE FROM entries WHERE id = ?', (id,))
+        db.commit()
+
+    outbox.drain(db)
 
     flash('Entry was successfully deleted')
 
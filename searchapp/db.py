@@ -5,22 +5,74 @@ Created on Mon Jan  7 10:52:10 2019
 @author: Cosmo Zen
 
 Functions for interacting with the database
+
+Each thread keeps its connection open between requests instead of opening a
+new one every time. The database runs in WAL mode, so readers are not blocked
+by the job workers writing and a commit does not have to wait for a full
+fsync of the database file.
+
+An existing database is brought up to schema.sql by `flask migrate-db`,
+which adds the missing tables, indexes, columns and seed rows and keeps the
+data, while `flask init-db` starts over with empty tables.
 """
 
+import os
 import sqlite3
+import threading
 
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    # with WAL, NORMAL only syncs at checkpoints and stays safe on a crash
+    'PRAGMA synchronous = NORMAL',
+    # page cache of 16 MB per connection, in KiB when negative
+    'PRAGMA cache_size = -16000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA mmap_size = 268435456',
+)
+
+_local = threading.local()
+
+# connections a forked child inherited from its parent; they are kept
+# referenced, since closing one in the child could release the parent's locks
+_inherited = []
+
+
+def connect(path):
+    db = sqlite3.connect(
+        path,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        timeout=current_app.config['SQLITE_BUSY_TIMEOUT']
+    )
+    db.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        db.execute(pragma)
+    return db
+
+
+def _thread_connection(path):
+    """Return this thread's connection to the database at path, opening it
+    on first use. A thread that does not run in the process that opened its
+    connections, i.e. after a fork, starts over with new ones.
+    """
+    pid = os.getpid()
+    if getattr(_local, 'pid', None) != pid:
+        _inherited.extend(getattr(_local, 'connections', {}).values())
+        _local.connections = {}
+        _local.pid = pid
+
+    db = _local.connections.get(path)
+    if db is None:
+        db = _local.connections[path] = connect(path)
+    return db
+
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db = _thread_connection(current_app.config['DATABASE'])
 
     return g.db
 
@@ -28,15 +80,86 @@ def get_db():
 def close_db(e=None):
     db = g.pop('db', None)
 
-    if db is not None:
-        db.close()
+    # the connection stays open for the next request of this thread, but
+    # nothing left uncommitted may leak into it
+    if db is not None and db.in_transaction:
+        db.rollback()
+
+
+def _schema():
+    with current_app.open_resource('schema.sql') as f:
+        return f.read().decode('utf8')
 
 
 def init_db():
     db = get_db()
+    db.executescript(_schema())
+
+
+def _column(info):
+    """The definition ALTER TABLE ADD COLUMN takes for a column of PRAGMA
+    table_info. NOT NULL is only kept with a default, which fills the
+    existing rows.
+    """
+    definition = '{} {}'.format(info['name'], info['type'])
+    if info['dflt_value'] is not None:
+        if info['notnull']:
+            definition += ' NOT NULL'
+        definition += ' DEFAULT {}'.format(info['dflt_value'])
+    return definition
+
+
+def migrate_db():
+    """Bring the database up to schema.sql without losing data: create the
+    tables and indexes it lacks, add the columns missing from the tables it
+    has and insert the seed rows it does not have yet. Running it again
+    changes nothing. Returns the list of changes made.
+    """
+    fresh = sqlite3.connect(':memory:')
+    fresh.row_factory = sqlite3.Row
+    fresh.executescript(_schema())
 
-    with current_app.open_resource('schema.sql') as f:
-        db.executescript(f.read().decode('utf8'))
+    db = get_db()
+    existing = dict((row['name'], row['type']) for row in db.execute(
+        "SELECT name, type FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'"))
+    changes = []
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        # tables first, the indexes may be on columns added here
+        objects = fresh.execute(
+            "SELECT name, type, tbl_name, sql FROM sqlite_master"
+            " WHERE name NOT LIKE 'sqlite_%' ORDER BY type = 'index', rowid"
+        ).fetchall()
+        for obj in objects:
+            if obj['type'] == 'table' and obj['name'] in existing:
+                have = set(row['name'] for row in db.execute(
+                    'PRAGMA table_info({})'.format(obj['name'])))
+                for info in fresh.execute('PRAGMA table_info({})'.format(obj['name'])):
+                    if info['name'] not in have:
+                        db.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                            obj['name'], _column(info)))
+                        changes.append('column {}.{}'.format(obj['name'], info['name']))
+            elif obj['name'] not in existing and obj['sql'] is not None:
+                db.execute(obj['sql'])
+                changes.append('{} {}'.format(obj['type'], obj['name']))
+
+            if obj['type'] == 'table':
+                rows = fresh.execute('SELECT * FROM {}'.format(obj['name'])).fetchall()
+                for row in rows:
+                    inserted = db.execute(
+                        'INSERT OR IGNORE INTO {} ({}) VALUES ({})'.format(
+                            obj['name'], ', '.join(row.keys()),
+                            ', '.join('?' * len(row))), tuple(row)
+                    ).rowcount
+                    if inserted:
+                        changes.append('row {}.{}'.format(obj['name'], row[0]))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        fresh.close()
+    return changes
 
 
 @click.command('init-db')
@@ -47,6 +170,18 @@ def init_db_command():
     click.echo('Initialized the database.')
 
 
+@click.command('migrate-db')
+@with_appcontext
+def migrate_db_command():
+    """Update the tables to the current schema, keeping their data."""
+    changes = migrate_db()
+    for change in changes:
+        click.echo('Added {}'.format(change))
+    click.echo('The database is up to date.' if not changes else
+               'Migrated the database, {} changes.'.format(len(changes)))
+
+
 def init_app(app):
     app.teardown_appcontext(close_db)
-    app.cli.add_command(init_db_command)
\ No newline at end of file
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
\ No newline at end of file
@@ -6,96 +6,180 @@ Functions for extracting information from Word documents
 
 from __future__ import print_function, division
 
-import re
-from datetime import datetime
-from pprint import pprint  # useful for troubleshooting dictionary content
-
-from docx import Document
+import io
+import zipfile
+from xml.etree.ElementTree import iterparse
+
+from searchapp.text_processing import PARAGRAPH, TABLE, collect
+
+
+# WordprocessingML namespace and the qualified tag names the streaming
+# extractor cares about
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+W_BODY = W_NS + 'body'
+W_P = W_NS + 'p'
+W_R = W_NS + 'r'
+W_HYPERLINK = W_NS + 'hyperlink'
+W_T = W_NS + 't'
+W_TBL = W_NS + 'tbl'
+W_TR = W_NS + 'tr'
+W_TC = W_NS + 'tc'
+W_TCPR = W_NS + 'tcPr'
+W_GRIDSPAN = W_NS + 'gridSpan'
+W_VMERGE = W_NS + 'vMerge'
+W_VAL = W_NS + 'val'
+W_BREAKS = (W_NS + 'tab', W_NS + 'ptab', W_NS + 'br', W_NS + 'cr')
+
+
+def _paragraph_text(p):
+    """Return the text of a w:p element the way python-docx reports it: only
+    the runs of the paragraph itself (and of its hyperlinks) are read, with
+    tabs and line breaks turned into whitespace.
+    """
 
+    text = []
+    for child in p:
+        if child.tag == W_R:
+            runs = (child,)
+        elif child.tag == W_HYPERLINK:
+            runs = child.findall(W_R)
+        else:
+            continue
+        for r in runs:
+            for node in r:
+                if node.tag == W_T:
+                    if node.text:
+                        text.append(node.text)
+                elif node.tag in W_BREAKS:
+                    text.append(' ')
+    return ''.join(text)
+
+
+def _table_rows(tbl):
+    """Return the rows of a w:tbl element as lists of cell text. Horizontally
+    merged cells are repeated once per grid column and vertically merged
+    cells repeat the text of the cell they continue, matching python-docx's
+    row.cells.
+    """
 
-def element_extract(element):
-    """Element extract will be our ultimate utility function for both
-    paragraph_extract and header_extract. An "element" in this case could be a
-    document, or the content of the cells in a table.
+    rows = []
+    previous = []
+    # only the table's own rows, the rows of a table nested in a cell are not
+    for tr in tbl.findall(W_TR):
+        cells = []
+        for tc in tr.findall(W_TC):
+            span = 1
+            merged = False
+            tcPr = tc.find(W_TCPR)
+            if tcPr is not None:
+                gridSpan = tcPr.find(W_GRIDSPAN)
+                if gridSpan is not None:
+                    span = int(gridSpan.get(W_VAL, 1))
+                vMerge = tcPr.find(W_VMERGE)
+                merged = vMerge is not None and vMerge.get(W_VAL) != 'restart'
+            if merged and len(previous) > len(cells):
+                text = previous[len(cells)]
+            else:
+                text = '\n'.join(_paragraph_text(p) for p in tc.findall(W_P))
+            cells.extend([text] * span)
+        rows.append(cells)
+        previous = cells
+    return rows
+
+
+def zip_source(inputFile):
+    """ZipFile needs a path or a binary file object it can seek in. Bytes are
+    wrapped in a BytesIO, and a stream that cannot seek, such as the body of a
+    request, is read into one.
+    """
+    if isinstance(inputFile, (bytes, bytearray, memoryview)):
+        return io.BytesIO(inputFile)
+    if hasattr(inputFile, 'read'):
+        try:
+            inputFile.tell()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return io.BytesIO(inputFile.read())
+    return inputFile
+
+
+def _body_elements(inputFile):
+    """Yield the paragraphs and tables directly under w:body in document
+    order, each as soon as it has been parsed. An element is discarded when
+    the next one is asked for, so it has to be used right away.
+    """
 
-    You need to return the raw text, where all newlines are replaced with
-    spaces.
+    with zipfile.ZipFile(zip_source(inputFile)) as docx:
+        with docx.open('word/document.xml') as part:
+            body = None
+            depth = 0
+            for event, elem in iterparse(part, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if elem.tag == W_BODY:
+                        body = elem
+                    continue
 
-    Args:
-        element: any component of a DOCX that has the paragraphs property.
+                depth -= 1
+                # only the direct children of w:body are the document's
+                # paragraphs and tables, anything deeper is handled with them
+                if body is None or depth != 2:
+                    continue
 
-    Returns:
-        string of text with only single spaces splitting words (all newlines
-            and multiple spaces are removed)
-    """
-    
-    text = []
-    for p in element.paragraphs:
-        #print(p.text)
-        newwords = p.text.split()
-        if len(newwords) > 0:
-            text.append(' '.join(newwords))
-            
-    return " ".join(text)
+                if elem.tag in (W_P, W_TBL):
+                    yield elem
+                body.remove(elem)
 
 
-def paragraph_extract(inputFile):
-    """This uses the element_extract function and passes the entire document.
-    It does not require any modification.
+def blocks(inputFile):
+    """Yield the top level paragraphs and tables of a DOCX document in
+    document order, in the block form text_processing.collect reads.
 
     Args:
-        inputFile (file): the DOCX file to be read
+        inputFile (file): the DOCX file to be read, as a path, binary file
+            object or bytes
 
-    Returns:
-        string of text from the document skipping word art, tables, etc.
+    Yields:
+        ('paragraph', text) and ('table', rows) tuples
     """
 
-    doc = Document(inputFile)
-    return element_extract(doc)
+    for elem in _body_elements(inputFile):
+        if elem.tag == W_P:
+            yield PARAGRAPH, _paragraph_text(elem)
+        else:
+            yield TABLE, _table_rows(elem)
 
 
-def header_extract(inputFile, splitFields=[]):
-    """From our schema we can assume that the first table is the only table we
-    need to care about in the document as the header and all other tables can be
-    skipped for now.
+def document_extract(inputFile, splitFields=[]):
+    """Single pass extraction of the header table, the other tables and the
+    transcription.
 
-    The function takes an optional argument of splitFields which is an array of
-    potential values. For each header key that is listed in splitFields the data
-    should be split into an array rather than read as a single string. The array
-    can be comma or space delimited so both should be accounted for.
+    The main document part, word/document.xml, is read straight out of the
+    DOCX zip with an incremental XML parser. Each top level paragraph or table
+    is processed as soon as it has been parsed and then discarded, so the full
+    document tree is never held in memory and the file is only unzipped once.
 
-    The header should return a dictionary, d, with key-value pairs for each
-    entry in the table and the addition of a new key for date formatted as YYYY-
-    MM-DD. This date will act as our timestamp for when the document is loaded
-    in the search index. It will be set to "today".
+    The first table is the header. Every other table, such as a coding sheet
+    or a list of timestamps, is added to the headers under 'tables' as a list
+    of rows, see text_processing.collect.
 
     Args:
-        inputFile (file): the DOCX file to be read
+        inputFile (file): the DOCX file to be read, as a path, binary file
+            object or bytes
         splitFields (list): array of header keys that should be treated as
             array elements and not as a single string.
 
     Returns:
-        dictionary of header-key: value for each entry in the first table of the
-            word document or a blank dictionary if none exists. The dictionary
-            should add a key for the date formatted YYYY-MM-DD.
+        tuple of (headers, transcription). headers is a dictionary of
+            header-key: value for each row of the first table, with the date
+            the document was loaded, formatted YYYY-MM-DD, under 'date'.
+            transcription is the text of the paragraphs, skipping word art,
+            tables, etc.
     """
-    
-    headers = {}
-    doc = Document(inputFile)
-    if len(doc.tables) > 0:
-        for r in doc.tables[0].rows:
-            key = r.cells[0].text.lower()
-            value = r.cells[1].text
-            if key in splitFields:
-                value = re.compile('\w+').findall(value)
-            headers[key] = value
-            #print(key, value)
-        headers['date'] = datetime.today().strftime('%Y-%m-%d')
-    return headers
+
+    return collect(blocks(inputFile), splitFields)
 
 
 if __name__ == '__main__':
-    text = paragraph_extract('transcriptions/transcript01.docx')
+    headers, text = document_extract('transcriptions/transcript01.docx', ['Tags'])
     print(text)
-    headers = header_extract('transcriptions/transcript01.docx', ['Tags'])
     print(headers)
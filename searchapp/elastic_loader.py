@@ -6,43 +6,551 @@ Functions for interacting with ElasticSearch via Python
 
 from __future__ import print_function, division
 
-# required for elastic search connection
-from elasticsearch import Elasticsearch
-
+# the elasticsearch package takes a large share of the app's import time,
+# so it is only imported once a client is created, see get_client
 import sys
 import os
+import random
+import threading
 import time
+from contextlib import contextmanager
+
+from searchapp import metrics
+
+# Settings for the shared client and backend. The app sets them from its
+# config with init_app, scripts can call configure directly.
+_settings = {'hosts': None, 'maxsize': 10, 'timeout': 10,
+             'backend': 'elasticsearch', 'local_path': None,
+             'shards': 1, 'replicas': 1,
+             'retry_attempts': 3, 'retry_delay': 0.1, 'retry_max_delay': 2.0,
+             'breaker_threshold': 5, 'breaker_reset': 30}
+
+# One client, and with it one connection pool, per process. The pid is kept
+# with it so a client inherited through a fork is never reused by the child.
+_client = None
+_client_pid = None
+_client_lock = threading.RLock()
+
+# The backend ElasticLoader uses by default, created per process like _client
+_backend = None
+_backend_pid = None
+
+# The circuit breaker of the writes of this process, see get_breaker
+_breaker = None
+_breaker_pid = None
+
+# Names of the indices this process has already created or seen created
+_known_indices = set()
+
+
+def configure(hosts=None, maxsize=10, timeout=10, backend='elasticsearch',
+              localPath=None, shards=1, replicas=1, retryAttempts=3,
+              retryDelay=0.1, retryMaxDelay=2.0, breakerThreshold=5,
+              breakerReset=30):
+    '''
+    Set the connection settings of the shared client and choose the
+    backend. A client or backend that was already created with the
+    old settings is dropped and rebuilt on next use.
+
+    Signature:
+        hosts = list of hosts, or a comma separated string of hosts,
+            None for localhost:9200
+        maxsize = number of connections kept open per host
+        timeout = request timeout in seconds
+        backend = 'elasticsearch', or 'local' for the embedded engine
+            in local_search
+        localPath = directory the local backend keeps its indices in
+        shards = number of primary shards of indices created from
+            an index template
+        replicas = number of replicas of those indices
+        retryAttempts = number of times a write that failed with a
+            retryable error is tried in all
+        retryDelay = delay in seconds before the first retry, doubled
+            for every further retry, with jitter
+        retryMaxDelay = upper bound of the delay between retries
+        breakerThreshold = retryable failures in a row after which
+            writes fail at once, 0 to never stop them
+        breakerReset = seconds the breaker stays open before a write
+            is let through to try the backend again
+    '''
+    global _client, _client_pid, _backend, _backend_pid, _breaker, _breaker_pid
+
+    if backend not in BACKENDS:
+        raise ValueError('Unknown search backend: {}'.format(backend))
+
+    if isinstance(hosts, str):
+        hosts = [h.strip() for h in hosts.split(',') if h.strip()]
+
+    with _client_lock:
+        _settings.update(hosts=hosts, maxsize=maxsize, timeout=timeout,
+                         backend=backend, local_path=localPath,
+                         shards=shards, replicas=replicas,
+                         retry_attempts=retryAttempts, retry_delay=retryDelay,
+                         retry_max_delay=retryMaxDelay,
+                         breaker_threshold=breakerThreshold,
+                         breaker_reset=breakerReset)
+        _client = _client_pid = None
+        _backend = _backend_pid = None
+        _breaker = _breaker_pid = None
+    _known_indices.clear()
+
+
+def get_client():
+    '''
+    Return the Elasticsearch client shared by this process, creating it
+    on first use. After a fork, e.g. of a preloaded gunicorn master, the
+    child creates its own client instead of sharing the parent's sockets.
+    The elasticsearch package is imported here, on first use.
+    '''
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                from elasticsearch import Elasticsearch
+                _client = Elasticsearch(_settings['hosts'],
+                                        maxsize=_settings['maxsize'],
+                                        timeout=_settings['timeout'])
+                _client_pid = pid
+    return _client
+
+
+def get_backend():
+    '''
+    Return the backend selected with configure, one instance per
+    process. The local backend is only imported when it is selected.
+    '''
+    global _backend, _backend_pid
+
+    pid = os.getpid()
+    if _backend is None or _backend_pid != pid:
+        with _client_lock:
+            if _backend is None or _backend_pid != pid:
+                if _settings['backend'] == 'local':
+                    from searchapp.local_search import LocalBackend
+                    _backend = LocalBackend(_settings['local_path'])
+                else:
+                    _backend = ElasticsearchBackend(get_client())
+                _backend_pid = pid
+    return _backend
+
+
+def get_breaker():
+    '''
+    Return the circuit breaker guarding the writes of this process,
+    created on first use. A breaker inherited through a fork is
+    replaced, so a child starts closed with a lock of its own.
+    '''
+    global _breaker, _breaker_pid
+
+    pid = os.getpid()
+    if _breaker is None or _breaker_pid != pid:
+        with _client_lock:
+            if _breaker is None or _breaker_pid != pid:
+                _breaker = CircuitBreaker(_settings['breaker_threshold'],
+                                          _settings['breaker_reset'])
+                _breaker_pid = pid
+    return _breaker
+
+
+def init_app(app):
+    configure(hosts=app.config.get('ELASTICSEARCH_HOSTS'),
+              maxsize=app.config.get('ELASTICSEARCH_MAXSIZE', 10),
+              timeout=app.config.get('ELASTICSEARCH_TIMEOUT', 10),
+              backend=app.config.get('SEARCH_BACKEND', 'elasticsearch'),
+              localPath=app.config.get('LOCAL_INDEX_PATH'),
+              shards=app.config.get('INDEX_SHARDS', 1),
+              replicas=app.config.get('INDEX_REPLICAS', 1),
+              retryAttempts=app.config.get('ELASTICSEARCH_RETRY_ATTEMPTS', 3),
+              retryDelay=app.config.get('ELASTICSEARCH_RETRY_DELAY', 0.1),
+              retryMaxDelay=app.config.get('ELASTICSEARCH_RETRY_MAX_DELAY', 2.0),
+              breakerThreshold=app.config.get('ELASTICSEARCH_BREAKER_THRESHOLD', 5),
+              breakerReset=app.config.get('ELASTICSEARCH_BREAKER_RESET', 30))
+
+
+class ElasticsearchBackend(object):
+
+    '''
+    The backend that talks to an ElasticSearch cluster. Every backend
+    implements put_template, create_index, exists, get_alias, swap_alias,
+    insert, get, delete, delete_by_query, bulk, scan, count, search,
+    get_settings, put_settings, refresh, forcemerge and delete_index with
+    the signatures of the ElasticLoader methods that call them.
+    '''
+
+    def __init__(self, es):
+        self.es = es
+
+    def put_template(self, name, template):
+        self.es.indices.put_template(name=name, body=template)
+
+    def create_index(self, idxName, mapping=None, aliases=()):
+        body = {'mappings': mapping} if mapping else {}
+        if aliases:
+            body['aliases'] = dict((alias, {}) for alias in aliases)
+        self.es.indices.create(index=idxName, body=body, ignore=400)
+
+    def exists(self, name):
+        return self.es.indices.exists(index=name)
+
+    def get_alias(self, alias):
+        if not self.es.indices.exists_alias(name=alias):
+            return []
+        return sorted(self.es.indices.get_alias(name=alias))
+
+    def swap_alias(self, alias, newIndex):
+        actions = [{'remove': {'index': idxName, 'alias': alias}}
+                   for idxName in self.get_alias(alias)]
+        if not actions and self.es.indices.exists(index=alias):
+            # an index created under the alias's name before aliases were
+            # used is deleted in the same request
+            actions.append({'remove_index': {'index': alias}})
+        actions.append({'add': {'index': newIndex, 'alias': alias}})
+        self.es.indices.update_aliases(body={'actions': actions})
+
+    def insert(self, idxName, docID, docType, body, refresh=False, routing=None):
+        self.es.index(index=idxName, id=docID, doc_type=docType, body=body,
+                      refresh=refresh, routing=routing)
+
+    def get(self, idxName, docID, docType, routing=None):
+        response = self.es.get(index=idxName, id=docID, doc_type=docType,
+                               routing=routing, ignore=404)
+        return response['_source'] if response.get('found') else None
+
+    def delete(self, idxName, docID, docType, refresh=False, routing=None):
+        self.es.delete(index=idxName, id=docID, doc_type=docType,
+                       refresh=refresh, routing=routing)
+
+    def delete_by_query(self, idxName, query):
+        self.es.delete_by_query(index=idxName, body={'query': query},
+                                conflicts='proceed', refresh=True)
+
+    def bulk(self, actions, chunkSize=500, threadCount=1, queueSize=4,
+             refresh=False):
+        # extra keyword arguments are passed on to every bulk request
+        from elasticsearch import helpers
+
+        kwargs = {'refresh': refresh} if refresh else {}
+        if threadCount > 1:
+            return helpers.parallel_bulk(self.es, actions,
+                                         thread_count=threadCount,
+                                         chunk_size=chunkSize,
+                                         queue_size=queueSize,
+                                         raise_on_error=False,
+                                         raise_on_exception=False,
+                                         **kwargs)
+
+        return helpers.streaming_bulk(self.es, actions,
+                                      chunk_size=chunkSize,
+                                      raise_on_error=False,
+                                      raise_on_exception=False,
+                                      **kwargs)
+
+    def scan(self, idxName, source=True, chunkSize=500):
+        from elasticsearch import helpers
+
+        for hit in helpers.scan(self.es, index=idxName, size=chunkSize,
+                                query={'query': {'match_all': {}},
+                                       '_source': source}):
+            yield hit['_id'], hit.get('_source', {})
+
+    def count(self, idxName):
+        return self.es.count(index=idxName)['count']
+
+    def search(self, idxName, body, routing=None):
+        return self.es.search(index=idxName, body=body, routing=routing)
+
+    def get_settings(self, idxName):
+        response = self.es.indices.get_settings(index=idxName)
+        return list(response.values())[0]['settings']['index']
+
+    def put_settings(self, idxName, settings):
+        self.es.indices.put_settings(index=idxName, body=settings)
+
+    def refresh(self, idxName):
+        self.es.indices.refresh(index=idxName)
+
+    def forcemerge(self, idxName, maxSegments=1):
+        self.es.indices.forcemerge(index=idxName, max_num_segments=maxSegments,
+                                   request_timeout=3600)
+
+    def delete_index(self, idxName):
+        self.es.indices.delete(index=idxName, ignore=[400, 404])
+
+
+BACKENDS = ('elasticsearch', 'local')
+
+
+# statuses, besides the 5xx ones, of requests that may succeed when they are
+# sent again: a request timeout and a full queue of the cluster
+RETRYABLE_STATUS = (408, 429)
+
+
+def versioned_name(alias, version):
+    ''' Name of the physical index holding version `version` of an alias. '''
+    return '{}_v{}'.format(alias, version)
+
+
+class CircuitOpenError(Exception):
+    ''' Raised instead of sending a write while the circuit breaker is open. '''
+
+
+class WriteError(Exception):
+    '''
+    A write that failed, with whether trying it again may succeed,
+    as reported for each document by word_to_elastic.sync_documents.
+    '''
+
+    def __init__(self, message, retryable):
+        super(WriteError, self).__init__(message)
+        self.retryable = retryable
+
+
+def is_retryable(error):
+    '''
+    Return whether a failed write may succeed when it is tried again:
+    the backend could not be reached, timed out, was overloaded (429)
+    or failed itself (5xx). A rejected request or document, e.g. one
+    that does not fit the mapping, fails the same way every time.
+
+    Signature:
+        error = the exception raised by the write, or the status of a
+            failed bulk item, which is not a number when the request
+            of the item got no response
+    '''
+    if isinstance(error, (CircuitOpenError, WriteError)):
+        return getattr(error, 'retryable', True)
+
+    status = getattr(error, 'status_code', None) if isinstance(error, Exception) else error
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS or status >= 500
+    if not isinstance(error, Exception):
+        return True
+    if isinstance(error, OSError):
+        return True
+    if 'elasticsearch' in sys.modules:
+        from elasticsearch.exceptions import ConnectionError
+        return isinstance(error, ConnectionError)
+    return False
+
+
+def backoff(attempt, delay, maxDelay):
+    '''
+    Seconds to wait before retry number attempt + 1: the delay doubled
+    for every earlier retry, capped at maxDelay, of which a random half
+    is taken off so clients that failed together do not retry together.
+    '''
+    wait = min(delay * 2 ** attempt, maxDelay)
+    return wait / 2 + random.uniform(0, wait / 2)
+
+
+class CircuitBreaker(object):
+
+    '''
+    Stops sending writes to a backend that keeps failing. After
+    threshold retryable failures in a row the breaker opens, and for
+    resetTimeout seconds every write fails at once with
+    CircuitOpenError instead of waiting for the backend to time out.
+    Then the next write is let through as a trial: if it succeeds the
+    breaker closes, if it fails the breaker stays open for another
+    resetTimeout seconds. A threshold of 0 never opens it.
+    '''
+
+    def __init__(self, threshold=5, resetTimeout=30):
+        self.threshold = threshold
+        self.resetTimeout = resetTimeout
+        self.failures = 0
+        self.openedAt = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.openedAt is None:
+            return 'closed'
+        if time.time() - self.openedAt >= self.resetTimeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        ''' Raise CircuitOpenError unless a write may be sent now. '''
+        with self._lock:
+            if self.openedAt is None:
+                return
+            now = time.time()
+            if now - self.openedAt >= self.resetTimeout:
+                # the trial write; the others wait for its outcome
+                self.openedAt = now
+                return
+        metrics.inc('es_breaker_rejected_total')
+        raise CircuitOpenError('search backend unavailable, writes are paused '
+                               'for up to {}s'.format(self.resetTimeout))
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.openedAt = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.threshold and self.failures >= self.threshold:
+                if self.openedAt is None:
+                    metrics.inc('es_breaker_opened_total')
+                self.openedAt = time.time()
+
 
 class ElasticLoader():
 
     '''
     A loader class for elastic search. It wraps the Python Elastic
     Search API with methods to create an index, delete an index, 
-    and load documents. 
+    and load documents. The work is done by a backend, ElasticSearch
+    or the embedded engine, chosen with configure.
+
+    Writes go through the circuit breaker of the process. Inserts and
+    deletes that fail with a retryable error are tried again after a
+    backoff, up to the attempts set with configure.
     '''
 
-    def __init__(self):
+    def __init__(self, es=None, backend=None):
         '''
         Initialize an ElasticLoader object with the .es ElasticSearch property.
-        No modification is required. 
+        Unless a client or backend is passed in, the process wide backend
+        from get_backend is used, so loaders are cheap to create. .es is
+        None when the backend is not ElasticSearch.
         '''
-        self.es = Elasticsearch()
+        if backend is None:
+            backend = ElasticsearchBackend(es) if es is not None else get_backend()
+        self.backend = backend
+        self.es = getattr(backend, 'es', None)
 
-    def create_index_with_mapping(self, idxName, mapping):
+    def create_index_with_mapping(self, idxName, mapping=None):
         ''' 
         Given an index name and a mapping, create the
         index with the mapping. By default set the ignore=400
-        parameter on the create method.
+        parameter on the create method. Indices this process has
+        already created are remembered, so repeated calls only
+        reach the cluster once.
 
         Signature:
             idxName = name of the index to create
-            mapping = dictionary with the mapping for the index
+            mapping = dictionary with the mapping for the index,
+                None to take it from the index template matching
+                the name
 
         ref: https://elasticsearch-py.readthedocs.io/en/master/api.html#elasticsearch.client.IndicesClient.create
         '''
-        self.es.indices.create(index=idxName, body=mapping, ignore=400)
+        if idxName in _known_indices:
+            return
+
+        self.backend.create_index(idxName, mapping)
+        _known_indices.add(idxName)
+
+    def put_template(self, alias, version, mapping, settings=None):
+        '''
+        Store the mapping and settings of the indices behind an alias
+        as the index template <alias>, applied to every index named
+        <alias>_v<n> that is created from then on. The template
+        carries the mapping version, and the shard and replica counts
+        set with configure unless settings give their own. Indices
+        that already exist keep what they were created with.
+
+        Signature:
+            alias = name the indices are read and written through
+            version = version of the mapping
+            mapping = dictionary with the mapping for the indices
+            settings = dictionary of further index settings, e.g.
+                analysis
+
+        ref: https://www.elastic.co/guide/en/elasticsearch/reference/6.3/indices-templates.html
+        '''
+        template = {
+            'index_patterns': [versioned_name(alias, '*')],
+            'version': version,
+            'settings': dict({'number_of_shards': _settings['shards'],
+                              'number_of_replicas': _settings['replicas']},
+                             **(settings or {})),
+            'mappings': mapping,
+        }
+        self.backend.put_template(alias, template)
+
+    def create_versioned_index(self, alias, version, mapping, settings=None):
+        '''
+        Make sure the alias exists. If there is neither an alias nor
+        an index of that name, the index template of the alias is
+        stored, and the physical index <alias>_v<version> is created
+        from it together with the alias, so documents are always
+        written and searched through the alias. An existing alias is
+        left where it points; moving it to a new version is the job
+        of the reindex command. The cluster is only asked once per
+        process.
+
+        Signature:
+            alias = name the index is read and written through
+            version = version of the mapping
+            mapping = dictionary with the mapping for the index
+            settings = dictionary of further index settings
+        '''
+        if alias in _known_indices:
+            return
+
+        if not self.backend.exists(alias):
+            self.put_template(alias, version, mapping, settings)
+            self.backend.create_index(versioned_name(alias, version),
+                                      aliases=[alias])
+        _known_indices.add(alias)
+
+    def exists(self, name):
+        ''' Return whether an index or alias of this name exists. '''
+        return self.backend.exists(name)
+
+    def get_alias(self, alias):
+        ''' Return the names of the indices the alias points to. '''
+        return self.backend.get_alias(alias)
+
+    def swap_alias(self, alias, newIndex):
+        '''
+        Point the alias at newIndex and away from every other index
+        in one atomic request, so searches never see a missing or
+        half built index. An old index that has the alias's name
+        itself is deleted as part of the swap.
+
+        ref: https://www.elastic.co/guide/en/elasticsearch/reference/6.3/indices-aliases.html
+        '''
+        self.backend.swap_alias(alias, newIndex)
+        _known_indices.discard(alias)
+
+    def _write(self, op, func, *args):
+        '''
+        Call func(*args) through the circuit breaker, retrying it with
+        exponential backoff and jitter while it fails with a retryable
+        error. The last error is raised.
+        '''
+        breaker = get_breaker()
+        attempt = 0
+        while True:
+            breaker.allow()
+            try:
+                return_value = func(*args)
+            except Exception as e:
+                metrics.inc('es_errors_total', op=op, error=type(e).__name__)
+                if not is_retryable(e):
+                    # the backend answered, it is the request that is wrong
+                    breaker.success()
+                    raise
+                breaker.failure()
+                attempt += 1
+                if attempt >= _settings['retry_attempts']:
+                    raise
+                metrics.inc('es_retries_total', op=op)
+                time.sleep(backoff(attempt - 1, _settings['retry_delay'],
+                                   _settings['retry_max_delay']))
+            else:
+                breaker.success()
+                return return_value
         
-    def insert(self, idxName, docID, docType, body):
+    def insert(self, idxName, docID, docType, body, refresh=False, routing=None):
         '''
         Insert a document of specified type into the index.
 
@@ -51,52 +559,222 @@ class ElasticLoader():
             docID = id of the document to be inserted
             docType = the document type to be added associated to the post
             body = a dictionary document to be posted
+            refresh = False, or 'wait_for' to return only once the
+                document is visible to searches
+            routing = routing key that picks the shard of the document,
+                None to route it by its id
 
         ref: https://elasticsearch-py.readthedocs.io/en/master/api.html#elasticsearch.Elasticsearch.index
         '''
-        self.es.index(index=idxName, id=docID, doc_type=docType, body=body)
+        self._write('insert', self.backend.insert, idxName, docID, docType,
+                    body, refresh, routing)
         
-    def try_insert(self, indexName, docID, doctype, body, silent=True):
+    def try_insert(self, indexName, docID, doctype, body, silent=True,
+                   routing=None):
         '''
         Wrap the self.insert method in a try/except
-        statement with optional output on failure. 
-        No modification is required.
+        statement with optional output on failure.
+        Returns whether the document was inserted, so
+        the caller can keep a failed one to load later.
         '''
         try:
-            self.insert(indexName, docID, doctype, body)
+            self.insert(indexName, docID, doctype, body, routing=routing)
+            return True
+
+        except Exception as e:
+            if not silent:
+                print("ERROR inserting {} ({}): {}: {}".format(
+                    docID, 'retryable' if is_retryable(e) else 'permanent',
+                    type(e).__name__, e), file=sys.stderr)
+            return False
+
+    def bulk(self, actions, chunkSize=500, threadCount=1, queueSize=4,
+             refresh=False):
+        '''
+        Stream an iterable of bulk actions into the cluster and yield one
+        (ok, item) result per document, in the style of the bulk helpers.
+        Failed documents are yielded rather than raised so the caller can
+        report them individually.
 
-        except:
-            if (silent):
-                pass
-            else:
-                print("ERROR {}".format(sys.exc_info()))
+        Signature:
+            actions = iterable of bulk action dictionaries, each with
+                _index, _type, _id and _source
+            chunkSize = number of documents sent per bulk request
+            threadCount = number of bulk requests in flight at once, above
+                one the actions are sent with parallel_bulk
+            queueSize = number of chunks buffered for the sending threads
+            refresh = False, or 'wait_for' to return each chunk only once
+                its documents are visible to searches
+
+        ref: https://elasticsearch-py.readthedocs.io/en/master/helpers.html#bulk-helpers
+        '''
+        breaker = get_breaker()
+        breaker.allow()
+        return self._bulk_results(breaker, self.backend.bulk(
+            actions, chunkSize, threadCount, queueSize, refresh))
+
+    @staticmethod
+    def _bulk_results(breaker, results):
+        # a request that failed or was pushed back counts as one failure
+        # of the backend, the rejection of single documents does not
+        unavailable = False
+        try:
+            for ok, item in results:
+                if not ok and is_retryable(list(item.values())[0].get('status')):
+                    unavailable = True
+                yield ok, item
+        except Exception as e:
+            if is_retryable(e):
+                breaker.failure()
+            raise
+        if unavailable:
+            breaker.failure()
+        else:
+            breaker.success()
+
+    def get(self, idxName, docID, doctype, routing=None):
+        '''
+        Return the source of a document, or None if it does not exist.
+        A document indexed with a routing key is only found with it.
+        '''
+        return self.backend.get(idxName, docID, doctype, routing)
 
-    def delete(self, idxName, docID, doctype):
+    def delete(self, idxName, docID, doctype, refresh=False, routing=None):
         '''
         Delete a document from the index.
 
         Signature:
             idxName = name of existing index for document loading
             docID = id of the document to be deleted
+            refresh = False, or 'wait_for' to return only once the
+                deletion is visible to searches
+            routing = the routing key the document was indexed with,
+                or None; with any other key the document is not found
 
         ref: https://elasticsearch-py.readthedocs.io/en/master/api.html#elasticsearch.Elasticsearch.index
         '''
-        self.es.delete(index=idxName, id=docID, doc_type=doctype)
+        self._write('delete', self.backend.delete, idxName, docID, doctype,
+                    refresh, routing)
+
+    def delete_by_query(self, idxName, query):
+        '''
+        Delete every document of the index that matches query and
+        return once the deletions are visible to searches.
+
+        Signature:
+            idxName = name of the index or alias
+            query = dictionary with the query DSL of the documents
+
+        ref: https://elasticsearch-py.readthedocs.io/en/master/api.html#elasticsearch.Elasticsearch.delete_by_query
+        '''
+        self._write('delete_by_query', self.backend.delete_by_query,
+                    idxName, query)
 
-    def try_delete(self, indexName, docID, doctype, silent=True):
+    def try_delete(self, indexName, docID, doctype, silent=True, refresh=False,
+                   routing=None):
         '''
         Wrap the self.delete method in a try/except
         statement with optional output on failure.
-        No modification is required.
+        Returns whether the document was deleted.
         '''
         try:
-            self.delete(indexName, docID, doctype)
+            self.delete(indexName, docID, doctype, refresh, routing)
+            return True
 
-        except:
-            if (silent):
-                pass
-            else:
-                print("ERROR {}".format(sys.exc_info()))
+        except Exception as e:
+            if not silent:
+                print("ERROR deleting {} ({}): {}: {}".format(
+                    docID, 'retryable' if is_retryable(e) else 'permanent',
+                    type(e).__name__, e), file=sys.stderr)
+            return False
+
+    def scan(self, idxName, source=True, chunkSize=500):
+        '''
+        Yield (docID, source) for every document in the index, read in
+        pages of chunkSize with the scroll API.
+
+        Signature:
+            idxName = name of the index or alias to read
+            source = False to only read the ids
+            chunkSize = number of documents fetched per request
+
+        ref: https://elasticsearch-py.readthedocs.io/en/master/helpers.html#scan
+        '''
+        return self.backend.scan(idxName, source, chunkSize)
+
+    def count(self, idxName):
+        ''' Return the number of documents in the index. '''
+        return self.backend.count(idxName)
+
+    def put_settings(self, idxName, settings):
+        '''
+        Change the dynamic settings of an index, e.g. its
+        refresh_interval. A setting of None restores its default.
+
+        ref: https://elasticsearch-py.readthedocs.io/en/master/api.html#elasticsearch.client.IndicesClient.put_settings
+        '''
+        self.backend.put_settings(idxName, settings)
+
+    def get_settings(self, idxName):
+        ''' Return the index settings of the index, e.g. its replicas. '''
+        return self.backend.get_settings(idxName)
+
+    def refresh(self, idxName):
+        ''' Make everything written to the index visible to searches. '''
+        self.backend.refresh(idxName)
+
+    def forcemerge(self, idxName, maxSegments=1):
+        '''
+        Merge the segments of the index down to maxSegments, which
+        makes searches of an index that is no longer written to
+        faster and drops its deleted documents. This can take a
+        long time on a big index.
+
+        ref: https://elasticsearch-py.readthedocs.io/en/master/api.html#elasticsearch.client.IndicesClient.forcemerge
+        '''
+        self.backend.forcemerge(idxName, maxSegments)
+
+    @contextmanager
+    def bulk_load(self, idxName, maxSegments=1):
+        '''
+        Context manager for loading a large number of documents.
+        Refreshes and replicas are turned off for the duration, as
+        every refresh writes a new segment and every document would
+        be indexed again on each replica. Afterwards the previous
+        settings are restored and the index is refreshed. When the
+        load finished without an error the index is force merged to
+        maxSegments, None to skip the merge.
+
+        Signature:
+            idxName = name of the index or alias being loaded
+            maxSegments = segments to merge the index down to
+        '''
+        current = self.get_settings(idxName)
+        previous = {'refresh_interval': current.get('refresh_interval'),
+                    'number_of_replicas': current.get('number_of_replicas')}
+        self.put_settings(idxName, {'index': {'refresh_interval': '-1',
+                                              'number_of_replicas': 0}})
+        try:
+            yield
+        finally:
+            self.put_settings(idxName, {'index': previous})
+            self.refresh(idxName)
+        if maxSegments:
+            self.forcemerge(idxName, maxSegments)
+
+    def search(self, idxName, body, routing=None):
+        '''
+        Run a query against the index and return the raw response.
+
+        Signature:
+            idxName = name of the index to search
+            body = dictionary with the query DSL body
+            routing = routing key, to only search the shard holding
+                the documents of that key, None to search every shard
+
+        ref: https://elasticsearch-py.readthedocs.io/en/master/api.html#elasticsearch.Elasticsearch.search
+        '''
+        return self.backend.search(idxName, body, routing)
 
     def delete_index(self, idxName):
         '''
@@ -106,7 +784,8 @@ class ElasticLoader():
 
         ref: https://elasticsearch-py.readthedocs.io/en/master/api.html#elasticsearch.client.IndicesClient.delete
         '''
-        self.es.indices.delete(index=idxName, ignore=[400, 404])
+        self.backend.delete_index(idxName)
+        _known_indices.discard(idxName)
 
 def unit_test():
     
@@ -139,7 +818,7 @@ def unit_test():
         doctype: {
             'dynamic':'strict',
             'properties':{
-                'Transcription':{'type':'string'}
+                'Transcription':{'type':'text'}
             }
         }
     }
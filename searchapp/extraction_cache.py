@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for caching document extractions by content hash
+
+Re-uploads of a file that has been seen before, under any name, reuse the
+header and transcription extracted the first time instead of parsing the
+document again. The cache lives in the app's SQLite database and is bounded
+by EXTRACTION_CACHE_MAX_BYTES, evicting the least recently used extractions
+first. Hit and miss counters are kept next to it so they add up across all
+gunicorn workers.
+"""
+
+import hashlib
+import json
+from datetime import datetime
+
+import click
+from flask import Blueprint, current_app, jsonify
+from flask.cli import with_appcontext
+
+from searchapp.auth import login_required
+from searchapp.db import get_db
+
+bp = Blueprint('cache', __name__, url_prefix='/cache')
+
+CHUNK_SIZE = 1024 * 1024
+
+# bumped whenever the extractor starts returning something different, so
+# extractions cached by an older one are missed and age out of the cache
+EXTRACTOR_VERSION = 2
+
+
+def content_hash(f):
+    """Return the SHA-256 hex digest of a file path, bytes or a binary file
+    object. A file object is read from its current position and rewound
+    afterwards.
+    """
+    h = hashlib.sha256()
+
+    if isinstance(f, (bytes, bytearray, memoryview)):
+        h.update(f)
+    elif isinstance(f, str):
+        with open(f, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+                h.update(chunk)
+    else:
+        start = f.tell()
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+        f.seek(start)
+
+    return h.hexdigest()
+
+
+def _cache_key(key):
+    return '{}:{}'.format(EXTRACTOR_VERSION, key)
+
+
+def _count(db, name):
+    db.execute('UPDATE cache_stats SET value = value + 1 WHERE name = ?', (name,))
+
+
+def get(db, key, commit=True):
+    """Return the cached extraction for a content hash, or None. The entry is
+    marked as recently used and the hit or miss is counted. The header date is
+    the load date of a document, so it is set to today rather than reused.
+    With commit=False the bookkeeping is left to the caller's transaction.
+    """
+    row = db.execute(
+        'SELECT body FROM extraction_cache WHERE hash = ?', (_cache_key(key),)
+    ).fetchone()
+
+    if row is None:
+        _count(db, 'misses')
+        if commit:
+            db.commit()
+        return None
+
+    db.execute(
+        "UPDATE extraction_cache SET last_used = julianday('now') WHERE hash = ?",
+        (_cache_key(key),)
+    )
+    _count(db, 'hits')
+    if commit:
+        db.commit()
+
+    json_out = json.loads(row[0])
+    if 'date' in json_out:
+        json_out['date'] = datetime.today().strftime('%Y-%m-%d')
+    return json_out
+
+
+def put(db, key, json_out, maxBytes, commit=True):
+    """Store an extraction under its content hash, then evict the least
+    recently used extractions until the cache fits in maxBytes.
+    """
+    body = json.dumps(json_out)
+    if len(body) > maxBytes:
+        return
+
+    db.execute(
+        'INSERT OR REPLACE INTO extraction_cache (hash, body, size, last_used)'
+        " VALUES (?, ?, ?, julianday('now'))", (_cache_key(key), body, len(body))
+    )
+
+    total = db.execute('SELECT sum(size) FROM extraction_cache').fetchone()[0]
+    if total > maxBytes:
+        evict = []
+        for old, size in db.execute(
+                'SELECT hash, size FROM extraction_cache ORDER BY last_used'):
+            if total <= maxBytes:
+                break
+            evict.append((old,))
+            total -= size
+        db.executemany('DELETE FROM extraction_cache WHERE hash = ?', evict)
+        db.execute(
+            'UPDATE cache_stats SET value = value + ? WHERE name = ?',
+            (len(evict), 'evictions')
+        )
+
+    if commit:
+        db.commit()
+
+
+def stats(db):
+    counters = dict(
+        (row[0], row[1]) for row in db.execute('SELECT name, value FROM cache_stats')
+    )
+    entries, size = db.execute(
+        'SELECT count(*), coalesce(sum(size), 0) FROM extraction_cache'
+    ).fetchone()
+    counters.update(entries=entries, bytes=size,
+                    max_bytes=current_app.config['EXTRACTION_CACHE_MAX_BYTES'])
+    return counters
+
+
+@bp.route('/stats')
+@login_required
+def stats_view():
+    return jsonify(stats(get_db()))
+
+
+@click.command('cache-stats')
+@with_appcontext
+def cache_stats_command():
+    """Show the extraction cache hit and miss counters."""
+    for name, value in sorted(stats(get_db()).items()):
+        click.echo('{}: {}'.format(name, value))
+
+
+def init_app(app):
+    app.cli.add_command(cache_stats_command)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the document formats that can be uploaded and indexed
+
+Every format has a blocks function that reads a document as a stream of
+paragraphs and tables, which text_processing turns into the headers and
+transcription that are indexed, and the paragraph offsets its passages are
+split at, in one pass, so every format ends up in the same JSON shape. A format is found by the extension of the file name, or by
+sniffing the content of a file whose extension is not known. Plain text and
+Markdown have no signature to sniff, so they are only taken by extension. The module of a
+format is only imported the first time a document of that format is read.
+"""
+
+import importlib
+import os
+import zipfile
+from codecs import getincrementaldecoder
+from collections import OrderedDict
+from io import BytesIO
+
+from searchapp.text_processing import collect
+
+# bytes read from the start of a document to sniff its type
+SNIFF_SIZE = 4096
+
+DOCX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+ODT_MIMETYPE = 'application/vnd.oasis.opendocument.text'
+
+
+class Extractor(object):
+    """A document format, with the 'module:function' path of its blocks
+    function, its file extensions and its MIME types.
+    """
+
+    def __init__(self, name, blocks, extensions, mimetypes):
+        self.name = name
+        self.path = blocks
+        self.extensions = tuple(extensions)
+        self.mimetypes = tuple(mimetypes)
+        self._blocks = None
+
+    def blocks(self, document):
+        if self._blocks is None:
+            module, function = self.path.split(':')
+            self._blocks = getattr(importlib.import_module(module), function)
+        return self._blocks(document)
+
+    def extract(self, document, splitFields=[], starts=None):
+        """Return the (headers, transcription) of a document, and append the
+        offsets of its paragraphs to starts, see collect.
+        """
+        return collect(self.blocks(document), splitFields, starts)
+
+
+EXTRACTORS = OrderedDict()
+_by_extension = {}
+_by_mimetype = {}
+
+
+def register(name, blocks, extensions, mimetypes=()):
+    """Add a format, or replace the one registered under the same name."""
+    extractor = EXTRACTORS[name] = Extractor(name, blocks, extensions, mimetypes)
+    for extension in extractor.extensions:
+        _by_extension[extension] = extractor
+    for mimetype in extractor.mimetypes:
+        _by_mimetype[mimetype] = extractor
+    return extractor
+
+
+register('docx', 'searchapp.docx_processing:blocks', ['.docx'], [DOCX_MIMETYPE])
+register('odt', 'searchapp.odt_processing:blocks', ['.odt'], [ODT_MIMETYPE])
+register('html', 'searchapp.html_processing:blocks', ['.html', '.htm'],
+         ['text/html', 'application/xhtml+xml'])
+register('md', 'searchapp.text_processing:markdown_blocks', ['.md', '.markdown'],
+         ['text/markdown'])
+register('txt', 'searchapp.text_processing:text_blocks', ['.txt'], ['text/plain'])
+
+
+def get(name):
+    """Return the extractor registered under name. Raises KeyError."""
+    return EXTRACTORS[name]
+
+
+def extensions():
+    """The file extensions of every registered format, for accept lists."""
+    return [ext for extractor in EXTRACTORS.values() for ext in extractor.extensions]
+
+
+def sniff(document):
+    """Guess the MIME type of a document from its bytes. DOCX and ODT are
+    told apart by the members of the zip and HTML by its opening markup.
+    Returns None for anything else: source code, CSV or JSON decode as text
+    just as well as a transcript does, so text without a .txt or .md
+    extension is not taken for one.
+    """
+    head = bytes(document[:SNIFF_SIZE])
+
+    if head.startswith(b'PK\x03\x04'):
+        try:
+            with zipfile.ZipFile(BytesIO(document)) as archive:
+                names = set(archive.namelist())
+                if 'mimetype' in names:
+                    return archive.read('mimetype').decode('ascii', 'replace').strip()
+                if 'word/document.xml' in names:
+                    return DOCX_MIMETYPE
+        except zipfile.BadZipFile:
+            return None
+        return 'application/zip'
+
+    if b'\x00' in head:
+        return None
+    try:
+        # the head may end in the middle of a character
+        text = getincrementaldecoder('utf-8')().decode(head, final=False)
+    except UnicodeDecodeError:
+        return None
+    start = text.lstrip('﻿ \t\r\n').lower()
+    if start.startswith('<!doctype html') or start.startswith('<html') or '<html' in start:
+        return 'text/html'
+    return None
+
+
+def find(filename, document=None):
+    """Return the extractor for a file by the extension of its name or, when
+    the extension is not registered and the document is given, by sniffing
+    its content. Returns None when the format is not supported.
+    """
+    extractor = _by_extension.get(os.path.splitext(filename)[1].lower())
+    if extractor is None and document is not None:
+        extractor = _by_mimetype.get(sniff(document))
+    return extractor
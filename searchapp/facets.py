@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for counting the tags, researchers, projects and load dates of the
+indexed documents
+
+The counts are kept in the facet_counts table, updated in the same
+transaction as the entry_headers rows of an entry, which suggest writes when
+a document is extracted and removes when its entry is deleted, so showing the
+facets reads a few rows instead of running a terms aggregation over the
+whole index. Dates are counted by day and rolled up into the months or years
+of the histogram when they are read. Should a count drift from the entries,
+reconcile recounts them from entry_headers; the job workers run it every
+FACETS_RECONCILE_INTERVAL seconds and `flask reconcile-facets` runs it now.
+"""
+
+import time
+
+import click
+from flask import Blueprint, current_app, jsonify, request
+from flask.cli import with_appcontext
+from werkzeug.exceptions import abort
+
+from searchapp import metrics
+from searchapp.auth import login_required
+from searchapp.db import get_db
+
+bp = Blueprint('facets', __name__, url_prefix='/api')
+
+FIELDS = ('tags', 'researcher', 'project')
+DATE_FIELD = 'date'
+
+# length of the YYYY-MM-DD key kept of a date for each histogram interval
+INTERVALS = {'day': 10, 'month': 7, 'year': 4}
+
+# index_state row holding the time of the last reconcile
+RECONCILED = 'facets_reconciled'
+
+
+def count(db, rows, delta):
+    """Add delta to the count of every (field, value, key) row of a faceted
+    field, adding the counts that are new and removing those that drop to
+    zero. Not committed.
+    """
+    for field, value, key in rows:
+        if field not in FIELDS and field != DATE_FIELD:
+            continue
+        updated = db.execute(
+            'UPDATE facet_counts SET count = count + ? WHERE field = ? AND key = ?',
+            (delta, field, key)
+        ).rowcount
+        if not updated and delta > 0:
+            db.execute(
+                'INSERT INTO facet_counts (field, key, value, count) VALUES (?, ?, ?, ?)',
+                (field, key, value, delta)
+            )
+        elif delta < 0:
+            db.execute('DELETE FROM facet_counts WHERE field = ? AND key = ? AND count <= 0',
+                       (field, key))
+
+
+def reconcile(db):
+    """Recount every facet from the entry_headers of the entries that still
+    exist and correct the counts that differ. Returns the number of counts
+    corrected.
+    """
+    fields = FIELDS + (DATE_FIELD,)
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        expected = dict(
+            ((row['field'], row['key']), (row['value'], row['n']))
+            for row in db.execute(
+                'SELECT h.field, h.key, min(h.value) AS value, count(*) AS n'
+                ' FROM entry_headers h JOIN entries e ON e.id = h.entry_id'
+                ' WHERE h.field IN ({}) GROUP BY h.field, h.key'
+                .format(', '.join('?' * len(fields))), fields
+            )
+        )
+        actual = dict(((row['field'], row['key']), row['count'])
+                      for row in db.execute('SELECT field, key, count FROM facet_counts'))
+
+        corrected = 0
+        for field, key in actual:
+            if (field, key) not in expected:
+                db.execute('DELETE FROM facet_counts WHERE field = ? AND key = ?',
+                           (field, key))
+                corrected += 1
+        for (field, key), (value, n) in expected.items():
+            if actual.get((field, key)) != n:
+                db.execute(
+                    'INSERT OR REPLACE INTO facet_counts (field, key, value, count)'
+                    ' VALUES (?, ?, ?, ?)', (field, key, value, n)
+                )
+                corrected += 1
+        db.execute('UPDATE index_state SET value = ? WHERE name = ?',
+                   (int(time.time()), RECONCILED))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    if corrected:
+        metrics.inc('facet_counts_corrected_total', corrected)
+    return corrected
+
+
+def reconcile_due(db):
+    """Reconcile when the last reconcile, by any worker of any process, is
+    older than FACETS_RECONCILE_INTERVAL. Returns the number of counts
+    corrected, or None when it was not due.
+    """
+    interval = current_app.config['FACETS_RECONCILE_INTERVAL']
+    if not interval:
+        return None
+    now = int(time.time())
+    try:
+        # claim this round, the other workers see it as done
+        claimed = db.execute(
+            'UPDATE index_state SET value = ? WHERE name = ? AND value <= ?',
+            (now, RECONCILED, now - interval)
+        ).rowcount == 1
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    if not claimed:
+        return None
+    return reconcile(db)
+
+
+def top(db, field, size):
+    """The size most frequent values of a field as (value, count) pairs."""
+    return [(row['value'], row['count']) for row in db.execute(
+        'SELECT value, count FROM facet_counts WHERE field = ?'
+        ' ORDER BY count DESC, key LIMIT ?', (field, size)
+    )]
+
+
+def histogram(db, interval, date_from='', date_to=''):
+    """Count the documents loaded in every day, month or year between
+    date_from and date_to, YYYY-MM-DD and inclusive, as (key, count) pairs
+    in date order.
+    """
+    length = INTERVALS[interval]
+    query = ('SELECT substr(key, 1, ?) AS bucket, sum(count) AS n FROM facet_counts'
+             ' WHERE field = ?')
+    params = [length, DATE_FIELD]
+    if date_from:
+        query += ' AND key >= ?'
+        params.append(date_from)
+    if date_to:
+        query += ' AND key <= ?'
+        params.append(date_to)
+    query += ' GROUP BY bucket ORDER BY bucket'
+    return [(row['bucket'], row['n']) for row in db.execute(query, params)]
+
+
+@bp.route('/facets')
+@login_required
+def facets():
+    """The most frequent tags, researchers and projects, or those of one
+    field, and the histogram of the load dates.
+    """
+    args = request.args
+    field = args.get('field')
+    if field is not None and field not in FIELDS:
+        abort(400, 'field must be one of {}'.format(', '.join(FIELDS)))
+    interval = args.get('interval', 'month')
+    if interval not in INTERVALS:
+        abort(400, 'interval must be one of day, month, year')
+    try:
+        size = min(max(int(args.get('size', current_app.config['FACETS_SIZE'])), 1),
+                   current_app.config['FACETS_MAX_SIZE'])
+    except ValueError:
+        abort(400, 'size must be an integer')
+
+    db = get_db()
+    return jsonify({
+        'facets': dict(
+            (name, [{'value': value, 'count': n} for value, n in top(db, name, size)])
+            for name in ([field] if field else FIELDS)
+        ),
+        'dates': {
+            'interval': interval,
+            'buckets': [{'key': key, 'count': n} for key, n in histogram(
+                db, interval, args.get('date_from', ''), args.get('date_to', ''))],
+        },
+    })
+
+
+@click.command('reconcile-facets')
+@with_appcontext
+def reconcile_facets_command():
+    """Recount the facets from the entries and correct any drift."""
+    corrected = reconcile(get_db())
+    click.echo('Corrected {} facet counts'.format(corrected))
+
+
+def init_app(app):
+    app.cli.add_command(reconcile_facets_command)
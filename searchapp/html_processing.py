@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Functions for extracting information from HTML documents
+"""
+
+from __future__ import print_function, division
+
+from html.parser import HTMLParser
+
+from searchapp.text_processing import PARAGRAPH, TABLE, open_text
+
+# elements whose start or end ends the paragraph before them
+BLOCK_TAGS = frozenset((
+    'address', 'article', 'aside', 'blockquote', 'body', 'br', 'dd', 'div',
+    'dl', 'dt', 'figcaption', 'figure', 'footer', 'form', 'h1', 'h2', 'h3',
+    'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main', 'nav', 'ol', 'p', 'pre',
+    'section', 'table', 'ul',
+))
+
+# elements of a table nested in a cell, whose text is part of the cell
+CELL_TAGS = frozenset(('tr', 'td', 'th', 'caption'))
+
+# elements whose text is not part of the document
+SKIP_TAGS = frozenset(('head', 'script', 'style', 'template', 'noscript'))
+
+CHUNK_SIZE = 64 * 1024
+
+
+class _BlockParser(HTMLParser):
+    """Collects the paragraphs and tables of an HTML document as blocks,
+    which are taken from the blocks list as the document is fed in. The text
+    of a table nested in a cell is part of that cell.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.blocks = []
+        self._text = []
+        self._skip = 0
+        self._tables = 0
+        self._rows = None
+        self._cells = None
+        self._cell = None
+
+    def _flush(self):
+        if self._text:
+            self.blocks.append((PARAGRAPH, ''.join(self._text)))
+            self._text = []
+
+    def _end_cell(self):
+        if self._cell is not None:
+            self._cells.append(''.join(self._cell))
+            self._cell = None
+
+    def _end_row(self):
+        self._end_cell()
+        if self._cells is not None:
+            self._rows.append(self._cells)
+            self._cells = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self._skip += 1
+        elif tag == 'table':
+            self._tables += 1
+            if self._tables == 1:
+                self._flush()
+                self._rows = []
+            elif self._cell is not None:
+                self._cell.append(' ')
+        elif self._tables == 1 and tag == 'tr':
+            self._end_row()
+            self._cells = []
+        elif self._tables == 1 and tag in ('td', 'th'):
+            self._end_cell()
+            if self._cells is None:
+                self._cells = []
+            self._cell = []
+        elif tag in BLOCK_TAGS or tag in CELL_TAGS:
+            if self._tables:
+                if self._cell is not None:
+                    self._cell.append(' ')
+            elif tag in BLOCK_TAGS:
+                self._flush()
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag in SKIP_TAGS or tag == 'table':
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self._skip = max(self._skip - 1, 0)
+        elif tag == 'table' and self._tables:
+            self._tables -= 1
+            if self._tables == 0:
+                self._end_row()
+                self.blocks.append((TABLE, self._rows))
+                self._rows = None
+        elif self._tables == 1 and tag == 'tr':
+            self._end_row()
+        elif self._tables == 1 and tag in ('td', 'th'):
+            self._end_cell()
+        elif tag in BLOCK_TAGS or tag in CELL_TAGS:
+            if self._tables:
+                if self._cell is not None:
+                    self._cell.append(' ')
+            elif tag in BLOCK_TAGS:
+                self._flush()
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        if self._tables:
+            if self._cell is not None:
+                self._cell.append(data)
+        else:
+            self._text.append(data)
+
+    def close(self):
+        HTMLParser.close(self)
+        if self._tables:
+            self._end_row()
+            self.blocks.append((TABLE, self._rows))
+            self._tables = 0
+        self._flush()
+
+
+def blocks(inputFile):
+    """Yield the paragraphs and tables of an HTML document. Text is split
+    into paragraphs at block level elements such as p, div, li, headings and
+    br; the text of head, script and style is left out. The document is read
+    and parsed in chunks, and blocks are yielded as soon as they are complete.
+
+    Args:
+        inputFile (file): the document to be read, as a path, binary file
+            object or bytes, encoded as UTF-8
+
+    Yields:
+        ('paragraph', text) and ('table', rows) tuples
+    """
+
+    parser = _BlockParser()
+    with open_text(inputFile) as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            parser.feed(chunk)
+            for block in parser.blocks:
+                yield block
+            del parser.blocks[:]
+    parser.close()
+    for block in parser.blocks:
+        yield block
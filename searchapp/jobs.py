@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for queueing uploaded documents and indexing them in the background
+
+Uploads are recorded in the jobs table together with the uploaded document
+and picked up by a pool of worker threads in each app process, so a request
+only has to store the upload. The table doubles as the durable queue: a job
+left extracting by a process that died is handed out again once its lease
+runs out. An extracted document is handed
+to the outbox, and the job stays indexing until the outbox has delivered it.
+"""
+
+import os
+import threading
+import time
+
+import click
+from flask import Blueprint, current_app, jsonify
+from flask.cli import with_appcontext
+from werkzeug.exceptions import abort
+
+from searchapp import (
+    extraction_cache, extractors, facets, metrics, near_duplicates, outbox, suggest
+)
+from searchapp.auth import login_required
+from searchapp.db import get_db
+
+bp = Blueprint('jobs', __name__, url_prefix='/jobs')
+
+# statuses of a job that has not finished yet
+ACTIVE = ('queued', 'extracting', 'indexing')
+
+_workers = []
+_workers_pid = None
+_workers_lock = threading.Lock()
+
+
+class QueueFull(Exception):
+    """Raised by enqueue when JOB_QUEUE_MAX jobs are already waiting."""
+
+
+def queue_depth(db):
+    return db.execute(
+        'SELECT count(*) FROM jobs WHERE status IN (?, ?, ?)', ACTIVE
+    ).fetchone()[0]
+
+
+def enqueue(db, entry_id, document, content_hash=None, claimed=False, format_name='docx'):
+    """Add a job for an entry with the bytes of its uploaded document and
+    format_name, the name of its format in the extractors registry. The
+    insert is not committed, so the caller can commit it together with the
+    entry. With the content hash of the document, the job can reuse a cached
+    extraction.
+
+    A claimed job has already been extracted by the caller, which adds the
+    document to the outbox in the same transaction. It starts out as indexing
+    on its first attempt and does not count against JOB_QUEUE_MAX.
+    """
+    if claimed:
+        return db.execute(
+            'INSERT INTO jobs (entry_id, document, format, content_hash, status, attempts)'
+            ' VALUES (?, ?, ?, ?, ?, 1)',
+            (entry_id, document, format_name, content_hash, 'indexing')
+        ).lastrowid
+
+    limit = current_app.config['JOB_QUEUE_MAX']
+    if limit and queue_depth(db) >= limit:
+        raise QueueFull('Too many uploads are waiting to be indexed, please try again later')
+
+    return db.execute(
+        'INSERT INTO jobs (entry_id, document, format, content_hash) VALUES (?, ?, ?, ?)',
+        (entry_id, document, format_name, content_hash)
+    ).lastrowid
+
+
+def claim(db):
+    """Take the oldest job that is due and mark it as extracting. Jobs that
+    have been extracting for longer than JOB_LEASE seconds are assumed to
+    belong to a dead worker and are handed out again. Indexing jobs are not,
+    their document is safe in the outbox.
+    """
+    lease = '-{} seconds'.format(current_app.config['JOB_LEASE'])
+
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        job = db.execute(
+            'SELECT * FROM jobs'
+            ' WHERE (status = ? AND run_after <= CURRENT_TIMESTAMP)'
+            ' OR (status = ? AND updated <= datetime(\'now\', ?))'
+            ' ORDER BY id LIMIT 1',
+            ('queued', 'extracting', lease)
+        ).fetchone()
+        if job is not None:
+            db.execute(
+                'UPDATE jobs SET status = ?, attempts = attempts + 1,'
+                ' updated = CURRENT_TIMESTAMP WHERE id = ?',
+                ('extracting', job['id'])
+            )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return job
+
+
+def set_status(db, job_id, status, error=None, commit=True):
+    if status in ACTIVE:
+        db.execute(
+            'UPDATE jobs SET status = ?, error = ?, updated = CURRENT_TIMESTAMP'
+            ' WHERE id = ?', (status, error, job_id)
+        )
+    else:
+        # a finished job no longer needs its copy of the document
+        db.execute(
+            'UPDATE jobs SET status = ?, error = ?, document = NULL,'
+            ' updated = CURRENT_TIMESTAMP WHERE id = ?', (status, error, job_id)
+        )
+    if commit:
+        db.commit()
+
+
+def defer(db, job_id, error, attempts):
+    """Queue a failed job again after a delay that doubles with every attempt.
+    The update is not committed.
+    """
+    delay = current_app.config['JOB_RETRY_DELAY'] * 2 ** (attempts - 1)
+    db.execute(
+        'UPDATE jobs SET status = ?, error = ?, updated = CURRENT_TIMESTAMP,'
+        ' run_after = datetime(\'now\', ?) WHERE id = ?',
+        ('queued', error, '+{} seconds'.format(delay), job_id)
+    )
+
+
+def add_passages(json_out, document, format_name, passage_tokens, overlap_tokens):
+    """Set the passage settings of an extraction under 'passage_params', so
+    its passages of at most passage_tokens tokens are split from the
+    transcription at the paragraph offsets under 'paragraph_starts' when it is
+    indexed. Only an extraction cached before the offsets were kept is read
+    again, for them. With passage_tokens 0 passages are turned off.
+    """
+    # earlier versions kept the split passages themselves
+    json_out.pop('passages', None)
+    if not passage_tokens:
+        json_out.pop('passage_params', None)
+        return json_out
+    if 'paragraph_starts' not in json_out:
+        starts = []
+        extractors.get(format_name).extract(document, starts=starts)
+        json_out['paragraph_starts'] = starts
+    json_out['passage_params'] = [passage_tokens, overlap_tokens]
+    return json_out
+
+
+def extract(document, format_name='docx', passage_tokens=0, overlap_tokens=0):
+    """Extract the header fields, transcription and paragraph offsets of a
+    document in one pass with the extractor registered as format_name. Does not need an app
+    context, so it can run in a thread pool.
+    """
+    starts = []
+    json_out, transcription = extractors.get(format_name).extract(document, ['tags'],
+                                                                  starts)
+    json_out['transcription'] = transcription
+    json_out['paragraph_starts'] = starts
+    return add_passages(json_out, document, format_name, passage_tokens, overlap_tokens)
+
+
+def run_job(db, job):
+    """Extract the document of a claimed job, or take the extraction from the
+    cache when the same content has been seen before, and hand it to the
+    outbox. A failed extraction is queued again after an exponentially growing
+    delay until JOB_MAX_ATTEMPTS is reached, then the job is marked failed.
+    Failures to index are retried by the outbox instead.
+    """
+    if db.execute('SELECT id FROM entries WHERE id = ?',
+                  (job['entry_id'],)).fetchone() is None:
+        set_status(db, job['id'], 'cancelled')
+        metrics.inc('jobs_total', outcome='cancelled')
+        return
+
+    config = current_app.config
+    try:
+        key = job['content_hash']
+        json_out = extraction_cache.get(db, key) if key else None
+
+        if json_out is None:
+            with metrics.stage('extract'):
+                json_out = extract(job['document'], job['format'],
+                                   config['PASSAGE_TOKENS'],
+                                   config['PASSAGE_OVERLAP_TOKENS'])
+            if key:
+                extraction_cache.put(db, key, json_out,
+                                     config['EXTRACTION_CACHE_MAX_BYTES'])
+        else:
+            add_passages(json_out, job['document'], job['format'],
+                         config['PASSAGE_TOKENS'], config['PASSAGE_OVERLAP_TOKENS'])
+
+        with metrics.stage('minhash'):
+            signature = near_duplicates.document_signature(json_out)
+
+        # the entry is checked under the write lock, so its delete either
+        # comes after the index operation in the outbox or cancels the job
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if db.execute('SELECT id FROM entries WHERE id = ?',
+                          (job['entry_id'],)).fetchone() is None:
+                set_status(db, job['id'], 'cancelled', commit=False)
+                metrics.inc('jobs_total', outcome='cancelled')
+                db.commit()
+                return
+            outbox.add(db, job['entry_id'], 'index', json_out)
+            suggest.record(db, job['entry_id'], suggest.header_values(json_out))
+            near_duplicates.record(db, job['entry_id'], signature)
+            set_status(db, job['id'], 'indexing', commit=False)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+        current_app.logger.error('Job %s failed: %s', job['id'], error)
+
+        attempts = job['attempts'] + 1
+        if attempts < config['JOB_MAX_ATTEMPTS']:
+            defer(db, job['id'], error, attempts)
+            db.commit()
+            metrics.inc('jobs_total', outcome='retried')
+            return
+
+        set_status(db, job['id'], 'failed', error)
+        metrics.inc('jobs_total', outcome='failed')
+
+    else:
+        outbox.drain(db)
+
+
+def run_pending():
+    """Run due jobs until none are left. Returns the number of jobs run."""
+    db = get_db()
+    count = 0
+    job = claim(db)
+    while job is not None:
+        run_job(db, job)
+        metrics.flush()
+        count += 1
+        job = claim(db)
+    return count
+
+
+def _work(app):
+    while True:
+        try:
+            with app.app_context():
+                count = run_pending()
+                outbox.drain()
+                facets.reconcile_due(get_db())
+            # the snapshot of an idle process catches up with its last requests
+            metrics.flush()
+        except Exception:
+            app.logger.exception('Job worker error')
+            count = 0
+        if not count:
+            time.sleep(app.config['JOB_POLL_INTERVAL'])
+
+
+def start_workers(app):
+    """Start JOB_WORKERS background threads in this process. Threads do not
+    survive a fork, so the pid is checked and a forked gunicorn worker starts
+    its own pool on its first request.
+    """
+    global _workers, _workers_pid
+
+    pid = os.getpid()
+    if _workers_pid == pid:
+        return
+
+    with _workers_lock:
+        if _workers_pid == pid:
+            return
+        _workers = []
+        for n in range(app.config['JOB_WORKERS']):
+            t = threading.Thread(target=_work, args=(app,),
+                                 name='job-worker-{}'.format(n))
+            t.daemon = True
+            t.start()
+            _workers.append(t)
+        _workers_pid = pid
+
+
+@bp.route('/<int:id>')
+@login_required
+def status(id):
+    job = get_db().execute(
+        'SELECT id, entry_id, status, attempts, error, created, updated'
+        ' FROM jobs WHERE id = ?', (id,)
+    ).fetchone()
+
+    if job is None:
+        abort(404, "Job id {0} doesn't exist.".format(id))
+
+    return jsonify(
+        id=job['id'],
+        entry_id=job['entry_id'],
+        status=job['status'],
+        attempts=job['attempts'],
+        error=job['error'],
+        created=str(job['created']),
+        updated=str(job['updated']),
+    )
+
+
+@click.command('run-jobs')
+@with_appcontext
+def run_jobs_command():
+    """Run queued ingestion jobs in the foreground until interrupted."""
+    click.echo('Running jobs, press CTRL+C to quit.')
+    _work(current_app._get_current_object())
+
+
+def init_app(app):
+    app.cli.add_command(run_jobs_command)
+
+    if app.config['JOB_WORKERS'] > 0:
+        @app.before_request
+        def ensure_workers():
+            start_workers(current_app._get_current_object())
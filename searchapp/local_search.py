@@ -0,0 +1,943 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Embedded search engine used as a drop-in alternative to ElasticSearch
+
+Each index is a directory of immutable segments plus a manifest. A segment
+holds the stored documents, a term dictionary and a postings file; the
+documents and postings are memory-mapped for querying, so only the term
+dictionaries are kept on the heap. New documents are written as new segments,
+deletes are recorded as tombstones in the manifest, and small segments are
+merged into larger ones as they accumulate. Queries are scored with BM25.
+
+Like ElasticSearch, match queries are run against the tokens of a field and
+term queries against its whole values, each of the values of a list, which
+are lowercased first for the fields the index mapping gives a normalizer.
+
+Writers in different processes are serialized with a lock file and readers
+pick up a new manifest on their next query, so every gunicorn worker can use
+the same directory.
+"""
+
+from __future__ import print_function, division
+
+import fcntl
+import fnmatch
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import threading
+from array import array
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# BM25 parameters, the same defaults as Lucene
+K1 = 1.2
+B = 0.75
+
+# number of segments of a similar size that are merged into one
+MERGE_FACTOR = 10
+
+# values of at most this many characters are kept in the term dictionary so
+# range filters do not have to load the stored document, and are matched by
+# term queries, like the ignore_above of a keyword field
+STORED_VALUE_MAX = 256
+
+MANIFEST = 'manifest.json'
+
+# alias name: index name, kept next to the index directories
+ALIASES = 'aliases.json'
+
+# template name: index template, applied to indices created without a mapping
+TEMPLATES = 'templates.json'
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def _field_text(value):
+    if isinstance(value, (list, tuple)):
+        return ' '.join(_field_text(v) for v in value)
+    return str(value)
+
+
+def _keyword(value):
+    """The exact string a term query compares a single value with."""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def normalized_fields(mapping):
+    """The fields of an index mapping, with or without a document type
+    level, that have a normalizer.
+    """
+    if not mapping:
+        return set()
+    properties = mapping.get('properties')
+    if properties is None and len(mapping) == 1:
+        properties = list(mapping.values())[0].get('properties')
+    return set(field for field, spec in (properties or {}).items()
+               if isinstance(spec, dict) and spec.get('normalizer'))
+
+
+class LocalIndexMissing(KeyError):
+    """Raised when a query or delete names an index that was never created."""
+
+
+class LocalDocumentMissing(KeyError):
+    """Raised when a delete names a document that is not in the index."""
+
+
+class Segment(object):
+    """Read-only view of one segment on disk."""
+
+    def __init__(self, path, name):
+        self.name = name
+        base = os.path.join(path, name)
+
+        with open(base + '.dict') as f:
+            meta = json.load(f)
+        self.ids = meta['ids']
+        self.offsets = meta['offsets']
+        self.lengths = meta['lengths']
+        self.values = meta['values']
+        self.terms = meta['terms']
+        self.normalized = set(meta.get('normalized', ()))
+        if 'keywords' in meta:
+            self.keywords = meta['keywords']
+        else:
+            # segments written before keywords were kept: the short values
+            self.keywords = {}
+            for field, values in self.values.items():
+                for docnum, value in values.items():
+                    for item in (value if isinstance(value, list) else [value]):
+                        self.keywords.setdefault(field, {}).setdefault(
+                            _keyword(item), []).append(int(docnum))
+        self.field_sums = dict((field, sum(lengths))
+                               for field, lengths in self.lengths.items())
+
+        self._files = []
+        self.post = self._map(base + '.post')
+        self.docs = self._map(base + '.docs')
+
+    def _map(self, filename):
+        f = open(filename, 'rb')
+        self._files.append(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def postings(self, field, term):
+        """Return the (docnum, term frequency) pairs of a term as a flat
+        sequence, straight from the mapped postings file.
+        """
+        entry = self.terms.get(field, {}).get(term)
+        if entry is None:
+            return ()
+        offset, df = entry
+        return memoryview(self.post)[offset:offset + df * 8].cast('I')
+
+    def df(self, field, term):
+        entry = self.terms.get(field, {}).get(term)
+        return 0 if entry is None else entry[1]
+
+    def keyword(self, field, value):
+        """Return the docnums of the documents having value as a whole value
+        of field, or of the field it is the keyword subfield of.
+        """
+        if field.endswith('.keyword'):
+            field = field[:-len('.keyword')]
+        value = _keyword(value)
+        if field in self.normalized:
+            value = value.lower()
+        return self.keywords.get(field, {}).get(value, ())
+
+    def source(self, docnum):
+        start, end = self.offsets[docnum], self.offsets[docnum + 1]
+        return json.loads(self.docs[start:end].decode('utf-8'))
+
+    def close(self):
+        for m in (self.post, self.docs):
+            if isinstance(m, mmap.mmap):
+                try:
+                    m.close()
+                except BufferError:
+                    # still referenced by a postings view, freed with it
+                    pass
+        for f in self._files:
+            f.close()
+
+
+def write_segment(path, name, docs, normalized=()):
+    """Write a list of (docID, source) pairs as a new segment. The whole
+    values of the normalized fields are lowercased for term queries.
+    """
+
+    base = os.path.join(path, name)
+    ids = []
+    offsets = [0]
+    lengths = {}
+    values = {}
+    keywords = {}
+    postings = defaultdict(lambda: defaultdict(list))
+
+    with open(base + '.docs', 'wb') as f:
+        for docnum, (docID, source) in enumerate(docs):
+            data = json.dumps(source, separators=(',', ':')).encode('utf-8')
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+            ids.append(docID)
+
+            for field, value in source.items():
+                if value is None or isinstance(value, dict):
+                    continue
+                text = _field_text(value)
+                if len(text) <= STORED_VALUE_MAX:
+                    values.setdefault(field, {})[str(docnum)] = value
+                for item in (value if isinstance(value, (list, tuple)) else [value]):
+                    item = _keyword(item)
+                    if field in normalized:
+                        item = item.lower()
+                    if len(item) <= STORED_VALUE_MAX:
+                        matching = keywords.setdefault(field, {}).setdefault(item, [])
+                        if not matching or matching[-1] != docnum:
+                            matching.append(docnum)
+                tokens = tokenize(text)
+                lengths.setdefault(field, [0] * len(docs))[docnum] = len(tokens)
+                for term, tf in Counter(tokens).items():
+                    postings[field][term].extend((docnum, tf))
+
+    post = array('I')
+    terms = {}
+    for field, fieldPostings in postings.items():
+        terms[field] = {}
+        for term in sorted(fieldPostings):
+            pairs = fieldPostings[term]
+            terms[field][term] = [len(post) * post.itemsize, len(pairs) // 2]
+            post.extend(pairs)
+
+    with open(base + '.post', 'wb') as f:
+        post.tofile(f)
+
+    with open(base + '.dict', 'w') as f:
+        json.dump({'ids': ids, 'offsets': offsets, 'lengths': lengths,
+                   'values': values, 'terms': terms, 'keywords': keywords,
+                   'normalized': sorted(normalized)}, f, separators=(',', ':'))
+
+
+def _remove_segment_files(path, name):
+    for ext in ('.dict', '.post', '.docs'):
+        try:
+            os.remove(os.path.join(path, name + ext))
+        except OSError:
+            pass
+
+
+def _write_manifest(path, manifest):
+    tmp = os.path.join(path, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(path, MANIFEST))
+
+
+class SegmentIndex(object):
+    """One index: a directory of segments and the manifest listing them."""
+
+    def __init__(self, path):
+        self.path = path
+        self.segments = []
+        self.deleted = {}
+        self.locations = {}
+        self._manifest_key = None
+        self._lock = threading.RLock()
+
+    def normalized(self):
+        """The fields the mapping the index was created with normalizes."""
+        try:
+            with open(os.path.join(self.path, 'mapping.json')) as f:
+                return normalized_fields(json.load(f))
+        except (IOError, OSError, ValueError):
+            return set()
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST)) as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return {'segments': [], 'next': 0}
+
+    def refresh(self):
+        """Reload the manifest if another writer has replaced it."""
+        try:
+            st = os.stat(os.path.join(self.path, MANIFEST))
+            key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            key = None
+
+        with self._lock:
+            if key == self._manifest_key:
+                return
+
+            # a merge in another process can remove the files of a segment
+            # between reading the manifest and opening them, so read again
+            for attempt in range(3):
+                manifest = self._read_manifest()
+                current = dict((s.name, s) for s in self.segments)
+                try:
+                    segments = [current[info['name']] if info['name'] in current
+                                else Segment(self.path, info['name'])
+                                for info in manifest['segments']]
+                    break
+                except (IOError, OSError):
+                    if attempt == 2:
+                        raise
+
+            # dropped segments are not closed here, a query in another thread
+            # may still be reading them; their maps are released with them
+
+            self.segments = segments
+            self.deleted = dict((info['name'], set(info['deleted']))
+                                for info in manifest['segments'])
+            self.locations = {}
+            for seg in segments:
+                deleted = self.deleted[seg.name]
+                for docnum, docID in enumerate(seg.ids):
+                    if docnum not in deleted:
+                        self.locations[docID] = (seg.name, docnum)
+            self._manifest_key = key
+
+    @contextmanager
+    def _writing(self):
+        """Hold the index lock, yield the current manifest for changes and
+        write it back. Files listed in the yielded 'obsolete' list are removed
+        once the new manifest is in place.
+        """
+        with self._lock:
+            with open(os.path.join(self.path, 'lock'), 'a') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                try:
+                    self._manifest_key = None
+                    self.refresh()
+                    manifest = self._read_manifest()
+                    obsolete = []
+                    yield manifest, obsolete
+                    _write_manifest(self.path, manifest)
+                    self.refresh()
+                    for name in obsolete:
+                        _remove_segment_files(self.path, name)
+                finally:
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _tombstone(self, manifest, docID):
+        location = self.locations.pop(docID, None)
+        if location is None:
+            return False
+        name, docnum = location
+        for info in manifest['segments']:
+            if info['name'] == name:
+                info['deleted'].append(docnum)
+        return True
+
+    def add(self, docs):
+        """Index a list of (docID, source) pairs as one new segment, replacing
+        earlier versions of the same documents.
+        """
+        latest = {}
+        for docID, source in docs:
+            latest[str(docID)] = source
+        if not latest:
+            return
+
+        with self._writing() as (manifest, obsolete):
+            for docID in latest:
+                self._tombstone(manifest, docID)
+
+            name = 'seg_{:08d}'.format(manifest['next'])
+            manifest['next'] += 1
+            write_segment(self.path, name, list(latest.items()), self.normalized())
+            manifest['segments'].append(
+                {'name': name, 'docs': len(latest), 'deleted': []})
+
+            self._merge_tiers(manifest, obsolete)
+
+    def remove(self, docIDs):
+        """Delete documents by id and return the ids that were found."""
+        with self._writing() as (manifest, obsolete):
+            found = [str(docID) for docID in docIDs
+                     if self._tombstone(manifest, str(docID))]
+            # segments with nothing left in them are dropped right away
+            for info in list(manifest['segments']):
+                if len(info['deleted']) >= info['docs']:
+                    manifest['segments'].remove(info)
+                    obsolete.append(info['name'])
+        return found
+
+    def _live_docs(self, info):
+        seg = Segment(self.path, info['name'])
+        try:
+            deleted = set(info['deleted'])
+            return [(seg.ids[docnum], seg.source(docnum))
+                    for docnum in range(len(seg)) if docnum not in deleted]
+        finally:
+            seg.close()
+
+    def _merge(self, manifest, obsolete, group):
+        docs = []
+        for info in group:
+            docs.extend(self._live_docs(info))
+
+        name = 'seg_{:08d}'.format(manifest['next'])
+        manifest['next'] += 1
+        write_segment(self.path, name, docs, self.normalized())
+
+        position = manifest['segments'].index(group[0])
+        for info in group:
+            manifest['segments'].remove(info)
+            obsolete.append(info['name'])
+        manifest['segments'].insert(position,
+                                    {'name': name, 'docs': len(docs), 'deleted': []})
+
+    def _merge_tiers(self, manifest, obsolete):
+        """Merge MERGE_FACTOR segments of the same size tier, where a tier
+        spans a factor of MERGE_FACTOR in live documents, until no tier is
+        full. Each merge also drops the deleted documents of its segments.
+        """
+        while True:
+            tiers = defaultdict(list)
+            for info in manifest['segments']:
+                live = max(info['docs'] - len(info['deleted']), 1)
+                tiers[int(math.log(live, MERGE_FACTOR))].append(info)
+            full = [group for group in tiers.values() if len(group) >= MERGE_FACTOR]
+            if not full:
+                return
+            self._merge(manifest, obsolete, full[0][:MERGE_FACTOR])
+
+    def force_merge(self, maxSegments=1):
+        """Merge the index down to at most maxSegments segments."""
+        with self._writing() as (manifest, obsolete):
+            while len(manifest['segments']) > maxSegments:
+                count = len(manifest['segments']) - maxSegments + 1
+                group = sorted(manifest['segments'],
+                               key=lambda info: info['docs'])[:count]
+                self._merge(manifest, obsolete, group)
+
+    def count(self):
+        self.refresh()
+        return len(self.locations)
+
+    def get(self, docID):
+        """Return the source of a document, or None if it is not indexed."""
+        self.refresh()
+        with self._lock:
+            location = self.locations.get(str(docID))
+            segments = dict((seg.name, seg) for seg in self.segments)
+        if location is None:
+            return None
+        name, docnum = location
+        return segments[name].source(docnum)
+
+    def scan(self, source=True):
+        """Yield (docID, source) for every live document in the segments that
+        are current when the scan starts. Without source, only the ids are
+        read and the sources are empty.
+        """
+        self.refresh()
+        with self._lock:
+            segments = list(self.segments)
+            deleted = dict(self.deleted)
+        for seg in segments:
+            dead = deleted.get(seg.name, ())
+            for docnum, docID in enumerate(seg.ids):
+                if docnum not in dead:
+                    yield docID, seg.source(docnum) if source else {}
+
+    def search(self, body):
+        """Run an ElasticSearch style query body and return a response shaped
+        like ElasticSearch's. Supports match_all, match, multi_match, term,
+        terms, range and bool queries, from/size paging, _source includes and
+        excludes, and highlighting.
+        """
+        self.refresh()
+        with self._lock:
+            segments = list(self.segments)
+            deleted = dict(self.deleted)
+
+        query = body.get('query', {'match_all': {}})
+        stats = _Stats(segments)
+
+        results = []
+        for segOrder, seg in enumerate(segments):
+            scores = _evaluate(query, seg, stats)
+            dead = deleted.get(seg.name, ())
+            for docnum, score in scores.items():
+                if docnum not in dead:
+                    results.append((-score, segOrder, docnum))
+        results.sort()
+
+        start = int(body.get('from', 0))
+        size = int(body.get('size', 10))
+        sourceFilter = body.get('_source', True)
+        highlight = body.get('highlight', {}).get('fields', {})
+        highlightTerms = _query_terms(query) if highlight else {}
+
+        hits = []
+        for negScore, segOrder, docnum in results[start:start + size]:
+            seg = segments[segOrder]
+            source = seg.source(docnum)
+            hit = {'_id': seg.ids[docnum], '_score': -negScore}
+            if highlight:
+                fragments = {}
+                for field in highlight:
+                    found = _highlight(source.get(field), highlightTerms.get(field, ()))
+                    if found:
+                        fragments[field] = found
+                if fragments:
+                    hit['highlight'] = fragments
+            hit['_source'] = _filter_source(source, sourceFilter)
+            hits.append(hit)
+
+        return {'hits': {
+            'total': len(results),
+            'max_score': -results[0][0] if results else None,
+            'hits': hits,
+        }}
+
+
+class _Stats(object):
+    """Collection wide statistics for BM25, computed over all segments."""
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.docs = sum(len(seg) for seg in segments) or 1
+        self._avgdl = {}
+
+    def avgdl(self, field):
+        if field not in self._avgdl:
+            total = sum(seg.field_sums.get(field, 0) for seg in self.segments)
+            self._avgdl[field] = (total / self.docs) or 1.0
+        return self._avgdl[field]
+
+    def idf(self, field, term):
+        df = sum(seg.df(field, term) for seg in self.segments)
+        return math.log(1 + (self.docs - df + 0.5) / (df + 0.5))
+
+
+def _match_params(spec):
+    field, value = list(spec.items())[0]
+    if isinstance(value, dict):
+        return field, str(value.get('query', '')), value.get('operator', 'or').lower()
+    return field, str(value), 'or'
+
+
+def _score_terms(seg, stats, field, terms, operator):
+    scores = defaultdict(float)
+    matched = defaultdict(int)
+    lengths = seg.lengths.get(field)
+    if lengths is None:
+        return {}
+    avgdl = stats.avgdl(field)
+
+    for term in terms:
+        postings = seg.postings(field, term)
+        if not len(postings):
+            continue
+        idf = stats.idf(field, term)
+        for i in range(0, len(postings), 2):
+            docnum, tf = postings[i], postings[i + 1]
+            norm = K1 * (1 - B + B * lengths[docnum] / avgdl)
+            scores[docnum] += idf * tf * (K1 + 1) / (tf + norm)
+            matched[docnum] += 1
+
+    if operator == 'and':
+        return dict((d, s) for d, s in scores.items() if matched[d] == len(terms))
+    return dict(scores)
+
+
+def _all_docs(seg):
+    return dict.fromkeys(range(len(seg)), 1.0)
+
+
+def _compare(value, bounds):
+    for op, bound in bounds.items():
+        try:
+            left, right = float(value), float(bound)
+        except (TypeError, ValueError):
+            left, right = str(value), str(bound)
+        if op == 'gte' and not left >= right:
+            return False
+        if op == 'gt' and not left > right:
+            return False
+        if op == 'lte' and not left <= right:
+            return False
+        if op == 'lt' and not left < right:
+            return False
+    return True
+
+
+def _evaluate(query, seg, stats):
+    """Return {docnum: score} for the documents of a segment matching query."""
+
+    kind, spec = list(query.items())[0]
+
+    if kind == 'match_all':
+        return _all_docs(seg)
+
+    if kind == 'match':
+        field, text, operator = _match_params(spec)
+        return _score_terms(seg, stats, field, sorted(set(tokenize(text))), operator)
+
+    if kind == 'multi_match':
+        terms = sorted(set(tokenize(str(spec.get('query', '')))))
+        operator = spec.get('operator', 'or').lower()
+        best = {}
+        for field in spec.get('fields', []):
+            field = field.split('^')[0]
+            for docnum, score in _score_terms(seg, stats, field, terms, operator).items():
+                best[docnum] = max(score, best.get(docnum, 0.0))
+        return best
+
+    if kind in ('term', 'terms'):
+        field, wanted = list(spec.items())[0]
+        if not isinstance(wanted, (list, tuple)):
+            wanted = [wanted]
+        found = {}
+        for value in wanted:
+            for docnum in seg.keyword(field, value):
+                found[docnum] = 1.0
+        return found
+
+    if kind == 'range':
+        field, bounds = list(spec.items())[0]
+        bounds = dict((k, v) for k, v in bounds.items() if k in ('gte', 'gt', 'lte', 'lt'))
+        values = seg.values.get(field, {})
+        return dict((int(docnum), 1.0) for docnum, value in values.items()
+                    if _compare(value, bounds))
+
+    if kind == 'exists':
+        lengths = seg.lengths.get(spec['field'], [])
+        return dict((docnum, 1.0) for docnum, n in enumerate(lengths) if n)
+
+    if kind == 'bool':
+        def clauses(name):
+            c = spec.get(name, [])
+            return c if isinstance(c, list) else [c]
+
+        must = clauses('must')
+        filters = clauses('filter')
+        should = clauses('should')
+
+        if must:
+            scores = None
+            for clause in must:
+                docs = _evaluate(clause, seg, stats)
+                if scores is None:
+                    scores = dict(docs)
+                else:
+                    scores = dict((d, s + docs[d]) for d, s in scores.items() if d in docs)
+        elif should and not filters:
+            scores = {}
+        else:
+            scores = dict.fromkeys(range(len(seg)), 0.0 if filters and not should else 1.0)
+
+        for clause in filters:
+            docs = _evaluate(clause, seg, stats)
+            scores = dict((d, s) for d, s in scores.items() if d in docs)
+
+        if should:
+            for clause in should:
+                for d, s in _evaluate(clause, seg, stats).items():
+                    if d in scores:
+                        scores[d] += s
+                    elif not must and not filters:
+                        scores[d] = s
+
+        for clause in clauses('must_not'):
+            docs = _evaluate(clause, seg, stats)
+            scores = dict((d, s) for d, s in scores.items() if d not in docs)
+
+        return scores
+
+    raise ValueError('Unsupported query type for the local backend: {}'.format(kind))
+
+
+def _query_terms(query, found=None):
+    """Collect the scored terms of a query by field, for highlighting."""
+    if found is None:
+        found = defaultdict(set)
+    kind, spec = list(query.items())[0]
+    if kind == 'match':
+        field, text, operator = _match_params(spec)
+        found[field].update(tokenize(text))
+    elif kind == 'multi_match':
+        for field in spec.get('fields', []):
+            found[field.split('^')[0]].update(tokenize(str(spec.get('query', ''))))
+    elif kind == 'bool':
+        for name in ('must', 'should'):
+            clauses = spec.get(name, [])
+            for clause in clauses if isinstance(clauses, list) else [clauses]:
+                _query_terms(clause, found)
+    return found
+
+
+def _highlight(value, terms, fragmentSize=100, fragments=5):
+    if not value or not terms:
+        return []
+    text = _field_text(value)
+    found = []
+    end = -1
+    for m in TOKEN_RE.finditer(text):
+        if m.group(0).lower() not in terms or m.start() < end:
+            continue
+        start = max(m.start() - fragmentSize // 2, 0)
+        space = text.find(' ', start)
+        if start and 0 <= space < m.start():
+            start = space + 1
+        end = min(start + fragmentSize, len(text))
+        fragment = text[start:end]
+        for t in terms:
+            fragment = re.sub(r'(?i)\b({})\b'.format(re.escape(t)), r'<em>\1</em>', fragment)
+        found.append(fragment)
+        if len(found) >= fragments:
+            break
+    return found
+
+
+def _filter_source(source, sourceFilter):
+    if sourceFilter is True:
+        return source
+    if sourceFilter is False:
+        return {}
+    if isinstance(sourceFilter, (list, str)):
+        sourceFilter = {'includes': sourceFilter}
+    includes = sourceFilter.get('includes')
+    excludes = sourceFilter.get('excludes', [])
+    if isinstance(includes, str):
+        includes = [includes]
+    if isinstance(excludes, str):
+        excludes = [excludes]
+    return dict((k, v) for k, v in source.items()
+                if (not includes or k in includes) and k not in excludes)
+
+
+class LocalBackend(object):
+    """Search backend that keeps every index as a SegmentIndex below one
+    directory. It implements the same operations as the ElasticSearch backend
+    of ElasticLoader; document types, refresh options, index settings and
+    routing keys are accepted and ignored, since writes are visible as soon as
+    they return and every index is a single shard.
+    Aliases are kept in one file that every process rereads when it changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._indices = {}
+        self._lock = threading.Lock()
+        self._alias_state = (None, {})
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _aliases(self):
+        path = os.path.join(self.path, ALIASES)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return {}
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if self._alias_state[0] != key:
+            with open(path) as f:
+                self._alias_state = (key, json.load(f))
+        return self._alias_state[1]
+
+    @contextmanager
+    def _changing_aliases(self):
+        """Hold the alias lock and yield the alias map for changes, which is
+        written back atomically.
+        """
+        with open(os.path.join(self.path, 'aliases.lock'), 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                aliases = dict(self._aliases())
+                yield aliases
+                tmp = os.path.join(self.path, ALIASES + '.tmp')
+                with open(tmp, 'w') as f:
+                    json.dump(aliases, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, os.path.join(self.path, ALIASES))
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _index(self, idxName, create=False):
+        idxName = self._aliases().get(idxName, idxName)
+        with self._lock:
+            index = self._indices.get(idxName)
+            if index is None:
+                path = os.path.join(self.path, idxName)
+                if not os.path.isdir(path):
+                    if not create:
+                        raise LocalIndexMissing(idxName)
+                    os.makedirs(path)
+                index = self._indices[idxName] = SegmentIndex(path)
+            return index
+
+    def put_template(self, name, template):
+        path = os.path.join(self.path, TEMPLATES)
+        templates = self._templates()
+        templates[name] = template
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(templates, f)
+        os.replace(tmp, path)
+
+    def _templates(self):
+        try:
+            with open(os.path.join(self.path, TEMPLATES)) as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return {}
+
+    def create_index(self, idxName, mapping=None, aliases=()):
+        if mapping is None:
+            # the mappings of the template whose pattern matches the name
+            for template in self._templates().values():
+                if any(fnmatch.fnmatchcase(idxName, pattern)
+                       for pattern in template['index_patterns']):
+                    mapping = template.get('mappings')
+        self._index(idxName, create=True)
+        path = os.path.join(self.path, idxName, 'mapping.json')
+        if not os.path.exists(path):
+            with open(path, 'w') as f:
+                json.dump(mapping, f)
+        if any(alias not in self._aliases() for alias in aliases):
+            with self._changing_aliases() as current:
+                for alias in aliases:
+                    current.setdefault(alias, idxName)
+
+    def exists(self, name):
+        return (name in self._aliases()
+                or os.path.isdir(os.path.join(self.path, name)))
+
+    def get_alias(self, alias):
+        current = self._aliases().get(alias)
+        return [current] if current else []
+
+    def swap_alias(self, alias, newIndex):
+        # like ElasticSearch, an index with the alias's name is deleted
+        legacy = (alias not in self._aliases()
+                  and os.path.isdir(os.path.join(self.path, alias)))
+        with self._changing_aliases() as current:
+            current[alias] = newIndex
+        if legacy:
+            self._drop(alias)
+
+    def get(self, idxName, docID, docType, routing=None):
+        return self._index(idxName).get(docID)
+
+    def scan(self, idxName, source=True, chunkSize=500):
+        return self._index(idxName).scan(source)
+
+    def count(self, idxName):
+        return self._index(idxName).count()
+
+    def get_settings(self, idxName):
+        return {}
+
+    def put_settings(self, idxName, settings):
+        pass
+
+    def refresh(self, idxName):
+        self._index(idxName).refresh()
+
+    def forcemerge(self, idxName, maxSegments=1):
+        self._index(idxName).force_merge(maxSegments)
+
+    def insert(self, idxName, docID, docType, body, refresh=False, routing=None):
+        self._index(idxName, create=True).add([(docID, body)])
+
+    def delete(self, idxName, docID, docType, refresh=False, routing=None):
+        if not self._index(idxName).remove([docID]):
+            raise LocalDocumentMissing(docID)
+
+    def delete_by_query(self, idxName, query):
+        index = self._index(idxName)
+        hits = index.search({'query': query, 'size': index.count(),
+                             '_source': False})['hits']['hits']
+        index.remove([hit['_id'] for hit in hits])
+
+    def bulk(self, actions, chunkSize=500, threadCount=1, queueSize=4,
+             refresh=False):
+        chunk = []
+        for action in actions:
+            chunk.append(action)
+            if len(chunk) >= chunkSize:
+                for result in self._bulk_chunk(chunk):
+                    yield result
+                chunk = []
+        for result in self._bulk_chunk(chunk):
+            yield result
+
+    def _bulk_chunk(self, chunk):
+        results = []
+        byIndex = defaultdict(lambda: ([], []))
+        for action in chunk:
+            op = action.get('_op_type', 'index')
+            docID = str(action['_id'])
+            if op == 'delete':
+                byIndex[action['_index']][1].append(docID)
+            else:
+                byIndex[action['_index']][0].append((docID, action['_source']))
+
+        for idxName, (docs, deletes) in byIndex.items():
+            try:
+                index = self._index(idxName, create=bool(docs))
+                index.add(docs)
+                removed = set(index.remove(deletes)) if deletes else set()
+            except Exception as e:
+                error = '{}: {}'.format(type(e).__name__, e)
+                for docID, source in docs:
+                    results.append((False, {'index': {'_index': idxName, '_id': docID,
+                                                      'status': 500, 'error': error}}))
+                for docID in deletes:
+                    results.append((False, {'delete': {'_index': idxName, '_id': docID,
+                                                       'status': 500, 'error': error}}))
+                continue
+
+            for docID, source in docs:
+                results.append((True, {'index': {'_index': idxName, '_id': docID,
+                                                 'status': 201}}))
+            for docID in deletes:
+                ok = docID in removed
+                results.append((ok, {'delete': {'_index': idxName, '_id': docID,
+                                                'status': 200 if ok else 404}}))
+        return results
+
+    def search(self, idxName, body, routing=None):
+        return self._index(idxName).search(body or {})
+
+    def delete_index(self, idxName):
+        if any(index == idxName for index in self._aliases().values()):
+            with self._changing_aliases() as current:
+                for alias, index in list(current.items()):
+                    if index == idxName:
+                        del current[alias]
+        self._drop(idxName)
+
+    def _drop(self, idxName):
+        with self._lock:
+            index = self._indices.pop(idxName, None)
+            if index is not None:
+                for seg in index.segments:
+                    seg.close()
+        shutil.rmtree(os.path.join(self.path, idxName), ignore_errors=True)
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for recording timings and counters and serving them to Prometheus
+
+Every process keeps its own counters and histograms in memory and writes a
+snapshot of them to METRICS_DIR after a request or background job, at most
+once every METRICS_FLUSH_INTERVAL seconds. The job worker threads also write
+it while the process is idle. /metrics adds up the snapshots of all
+processes, so a scrape that lands on any gunicorn worker sees the totals of
+all of them. Snapshots of processes that have exited are folded into an
+archive file so their counts are not lost, under a lock on LOCK_FILE so that
+two scrapes never fold the same snapshot.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, request
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the app runs as a single process
+    fcntl = None
+
+from searchapp.db import get_db
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+ARCHIVE = 'metrics-archive.json'
+LOCK_FILE = 'metrics.lock'
+
+# name: (type, help) of every metric that is recorded
+METRICS = {
+    'http_requests_total': ('counter', 'HTTP requests by endpoint, method and status.'),
+    'http_request_duration_seconds': ('histogram', 'HTTP request duration by endpoint.'),
+    'stage_duration_seconds': ('histogram', 'Duration of each upload, indexing and delete stage.'),
+    'es_errors_total': ('counter', 'Failed ElasticSearch writes by operation and error type.'),
+    'es_retries_total': ('counter', 'ElasticSearch writes retried after a retryable error, by operation.'),
+    'es_breaker_opened_total': ('counter', 'Times the circuit breaker of the writes opened.'),
+    'es_breaker_rejected_total': ('counter', 'Writes failed at once while the circuit breaker was open.'),
+    'jobs_total': ('counter', 'Finished ingestion jobs by outcome.'),
+    'search_cache_requests_total': ('counter', 'Search result cache lookups by result.'),
+    'outbox_operations_total': ('counter', 'Outbox operations sent to the search backend by op and outcome.'),
+    'outbox_delivery_lag_seconds': ('histogram', 'Time from writing an outbox operation to its delivery.'),
+    'facet_counts_corrected_total': ('counter', 'Facet counts found wrong and corrected by the reconcile.'),
+}
+
+_lock = threading.Lock()
+# held while a snapshot is taken and written, so they are written in order
+_flush_lock = threading.Lock()
+_flushed = 0.0
+_interval = 0
+_counters = {}
+_histograms = {}
+_dirty = False
+_pid = None
+_path = None
+
+
+def configure(path, interval=0):
+    """Set the directory snapshots are written to, None to keep metrics in
+    this process only, and the least number of seconds between two
+    snapshots.
+    """
+    global _path, _interval
+
+    if path and not os.path.isdir(path):
+        os.makedirs(path)
+    _path = path
+    _interval = interval
+
+
+def _key(name, labels):
+    return name + json.dumps(sorted(labels.items()), separators=(',', ':'))
+
+
+def _check_pid():
+    """Start from zero in a forked child, the parent reports its own counts."""
+    global _pid, _dirty
+
+    if _pid != os.getpid():
+        _counters.clear()
+        _histograms.clear()
+        _dirty = False
+        _pid = os.getpid()
+
+
+def inc(name, amount=1, **labels):
+    global _dirty
+
+    key = _key(name, labels)
+    with _lock:
+        _check_pid()
+        _counters[key] = _counters.get(key, 0) + amount
+        _dirty = True
+
+
+def observe(name, value, **labels):
+    global _dirty
+
+    key = _key(name, labels)
+    with _lock:
+        _check_pid()
+        hist = _histograms.get(key)
+        if hist is None:
+            # one count per bucket, then +Inf, sum and count
+            hist = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                hist[i] += 1
+                break
+        else:
+            hist[len(BUCKETS)] += 1
+        hist[-2] += value
+        hist[-1] += 1
+        _dirty = True
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe the time spent in the with block, also when it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def stage(name):
+    return timer('stage_duration_seconds', stage=name)
+
+
+def _snapshot_path(pid):
+    return os.path.join(_path, 'metrics-{}.json'.format(pid))
+
+
+def _write(path, snapshot):
+    # a temporary file of its own, so concurrent writers never share one
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.metrics-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def flush(force=False):
+    """Write this process's snapshot if anything changed since the last one
+    and, unless forced, that was at least METRICS_FLUSH_INTERVAL ago.
+    """
+    global _dirty, _flushed
+
+    if _path is None:
+        return
+    now = time.monotonic()
+    if not force and now - _flushed < _interval:
+        return
+    with _flush_lock:
+        with _lock:
+            _check_pid()
+            if not _dirty:
+                return
+            snapshot = {'counters': dict(_counters),
+                        'histograms': dict((k, list(v)) for k, v in _histograms.items())}
+            _dirty = False
+        _write(_snapshot_path(os.getpid()), snapshot)
+        _flushed = now
+
+
+def _merge(total, snapshot):
+    for key, value in snapshot.get('counters', {}).items():
+        total['counters'][key] = total['counters'].get(key, 0) + value
+    for key, hist in snapshot.get('histograms', {}).items():
+        current = total['histograms'].get(key)
+        if current is None:
+            total['histograms'][key] = list(hist)
+        else:
+            total['histograms'][key] = [a + b for a, b in zip(current, hist)]
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+@contextmanager
+def _archive_lock():
+    """Hold an exclusive lock on LOCK_FILE in METRICS_DIR, shared by every
+    process and thread.
+    """
+    with open(os.path.join(_path, LOCK_FILE), 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read(path):
+    """The snapshot in path, or None when it is gone or not written yet."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _fold(dead):
+    """Merge the snapshots of exited processes at the paths in dead into the
+    archive and remove them. Returns the archive.
+    """
+    archivePath = os.path.join(_path, ARCHIVE)
+    with _archive_lock():
+        archive = _read(archivePath) or {'counters': {}, 'histograms': {}}
+        # another scrape may have folded some of them since they were listed
+        folded = []
+        for path in dead:
+            snapshot = _read(path)
+            if snapshot is not None:
+                _merge(archive, snapshot)
+                folded.append(path)
+        if folded:
+            _write(archivePath, archive)
+            for path in folded:
+                os.remove(path)
+    return archive
+
+
+def collect():
+    """Add up the snapshots of every process that has written one. Snapshots
+    of processes that have exited are merged into the archive and removed.
+    """
+    flush(force=True)
+    total = {'counters': {}, 'histograms': {}}
+    if _path is None:
+        with _lock:
+            _merge(total, {'counters': _counters, 'histograms': _histograms})
+        return total
+
+    dead = []
+    for name in os.listdir(_path):
+        if not (name.startswith('metrics-') and name.endswith('.json')) or name == ARCHIVE:
+            continue
+        path = os.path.join(_path, name)
+        pid = int(name[len('metrics-'):-len('.json')])
+        if not _alive(pid):
+            dead.append(path)
+            continue
+        snapshot = _read(path)
+        if snapshot is not None:
+            _merge(total, snapshot)
+
+    if dead:
+        archive = _fold(dead)
+    else:
+        archive = _read(os.path.join(_path, ARCHIVE)) or {'counters': {}, 'histograms': {}}
+    _merge(total, archive)
+    return total
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels) + '}'
+
+
+def _split(key):
+    i = key.index('[')
+    return key[:i], [tuple(pair) for pair in json.loads(key[i:])]
+
+
+def render(total, extra=()):
+    """Format aggregated metrics, plus (name, type, help, value) tuples read at
+    scrape time, in the Prometheus text exposition format.
+    """
+    series = {}
+    for key, value in total['counters'].items():
+        name, labels = _split(key)
+        series.setdefault(name, []).append((labels, value))
+    for key, hist in total['histograms'].items():
+        name, labels = _split(key)
+        series.setdefault(name, []).append((labels, hist))
+
+    lines = []
+    for name in sorted(series):
+        kind, help = METRICS.get(name, ('untyped', ''))
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in sorted(series[name]):
+            if kind != 'histogram':
+                lines.append('{}{} {}'.format(name, _labels(labels), value))
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), value[:-2]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(labels + [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), value[-2]))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), value[-1]))
+
+    for name, kind, help, value in extra:
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.append('{} {}'.format(name, value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def database_metrics(db):
+    """Metrics that already live in SQLite and are read at scrape time."""
+    extra = [('jobs_queue_depth', 'gauge', 'Ingestion jobs waiting or running.',
+              db.execute("SELECT count(*) FROM jobs WHERE status IN"
+                         " ('queued', 'extracting', 'indexing')").fetchone()[0])]
+    count, oldest = db.execute('SELECT count(*), min(created) FROM outbox').fetchone()
+    extra.append(('outbox_pending', 'gauge', 'Outbox operations not delivered yet.', count))
+    extra.append(('outbox_oldest_age_seconds', 'gauge',
+                  'Age of the oldest undelivered outbox operation.',
+                  time.time() - oldest if oldest is not None else 0))
+    extra.append(('outbox_dead_letters', 'gauge',
+                  'Outbox operations given up on, waiting to be replayed.',
+                  db.execute('SELECT count(*) FROM dead_letters').fetchone()[0]))
+    for name, value in db.execute('SELECT name, value FROM cache_stats ORDER BY name'):
+        extra.append(('extraction_cache_{}_total'.format(name), 'counter',
+                      'Extraction cache {}.'.format(name), value))
+    return extra
+
+
+def metrics_view():
+    body = render(collect(), database_metrics(get_db()))
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    configure(app.config.get('METRICS_DIR'), app.config.get('METRICS_FLUSH_INTERVAL', 0))
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop('request_start', None)
+        if start is not None:
+            endpoint = request.endpoint or 'unmatched'
+            observe('http_request_duration_seconds',
+                    time.perf_counter() - start, endpoint=endpoint)
+            inc('http_requests_total', endpoint=endpoint,
+                method=request.method, status=response.status_code)
+        return response
+
+    @app.teardown_request
+    def flush_metrics(e=None):
+        flush()
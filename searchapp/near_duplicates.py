@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for finding the uploads that are near-duplicates of earlier ones,
+such as slightly edited revisions of the same interview
+
+The transcription of every extracted document is cut into shingles of
+NEAR_DUP_SHINGLE words and summarized by a MinHash signature of
+NEAR_DUP_PERMUTATIONS values, the minimum of each of as many random hash
+permutations over the shingles, computed with NumPy one block of shingles at
+a time. The share of equal values of two signatures estimates the Jaccard
+similarity of the two shingle sets. The signature is split into
+NEAR_DUP_BANDS bands, kept in the lsh_bands table, and the candidates of a
+new document are the entries sharing at least one band with it, found with
+the primary key instead of comparing it with every entry. A candidate whose
+estimated similarity is at least NEAR_DUP_THRESHOLD makes the new entry a
+near-duplicate: entries.duplicate_of is set to the first entry of the
+candidate's group, so every group of revisions hangs off its oldest upload.
+
+NumPy is only imported when a signature is computed.
+"""
+
+import re
+import zlib
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from searchapp.db import get_db
+
+# hashes are taken modulo this Mersenne prime, so that a * hash + b fits in
+# 64 bits
+PRIME = (1 << 31) - 1
+
+# the permutations must be the same in every process and across restarts
+SEED = 20190107
+
+# shingles hashed by one NumPy operation, bounding its memory
+BLOCK_SIZE = 4096
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+_permutations = {}
+
+
+def _permutation(count):
+    """The (a, b) coefficients of count hash permutations a * x + b."""
+    import numpy
+
+    if count not in _permutations:
+        rng = numpy.random.RandomState(SEED)
+        _permutations[count] = (rng.randint(1, PRIME, size=count).astype(numpy.uint64),
+                                rng.randint(0, PRIME, size=count).astype(numpy.uint64))
+    return _permutations[count]
+
+
+def shingles(text, size=5):
+    """The set of runs of size consecutive lowercased words of text. A text
+    shorter than that is a single shingle.
+    """
+    words = _WORD_RE.findall(text.lower())
+    if len(words) <= size:
+        return set([' '.join(words)]) if words else set()
+    return set(' '.join(words[i:i + size]) for i in range(len(words) - size + 1))
+
+
+def signature(text, permutations=128, size=5):
+    """The MinHash signature of the shingles of text, as a NumPy array of
+    permutations unsigned 32-bit integers, or None when text has no words.
+    """
+    import numpy
+
+    grams = shingles(text, size)
+    if not grams:
+        return None
+    hashes = numpy.fromiter((zlib.crc32(gram.encode('utf-8')) for gram in grams),
+                            dtype=numpy.uint64, count=len(grams)) % PRIME
+    a, b = _permutation(permutations)
+    result = numpy.full(permutations, PRIME, dtype=numpy.uint64)
+    for start in range(0, len(hashes), BLOCK_SIZE):
+        # one row per permutation, one column per shingle of the block
+        block = (numpy.outer(a, hashes[start:start + BLOCK_SIZE]) + b[:, None]) % PRIME
+        numpy.minimum(result, block.min(axis=1), out=result)
+    return result.astype('<u4')
+
+
+def similarity(first, second):
+    """The Jaccard similarity of two texts estimated from their signatures."""
+    return float((first == second).mean())
+
+
+def check_bands(permutations, count):
+    """Raise ValueError unless a signature of permutations values splits into
+    count bands of equal size.
+    """
+    if count < 1 or permutations % count:
+        raise ValueError('NEAR_DUP_PERMUTATIONS ({}) must be a multiple of'
+                         ' NEAR_DUP_BANDS ({})'.format(permutations, count))
+
+
+def bands(sig, count):
+    """Split a signature into count (band, key) pairs, the key being the
+    bytes of the band's values. The signature must split into count bands of
+    equal size.
+    """
+    check_bands(len(sig), count)
+    rows = len(sig) // count
+    return [(band, sig[band * rows:(band + 1) * rows].tobytes()) for band in range(count)]
+
+
+def _load(blob):
+    import numpy
+
+    return numpy.frombuffer(blob, dtype='<u4')
+
+
+def document_signature(json_out):
+    """The signature of an extracted document with the app's settings, or
+    None when near-duplicate detection is turned off or it has no text.
+    """
+    config = current_app.config
+    if not config['NEAR_DUP_THRESHOLD']:
+        return None
+    return signature(json_out.get('transcription') or '',
+                     config['NEAR_DUP_PERMUTATIONS'], config['NEAR_DUP_SHINGLE'])
+
+
+def candidates(db, sig, exclude=None):
+    """The ids of the existing entries sharing a band with sig."""
+    pairs = bands(sig, current_app.config['NEAR_DUP_BANDS'])
+    rows = db.execute(
+        'SELECT DISTINCT l.entry_id FROM lsh_bands l JOIN entries e ON e.id = l.entry_id'
+        ' WHERE ' + ' OR '.join(['(l.band = ? AND l.hash = ?)'] * len(pairs)),
+        [value for pair in pairs for value in pair]
+    )
+    return [row[0] for row in rows if row[0] != exclude]
+
+
+def record(db, entry_id, sig):
+    """Keep the signature of an entry and its bands, replacing earlier ones,
+    and mark the entry as a near-duplicate of the group of its most similar
+    candidate, if that is at least NEAR_DUP_THRESHOLD. Returns the
+    (duplicate_of, similarity) of the entry, or None. Not committed.
+    """
+    _remove(db, entry_id)
+    if sig is None:
+        return None
+
+    best = None
+    ids = candidates(db, sig, exclude=entry_id)
+    if ids:
+        rows = db.execute(
+            'SELECT entry_id, signature FROM signatures WHERE entry_id IN ({})'
+            .format(', '.join('?' * len(ids))), ids
+        )
+        for row in rows:
+            score = similarity(sig, _load(row['signature']))
+            if score >= current_app.config['NEAR_DUP_THRESHOLD'] and (
+                    best is None or score > best[1]):
+                best = (row['entry_id'], score)
+
+    db.execute('INSERT INTO signatures (entry_id, signature) VALUES (?, ?)',
+               (entry_id, sig.tobytes()))
+    db.executemany('INSERT INTO lsh_bands (band, hash, entry_id) VALUES (?, ?, ?)',
+                   [(band, key, entry_id)
+                    for band, key in bands(sig, current_app.config['NEAR_DUP_BANDS'])])
+
+    if best is None:
+        db.execute('UPDATE entries SET duplicate_of = NULL, similarity = NULL WHERE id = ?',
+                   (entry_id,))
+        return None
+    group = db.execute('SELECT coalesce(duplicate_of, id) FROM entries WHERE id = ?',
+                       (best[0],)).fetchone()[0]
+    db.execute('UPDATE entries SET duplicate_of = ?, similarity = ? WHERE id = ?',
+               (group, best[1], entry_id))
+    return group, best[1]
+
+
+def forget(db, entry_id):
+    """Remove the signature of a deleted entry. When it was the first of a
+    group, the oldest of the others takes its place. Not committed.
+    """
+    _remove(db, entry_id)
+    members = [row[0] for row in db.execute(
+        'SELECT id FROM entries WHERE duplicate_of = ? ORDER BY id', (entry_id,))]
+    if members:
+        db.execute('UPDATE entries SET duplicate_of = NULL, similarity = NULL WHERE id = ?',
+                   (members[0],))
+        db.execute('UPDATE entries SET duplicate_of = ? WHERE duplicate_of = ?',
+                   (members[0], entry_id))
+
+
+def _remove(db, entry_id):
+    db.execute('DELETE FROM signatures WHERE entry_id = ?', (entry_id,))
+    db.execute('DELETE FROM lsh_bands WHERE entry_id = ?', (entry_id,))
+
+
+@click.command('backfill-near-duplicates')
+@click.option('--all', 'everything', is_flag=True,
+              help='recompute every signature, after changing the NEAR_DUP settings')
+@with_appcontext
+def backfill_near_duplicates_command(everything):
+    """Compute the signatures of the indexed documents that have none, oldest
+    first, and mark their near-duplicates.
+    """
+    from searchapp.elastic_loader import ElasticLoader
+    from searchapp.word_to_elastic import INDEX_NAME
+
+    if not current_app.config['NEAR_DUP_THRESHOLD']:
+        raise click.ClickException('Near-duplicate detection is turned off')
+
+    db = get_db()
+    if everything:
+        db.execute('DELETE FROM signatures')
+        db.execute('DELETE FROM lsh_bands')
+        db.execute('UPDATE entries SET duplicate_of = NULL, similarity = NULL')
+        db.commit()
+    recorded = set(row[0] for row in db.execute('SELECT entry_id FROM signatures'))
+    entries = set(row[0] for row in db.execute('SELECT id FROM entries'))
+
+    el = ElasticLoader()
+    signatures = {}
+    if el.exists(INDEX_NAME):
+        for docID, source in el.scan(INDEX_NAME):
+            if docID.isdigit() and int(docID) in entries and int(docID) not in recorded:
+                signatures[int(docID)] = document_signature(source)
+
+    duplicates = 0
+    for entry_id in sorted(signatures):
+        if record(db, entry_id, signatures[entry_id]) is not None:
+            duplicates += 1
+    db.commit()
+    click.echo('Computed {} signatures, {} near-duplicates'.format(len(signatures), duplicates))
+
+
+def init_app(app):
+    if app.config['NEAR_DUP_THRESHOLD']:
+        check_bands(app.config['NEAR_DUP_PERMUTATIONS'], app.config['NEAR_DUP_BANDS'])
+    app.cli.add_command(backfill_near_duplicates_command)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Functions for extracting information from OpenDocument text (.odt) documents
+"""
+
+from __future__ import print_function, division
+
+import zipfile
+from xml.etree.ElementTree import iterparse
+
+from searchapp.docx_processing import zip_source
+from searchapp.text_processing import PARAGRAPH, TABLE
+
+# OpenDocument namespaces and the qualified tag names the extractor cares about
+OFFICE_NS = '{urn:oasis:names:tc:opendocument:xmlns:office:1.0}'
+TEXT_NS = '{urn:oasis:names:tc:opendocument:xmlns:text:1.0}'
+TABLE_NS = '{urn:oasis:names:tc:opendocument:xmlns:table:1.0}'
+OFFICE_TEXT = OFFICE_NS + 'text'
+TEXT_P = TEXT_NS + 'p'
+TEXT_H = TEXT_NS + 'h'
+TEXT_S = TEXT_NS + 's'
+TEXT_C = TEXT_NS + 'c'
+TEXT_NOTE = TEXT_NS + 'note'
+TEXT_BREAKS = (TEXT_NS + 'tab', TEXT_NS + 'line-break')
+TABLE_TABLE = TABLE_NS + 'table'
+TABLE_ROW = TABLE_NS + 'table-row'
+TABLE_CELL = TABLE_NS + 'table-cell'
+TABLE_COVERED = TABLE_NS + 'covered-table-cell'
+TABLE_ROW_GROUPS = (TABLE_NS + 'table-header-rows', TABLE_NS + 'table-rows',
+                    TABLE_NS + 'table-row-group')
+TABLE_REPEATED = TABLE_NS + 'number-columns-repeated'
+
+
+def _text(elem, text):
+    """Append the text of a text:p or text:h element, including its spans
+    and links, to the text list. Notes are left out like they are in DOCX.
+    """
+
+    if elem.text:
+        text.append(elem.text)
+    for child in elem:
+        if child.tag == TEXT_S:
+            text.append(' ' * int(child.get(TEXT_C, 1)))
+        elif child.tag in TEXT_BREAKS:
+            text.append(' ')
+        elif child.tag != TEXT_NOTE:
+            _text(child, text)
+        if child.tail:
+            text.append(child.tail)
+
+
+def _paragraphs(elem):
+    """Yield the text of every paragraph and heading in elem, such as a list
+    or a section, in document order.
+    """
+
+    if elem.tag in (TEXT_P, TEXT_H):
+        text = []
+        _text(elem, text)
+        yield ''.join(text)
+    elif elem.tag != TABLE_TABLE:
+        for child in elem:
+            for text in _paragraphs(child):
+                yield text
+
+
+def _rows(elem):
+    for child in elem:
+        if child.tag == TABLE_ROW:
+            yield child
+        elif child.tag in TABLE_ROW_GROUPS:
+            for row in _rows(child):
+                yield row
+
+
+def _table_rows(tbl):
+    """Return the rows of a table:table element as lists of cell text. A cell
+    repeated over several columns is repeated in the row, except at the end
+    of a row where the repeated cells are empty padding. Cells covered by a
+    merged cell are empty.
+    """
+
+    rows = []
+    for tr in _rows(tbl):
+        cells = []
+        for tc in tr:
+            if tc.tag not in (TABLE_CELL, TABLE_COVERED):
+                continue
+            text = '\n'.join(_paragraphs(tc))
+            cells.extend([text] * (int(tc.get(TABLE_REPEATED, 1)) if text else 1))
+        while cells and not cells[-1]:
+            cells.pop()
+        rows.append(cells)
+    return rows
+
+
+def blocks(inputFile):
+    """Yield the paragraphs and tables of an ODT document in document order.
+    content.xml is read straight out of the zip with an incremental XML
+    parser, and each top level element of the text is discarded once it has
+    been handled. Paragraphs inside lists and sections are paragraphs too.
+
+    Args:
+        inputFile (file): the ODT file to be read, as a path, binary file
+            object or bytes
+
+    Yields:
+        ('paragraph', text) and ('table', rows) tuples
+    """
+
+    with zipfile.ZipFile(zip_source(inputFile)) as odt:
+        with odt.open('content.xml') as part:
+            body = None
+            depth = 0
+            bodyDepth = None
+            for event, elem in iterparse(part, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if elem.tag == OFFICE_TEXT:
+                        body = elem
+                        bodyDepth = depth
+                    continue
+
+                depth -= 1
+                if body is None or depth != bodyDepth:
+                    continue
+
+                if elem.tag == TABLE_TABLE:
+                    yield TABLE, _table_rows(elem)
+                else:
+                    for text in _paragraphs(elem):
+                        yield PARAGRAPH, text
+                body.remove(elem)
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for delivering index changes to the search backend through an outbox
+
+Every change to the index is first written to the outbox table in the same
+transaction as the change to entries, so a change is never lost when the
+search backend is down or the process dies. drain() sends the outbox to the
+backend with bulk requests and removes each row only once the backend has
+acknowledged it, so delivery is at least once; index and delete are
+idempotent, so a repeated delivery does no harm. Of several operations on the
+same entry only the latest one is sent.
+
+Only one process drains at a time, which keeps the operations on an entry in
+order. The drainer holds a lease in index_state that runs out after
+OUTBOX_LEASE seconds, in case the process holding it dies, and renews it
+after every batch; a drainer that finds it has lost the lease stops.
+
+An operation that fails with a retryable error, e.g. the backend is down or
+pushing back, is retried after a growing delay with jitter. One that fails
+for good, e.g. a document the mapping rejects, or that has been tried
+OUTBOX_MAX_ATTEMPTS times, is moved to the dead_letters table, from where
+`flask replay-dead-letters` puts it back in the outbox.
+"""
+
+import json
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from searchapp import metrics, search_cache
+from searchapp.db import get_db
+from searchapp.elastic_loader import backoff, get_breaker
+from searchapp.word_to_elastic import routing_key, sync_documents
+
+LEASE = 'outbox_lease'
+
+
+def add(db, entry_id, op, body=None):
+    """Record an index operation, with the document as body, or a delete
+    operation for an entry, which must still be in entries. The insert is
+    not committed, so the caller commits it together with the change to the
+    entry.
+
+    The document is indexed with the id of the entry's author and routed by
+    the key INDEX_ROUTING picks from it, which is kept with the entry so the
+    delete goes to the same shard.
+    """
+    entry = db.execute('SELECT author_id, routing FROM entries WHERE id = ?',
+                       (entry_id,)).fetchone()
+    routing = entry['routing'] if entry is not None else None
+    if op == 'index':
+        body = dict(body, author_id=entry['author_id'])
+        routing = routing_key(body, current_app.config['INDEX_ROUTING'])
+        db.execute('UPDATE entries SET routing = ? WHERE id = ?', (routing, entry_id))
+
+    db.execute(
+        'INSERT INTO outbox (entry_id, op, body, routing, created)'
+        ' VALUES (?, ?, ?, ?, ?)',
+        (entry_id, op, json.dumps(body) if body is not None else None, routing,
+         time.time())
+    )
+
+
+def _acquire(db, lease):
+    now = time.time()
+    token = now + lease
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        acquired = db.execute(
+            'UPDATE index_state SET value = ? WHERE name = ? AND value <= ?',
+            (token, LEASE, now)
+        ).rowcount == 1
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return token if acquired else None
+
+
+def _renew(db, token, lease):
+    """Extend the lease held with token. Returns the new token, or None when
+    the lease ran out and another process has taken it.
+    """
+    renewed = time.time() + lease
+    held = db.execute(
+        'UPDATE index_state SET value = ? WHERE name = ? AND value = ?',
+        (renewed, LEASE, token)
+    ).rowcount == 1
+    db.commit()
+    return renewed if held else None
+
+
+def _release(db, token):
+    db.execute('UPDATE index_state SET value = 0 WHERE name = ? AND value = ?',
+               (LEASE, token))
+    db.commit()
+
+
+def _dead_letter(db, row, error, attempts, now):
+    """Move the operations of an entry up to row out of the outbox into
+    dead_letters, where row replaces an earlier dead letter of the entry,
+    and fail the job waiting for it.
+    """
+    db.execute(
+        'INSERT OR REPLACE INTO dead_letters'
+        ' (entry_id, op, body, routing, error, attempts, created, failed)'
+        ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (row['entry_id'], row['op'], row['body'], row['routing'], error,
+         attempts, row['created'], now)
+    )
+    db.execute('DELETE FROM outbox WHERE entry_id = ? AND id <= ?',
+               (row['entry_id'], row['id']))
+    failed = db.execute(
+        'UPDATE jobs SET status = \'failed\', error = ?, updated = CURRENT_TIMESTAMP'
+        ' WHERE entry_id = ? AND status = \'indexing\'', (error, row['entry_id'])
+    ).rowcount
+    if failed > 0:
+        metrics.inc('jobs_total', failed, outcome='failed')
+    metrics.inc('outbox_operations_total', op=row['op'], outcome='dead_lettered')
+    current_app.logger.error('Outbox gave up on %s of entry %s after %s attempts: %s',
+                             row['op'], row['entry_id'], attempts, error)
+
+
+def _deliver(db, rows):
+    """Send one batch of outbox rows, oldest first, and settle them. Returns
+    the number of entries whose latest operation was delivered.
+    """
+    config = current_app.config
+    latest = {}
+    for row in rows:
+        latest[row['entry_id']] = row
+
+    errors = sync_documents([
+        (entry_id, json.loads(row['body']) if row['op'] == 'index' else None,
+         row['routing'])
+        for entry_id, row in latest.items()
+    ])
+
+    now = time.time()
+    indexed = []
+    delivered = []
+    for entry_id, row in latest.items():
+        error = errors.get(entry_id)
+        if error is None:
+            # earlier operations on the entry are superseded by this one
+            db.execute('DELETE FROM outbox WHERE entry_id = ? AND id <= ?',
+                       (entry_id, row['id']))
+            metrics.observe('outbox_delivery_lag_seconds', now - row['created'])
+            metrics.inc('outbox_operations_total', op=row['op'], outcome='delivered')
+            if row['op'] == 'index':
+                indexed.append((entry_id,))
+            delivered.append((entry_id,))
+            continue
+
+        attempts = row['attempts'] + 1
+        if not error.retryable or attempts >= config['OUTBOX_MAX_ATTEMPTS']:
+            _dead_letter(db, row, str(error), attempts, now)
+            continue
+
+        delay = backoff(row['attempts'], config['OUTBOX_RETRY_DELAY'],
+                        config['OUTBOX_RETRY_MAX'])
+        db.execute(
+            'UPDATE outbox SET attempts = ?, error = ?, run_after = ?'
+            ' WHERE entry_id = ? AND id <= ?',
+            (attempts, str(error), now + delay, entry_id, row['id'])
+        )
+        db.execute(
+            'UPDATE jobs SET error = ?, updated = CURRENT_TIMESTAMP'
+            ' WHERE entry_id = ? AND status = ?', (str(error), entry_id, 'indexing')
+        )
+        metrics.inc('outbox_operations_total', op=row['op'], outcome='failed')
+
+    # a later operation on an entry supersedes its dead letter
+    if delivered:
+        db.executemany('DELETE FROM dead_letters WHERE entry_id = ?', delivered)
+
+    # the jobs waiting for these documents are finished
+    if indexed:
+        done = db.executemany(
+            'UPDATE jobs SET status = \'done\', error = NULL, document = NULL,'
+            ' updated = CURRENT_TIMESTAMP WHERE entry_id = ? AND status = \'indexing\'',
+            indexed
+        ).rowcount
+        if done > 0:
+            metrics.inc('jobs_total', done, outcome='done')
+    db.commit()
+
+    return len(latest) - len(errors)
+
+
+def drain(db=None):
+    """Deliver every outbox row that is due, OUTBOX_BATCH_SIZE at a time.
+    Returns the number of operations delivered, or None if another process
+    holds the lease and is draining already. Nothing is sent while the
+    circuit breaker is open, so the wait does not use up attempts.
+    """
+    db = db if db is not None else get_db()
+    config = current_app.config
+
+    if get_breaker().state == 'open':
+        return 0
+
+    token = _acquire(db, config['OUTBOX_LEASE'])
+    if token is None:
+        return None
+
+    delivered = 0
+    lastID = 0
+    try:
+        while True:
+            rows = db.execute(
+                'SELECT id, entry_id, op, body, routing, created, attempts FROM outbox'
+                ' WHERE id > ? AND run_after <= ? ORDER BY id LIMIT ?',
+                (lastID, time.time(), config['OUTBOX_BATCH_SIZE'])
+            ).fetchall()
+            if not rows:
+                break
+            lastID = rows[-1]['id']
+            delivered += _deliver(db, rows)
+            # a long drain keeps its lease, and stops once it has lost it
+            token = _renew(db, token, config['OUTBOX_LEASE'])
+            if token is None:
+                break
+    finally:
+        if db.in_transaction:
+            db.rollback()
+        if token is not None:
+            _release(db, token)
+
+    if delivered:
+        search_cache.bump_generation(db)
+    return delivered
+
+
+def replay_dead_letters(db, entry_ids=None):
+    """Put the dead letters back in the outbox with their attempts reset,
+    all of them or those of the entries in entry_ids, in one transaction.
+    The jobs they failed wait for them again. An index operation of an
+    entry that has been deleted since is dropped instead. Returns the
+    number of operations put back.
+    """
+    where = ''
+    params = ()
+    if entry_ids:
+        where = ' AND entry_id IN ({})'.format(', '.join('?' * len(entry_ids)))
+        params = tuple(entry_ids)
+
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.execute(
+            'DELETE FROM dead_letters WHERE op = \'index\''
+            ' AND entry_id NOT IN (SELECT id FROM entries)' + where, params
+        )
+        replayed = db.execute(
+            'INSERT INTO outbox (entry_id, op, body, routing, created)'
+            ' SELECT entry_id, op, body, routing, ? FROM dead_letters WHERE 1' + where
+            + ' ORDER BY id', (time.time(),) + params
+        ).rowcount
+        db.execute(
+            'UPDATE jobs SET status = \'indexing\', error = NULL,'
+            ' updated = CURRENT_TIMESTAMP WHERE status = \'failed\' AND entry_id IN'
+            ' (SELECT entry_id FROM dead_letters WHERE op = \'index\'' + where + ')',
+            params
+        )
+        db.execute('DELETE FROM dead_letters WHERE 1' + where, params)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return replayed
+
+
+@click.command('sync-outbox')
+@click.option('--once', is_flag=True, help='drain the outbox once and exit')
+@with_appcontext
+def sync_outbox_command(once):
+    """Deliver outbox operations to the search backend until interrupted."""
+    interval = current_app.config['JOB_POLL_INTERVAL']
+    while True:
+        try:
+            delivered = drain()
+            metrics.flush()
+            if delivered:
+                click.echo('Delivered {} operations'.format(delivered))
+        except Exception as e:
+            current_app.logger.warning('Outbox sync error: %s', e)
+        if once:
+            break
+        time.sleep(interval)
+
+
+@click.command('replay-dead-letters')
+@click.option('--entry', 'entry_ids', type=int, multiple=True,
+              help='replay only the dead letter of this entry, repeatable')
+@click.option('--list', 'list_only', is_flag=True,
+              help='list the dead letters instead of replaying them')
+@with_appcontext
+def replay_dead_letters_command(entry_ids, list_only):
+    """Put outbox operations that were given up on back in the outbox."""
+    db = get_db()
+    if list_only:
+        for row in db.execute('SELECT entry_id, op, attempts, failed, error'
+                              ' FROM dead_letters ORDER BY id'):
+            if entry_ids and row['entry_id'] not in entry_ids:
+                continue
+            click.echo('{} {} attempts={} failed={} {}'.format(
+                row['entry_id'], row['op'], row['attempts'],
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['failed'])),
+                row['error']))
+        return
+
+    replayed = replay_dead_letters(db, entry_ids)
+    click.echo('Replayed {} operations'.format(replayed))
+    if replayed:
+        delivered = drain(db)
+        metrics.flush()
+        if delivered is not None:
+            click.echo('Delivered {} operations'.format(delivered))
+
+
+def init_app(app):
+    app.cli.add_command(sync_outbox_command)
+    app.cli.add_command(replay_dead_letters_command)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for moving the transcript index to a new mapping version
+
+The documents of the index the transcript alias points at are streamed out
+with the scroll API and bulk loaded into transcript_v<version>, created from
+the index template of the current mapping, with refreshes and replicas turned
+off while it is loaded and force merged once it is complete. Documents
+written or deleted through the alias while the copy runs are caught up by
+comparing the ids of both indices, then the alias is swapped to the new index
+in one atomic request. Searches keep using the old index until the swap.
+The passage index is moved the same way with --index transcript_passage.
+
+Documents are routed in the new index by the current INDEX_ROUTING, so a
+change of routing mode is rolled out with a reindex too, and the routing keys
+kept with the entries are updated to match.
+"""
+
+from __future__ import print_function, division
+
+import sys
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from searchapp import search_cache
+from searchapp.db import get_db
+from searchapp.elastic_loader import ElasticLoader, versioned_name
+from searchapp.word_to_elastic import (DOC_TYPE, INDEX_NAME, MAPPING_VERSION,
+                                       PASSAGE_DOC_TYPE, PASSAGE_INDEX_NAME,
+                                       PASSAGE_MAPPING, PASSAGE_MAPPING_VERSION,
+                                       TEMPLATE_SETTINGS, TRANSCRIPT_MAPPING,
+                                       routing_key)
+
+# alias: (current mapping version, mapping, document type) of every index
+INDICES = {
+    INDEX_NAME: (MAPPING_VERSION, TRANSCRIPT_MAPPING, DOC_TYPE),
+    PASSAGE_INDEX_NAME: (PASSAGE_MAPPING_VERSION, PASSAGE_MAPPING, PASSAGE_DOC_TYPE),
+}
+
+
+class ReindexError(Exception):
+    """Raised when the index cannot be moved to the requested version."""
+
+
+def _copy(el, actions, chunkSize, threads, total, out, progressEvery):
+    """Bulk load actions, printing progress every progressEvery seconds.
+    Returns the number of documents copied and the failures by id.
+    """
+    copied = 0
+    failures = {}
+    start = last = time.time()
+
+    for ok, item in el.bulk(actions, chunkSize, threads):
+        result = list(item.values())[0]
+        if ok:
+            copied += 1
+        else:
+            failures[result['_id']] = result.get('error', result)
+
+        now = time.time()
+        if now - last >= progressEvery:
+            done = copied + len(failures)
+            print('{}/{} documents ({:.0f}%), {:.0f} docs/s'.format(
+                done, total, 100 * done / max(total, 1),
+                done / (now - start)), file=out)
+            last = now
+
+    return copied, failures
+
+
+def reindex(version=MAPPING_VERSION, mapping=TRANSCRIPT_MAPPING, alias=INDEX_NAME,
+            docType=DOC_TYPE, chunkSize=500, threads=1, deleteOld=False,
+            out=sys.stdout, progressEvery=5.0, settings=TEMPLATE_SETTINGS,
+            routing=None):
+    """Copy the documents behind alias into <alias>_v<version> created from
+    the index template of mapping and settings, then point the alias at it.
+    A leftover target from an earlier run that failed before the swap is
+    deleted and rebuilt. With routing, a function of a document returning
+    its routing key or None, the copies are routed by it. Returns a summary
+    dictionary, with the routing key of every copied document under
+    'routing'.
+    """
+    routed = {}
+
+    def action(docID, body):
+        action = {'_index': target, '_type': docType, '_id': docID,
+                  '_source': body}
+        if routing is not None:
+            key = routed[docID] = routing(body)
+            if key is not None:
+                action['_routing'] = key
+        return action
+
+    el = ElasticLoader()
+    target = versioned_name(alias, version)
+
+    current = el.get_alias(alias)
+    if target in current:
+        raise ReindexError('{} already points at {}'.format(alias, target))
+    if len(current) > 1:
+        raise ReindexError('{} points at more than one index: {}'.format(
+            alias, ', '.join(current)))
+    # before versioned indices the documents lived in an index named alias
+    source = current[0] if current else (alias if el.exists(alias) else None)
+
+    if el.exists(target):
+        print('Deleting {} left over from an earlier reindex'.format(target), file=out)
+        el.delete_index(target)
+    el.put_template(alias, version, mapping, settings)
+    el.create_index_with_mapping(target)
+
+    summary = {'source': source, 'target': target, 'documents': 0,
+               'failed': 0, 'seconds': 0.0, 'routing': routed}
+    start = time.time()
+
+    if source is not None:
+        total = el.count(source)
+        print('Copying {} documents from {} to {}'.format(total, source, target), file=out)
+        with el.bulk_load(target, maxSegments=None):
+            actions = (action(docID, body)
+                       for docID, body in el.scan(source, chunkSize=chunkSize))
+            copied, failures = _copy(el, actions, chunkSize, threads, total,
+                                     out, progressEvery)
+
+            # catch up with uploads and deletes made during the copy
+            sourceIDs = set(docID for docID, body in el.scan(source, False, chunkSize))
+            targetIDs = set(docID for docID, body in el.scan(target, False, chunkSize))
+            missing = sourceIDs - targetIDs - set(failures)
+            extra = targetIDs - sourceIDs
+            if missing or extra:
+                print('Catching up {} new and {} deleted documents'.format(
+                    len(missing), len(extra)), file=out)
+            actions = []
+            if routing is not None and missing:
+                # a routed document is only found by id with its key, which
+                # is not known, so the new ones are scanned for instead
+                found = ((docID, body) for docID, body in el.scan(source, chunkSize=chunkSize)
+                         if docID in missing)
+            else:
+                found = ((docID, el.get(source, docID, docType)) for docID in missing)
+            for docID, body in found:
+                if body is not None:
+                    actions.append(action(docID, body))
+            actions.extend({'_op_type': 'delete', '_index': target,
+                            '_type': docType, '_id': docID} for docID in extra)
+            caughtUp, lateFailures = _copy(el, actions, chunkSize, 1, len(actions),
+                                           out, progressEvery)
+            failures.update(lateFailures)
+
+        summary['documents'] = copied + len([a for a in actions if '_source' in a])
+        summary['failed'] = len(failures)
+        for docID, error in sorted(failures.items())[:10]:
+            print('FAILED {}: {}'.format(docID, error), file=out)
+        if failures:
+            el.delete_index(target)
+            raise ReindexError('{} documents could not be copied, {} is unchanged'.format(
+                len(failures), alias))
+        # merged only once the copy is known to be complete
+        el.forcemerge(target)
+
+    el.swap_alias(alias, target)
+    summary['seconds'] = time.time() - start
+    print('{} now points at {}: {} documents in {:.1f}s ({:.0f} docs/s)'.format(
+        alias, target, summary['documents'], summary['seconds'],
+        summary['documents'] / max(summary['seconds'], 1e-9)), file=out)
+
+    if deleteOld and source is not None and source != alias:
+        el.delete_index(source)
+        print('Deleted {}'.format(source), file=out)
+    return summary
+
+
+@click.command('reindex')
+@click.option('--index', 'alias', type=click.Choice(sorted(INDICES)),
+              default=INDEX_NAME, help='alias of the index to move')
+@click.option('--version', 'version', type=int, default=None,
+              help='mapping version to move the index to, the current one by default')
+@click.option('--batch-size', type=int, default=500,
+              help='documents per scroll page and bulk request')
+@click.option('--threads', type=int, default=1,
+              help='concurrent bulk requests')
+@click.option('--delete-old', is_flag=True,
+              help='delete the previous index after the swap')
+@with_appcontext
+def reindex_command(alias, version, batch_size, threads, delete_old):
+    """Copy an index into a new mapping version and swap its alias."""
+    current, mapping, docType = INDICES[alias]
+    mode = current_app.config['INDEX_ROUTING']
+    try:
+        summary = reindex(version or current, mapping, alias, docType,
+                          chunkSize=batch_size, threads=threads,
+                          deleteOld=delete_old, out=sys.stdout,
+                          routing=lambda body: routing_key(body, mode))
+    except ReindexError as e:
+        raise click.ClickException(str(e))
+
+    db = get_db()
+    if alias == INDEX_NAME:
+        # deletes have to be routed the way the entries are now indexed
+        db.executemany('UPDATE entries SET routing = ? WHERE id = ?',
+                       [(key, docID) for docID, key in summary['routing'].items()])
+        db.commit()
+    search_cache.bump_generation(db)
+
+
+def init_app(app):
+    app.cli.add_command(reindex_command)
@@ -1,3 +1,15 @@
+DROP TABLE IF EXISTS lsh_bands;
+DROP TABLE IF EXISTS signatures;
+DROP TABLE IF EXISTS facet_counts;
+DROP TABLE IF EXISTS suggest_log;
+DROP TABLE IF EXISTS entry_headers;
+DROP TABLE IF EXISTS dead_letters;
+DROP TABLE IF EXISTS outbox;
+DROP TABLE IF EXISTS index_state;
+DROP TABLE IF EXISTS cache_stats;
+DROP TABLE IF EXISTS extraction_cache;
+DROP TABLE IF EXISTS jobs;
+DROP TABLE IF EXISTS entries;
 DROP TABLE IF EXISTS user;
 DROP TABLE IF EXISTS post;
 
@@ -7,11 +19,148 @@ CREATE TABLE user (
   password TEXT NOT NULL
 );
 
+-- entries.id is the rowid, so the keyset pagination of the index page
+-- (id < ? ORDER BY id DESC) walks the table b-tree directly
 CREATE TABLE entries (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   author_id INTEGER NOT NULL,
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   title TEXT NOT NULL,
   body TEXT NOT NULL,
+  content_hash TEXT,
+  -- routing key the entry's document was indexed with, so its delete is
+  -- sent to the same shard; NULL when it was routed by id
+  routing TEXT,
+  -- first entry of the group of near-duplicates the entry belongs to, and
+  -- the estimated similarity it was matched with; NULL when it has none
+  duplicate_of INTEGER,
+  similarity REAL,
   FOREIGN KEY (author_id) REFERENCES user (id)
 );
+
+CREATE INDEX entries_content_hash ON entries (content_hash);
+
+CREATE INDEX entries_duplicate_of ON entries (duplicate_of);
+
+-- MinHash signature of every entry's transcription, NEAR_DUP_PERMUTATIONS
+-- little-endian 32-bit values
+CREATE TABLE signatures (
+  entry_id INTEGER PRIMARY KEY,
+  signature BLOB NOT NULL
+);
+
+-- the NEAR_DUP_BANDS bands of every signature, entries sharing a band are
+-- near-duplicate candidates
+CREATE TABLE lsh_bands (
+  band INTEGER NOT NULL,
+  hash BLOB NOT NULL,
+  entry_id INTEGER NOT NULL,
+  PRIMARY KEY (band, hash, entry_id)
+);
+
+CREATE INDEX lsh_bands_entry ON lsh_bands (entry_id);
+
+-- title and header values of every entry that are suggested as the user
+-- types; key is the lowercased value with its whitespace collapsed
+CREATE TABLE entry_headers (
+  entry_id INTEGER NOT NULL,
+  field TEXT NOT NULL,
+  value TEXT NOT NULL,
+  key TEXT NOT NULL,
+  PRIMARY KEY (entry_id, field, key)
+);
+
+CREATE INDEX entry_headers_key ON entry_headers (field, key);
+
+-- every change to entry_headers, read by each worker to update its
+-- suggestions; pruned to the last SUGGEST_LOG_MAX rows
+CREATE TABLE suggest_log (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  field TEXT NOT NULL,
+  value TEXT NOT NULL,
+  delta INTEGER NOT NULL
+);
+
+-- number of existing entries having each tag, researcher, project and load
+-- date (YYYY-MM-DD) in entry_headers, kept up to date with it
+CREATE TABLE facet_counts (
+  field TEXT NOT NULL,
+  key TEXT NOT NULL,
+  value TEXT NOT NULL,
+  count INTEGER NOT NULL,
+  PRIMARY KEY (field, key)
+);
+
+CREATE TABLE jobs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  entry_id INTEGER NOT NULL,
+  document BLOB,
+  -- name of the document's format in the extractors registry
+  format TEXT NOT NULL DEFAULT 'docx',
+  content_hash TEXT,
+  status TEXT NOT NULL DEFAULT 'queued',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  error TEXT,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (entry_id) REFERENCES entries (id)
+);
+
+CREATE INDEX jobs_status ON jobs (status, run_after);
+-- the latest job of an entry, max(id) for an entry_id, is the last key of
+-- its range in this index
+CREATE INDEX jobs_entry ON jobs (entry_id, id);
+
+CREATE TABLE extraction_cache (
+  hash TEXT PRIMARY KEY,
+  body TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  last_used REAL NOT NULL
+);
+
+CREATE INDEX extraction_cache_last_used ON extraction_cache (last_used);
+
+CREATE TABLE cache_stats (
+  name TEXT PRIMARY KEY,
+  value INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT INTO cache_stats (name) VALUES ('hits'), ('misses'), ('evictions');
+
+CREATE TABLE index_state (
+  name TEXT PRIMARY KEY,
+  value INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT INTO index_state (name) VALUES ('generation'), ('outbox_lease'), ('facets_reconciled');
+
+-- index and delete operations waiting to be sent to the search backend,
+-- written in the same transaction as the change to entries
+CREATE TABLE outbox (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  entry_id INTEGER NOT NULL,
+  op TEXT NOT NULL,
+  body TEXT,
+  routing TEXT,
+  created REAL NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  error TEXT,
+  run_after REAL NOT NULL DEFAULT 0
+);
+
+CREATE INDEX outbox_entry ON outbox (entry_id, id);
+
+-- outbox operations that failed for good, or too many times, kept to be
+-- replayed with `flask replay-dead-letters`; one per entry, the latest
+CREATE TABLE dead_letters (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  entry_id INTEGER NOT NULL UNIQUE,
+  op TEXT NOT NULL,
+  body TEXT,
+  routing TEXT,
+  error TEXT,
+  attempts INTEGER NOT NULL,
+  created REAL NOT NULL,
+  failed REAL NOT NULL
+);
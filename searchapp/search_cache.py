@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for caching search results between index changes
+
+Results are kept in a small in-process LRU cache with a TTL. Every change to
+the index bumps a generation counter stored in SQLite, which all gunicorn
+workers read, and a cached result is only served for the generation it was
+computed in. Nothing has to be deleted to invalidate the cache: the first
+lookup that sees a new generation simply starts over.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache(object):
+    """LRU cache with a time to live that is emptied whenever the index
+    generation it is asked about changes.
+    """
+
+    def __init__(self, maxsize=256, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _check_generation(self, generation):
+        if generation != self.generation:
+            self._data.clear()
+            self.generation = generation
+
+    def get(self, generation, key):
+        with self._lock:
+            self._check_generation(generation)
+            item = self._data.get(key)
+            if item is None or item[0] < time.time():
+                self._data.pop(key, None)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, generation, key, value):
+        with self._lock:
+            self._check_generation(generation)
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+def generation(db):
+    return db.execute(
+        'SELECT value FROM index_state WHERE name = ?', ('generation',)
+    ).fetchone()[0]
+
+
+def bump_generation(db):
+    """Invalidate cached results in every worker. Called after the index has
+    changed; the update is committed right away.
+    """
+    db.execute(
+        'UPDATE index_state SET value = value + 1 WHERE name = ?', ('generation',)
+    )
+    db.commit()
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for suggesting titles, tags, researchers and projects as the user
+types
+
+Suggestions never reach the search backend. Every worker keeps the distinct
+values of each field in a sorted array of lowercased keys with a count of the
+entries having them, and answers a prefix with a binary search followed by a
+short scan, ranked by count. The values of every entry are kept in the
+entry_headers table: titles are recorded when an entry is created, header
+values once its document has been extracted, and both are forgotten when it
+is deleted. The header values also keep the facet counts of the facets
+module up to date. Each of these changes is also appended to suggest_log, which
+every worker reads past the last row it has applied before answering, so a
+change made in one worker reaches the others without rebuilding. A worker
+that has fallen behind the pruned log, or has just started, rebuilds its
+arrays from entry_headers.
+"""
+
+import threading
+from bisect import bisect_left, insort
+
+import click
+from flask import Blueprint, current_app, jsonify, request
+from flask.cli import with_appcontext
+from werkzeug.exceptions import abort
+
+from searchapp import facets
+from searchapp.auth import login_required
+from searchapp.db import get_db
+
+bp = Blueprint('suggest', __name__, url_prefix='/api')
+
+FIELDS = ('title', 'tags', 'researcher', 'project')
+
+# header fields of an extracted document kept in entry_headers; the load
+# date is only counted by facets, not suggested
+HEADER_FIELDS = ('tags', 'researcher', 'project', 'date')
+
+
+def normalize(value):
+    """The key of a value: lowercased, whitespace collapsed."""
+    return ' '.join(str(value).lower().split())
+
+
+class PrefixIndex(object):
+    """The distinct values of one field. keys is sorted for bisect, and every
+    key maps to the first spelling seen of it and the number of entries that
+    have it; a key whose count drops to zero is removed.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.values = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, value, delta=1):
+        key = normalize(value)
+        if not key:
+            return
+        current = self.values.get(key)
+        if current is None:
+            if delta <= 0:
+                return
+            insort(self.keys, key)
+            self.values[key] = [value, delta]
+        elif current[1] + delta > 0:
+            current[1] += delta
+        else:
+            del self.values[key]
+            del self.keys[bisect_left(self.keys, key)]
+
+    def lookup(self, prefix, limit=10, scan=1000):
+        """Return up to limit (value, count) pairs whose key starts with
+        prefix, most frequent first. At most scan keys are ranked, so a one
+        letter prefix costs the same as a long one.
+        """
+        prefix = normalize(prefix)
+        start = bisect_left(self.keys, prefix)
+        matches = []
+        for key in self.keys[start:start + scan]:
+            if not key.startswith(prefix):
+                break
+            matches.append(self.values[key])
+        matches.sort(key=lambda item: (-item[1], item[0]))
+        return [(value, count) for value, count in matches[:limit]]
+
+
+class Suggester(object):
+    """A PrefixIndex per field, kept up to date with suggest_log."""
+
+    def __init__(self):
+        self.indices = dict((field, PrefixIndex()) for field in FIELDS)
+        self.seen = None
+        self._lock = threading.Lock()
+
+    def rebuild(self, db):
+        indices = dict((field, PrefixIndex()) for field in FIELDS)
+        # one read transaction, so the counts and the log position agree
+        if not db.in_transaction:
+            db.execute('BEGIN')
+        try:
+            seen = db.execute('SELECT coalesce(max(id), 0) FROM suggest_log').fetchone()[0]
+            # keys come in the order bisect needs, UTF-8 sorts by code point
+            rows = db.execute(
+                'SELECT field, key, min(value) AS value, count(*) AS n FROM entry_headers'
+                ' WHERE field IN ({}) GROUP BY field, key ORDER BY field, key'
+                .format(', '.join('?' * len(FIELDS))), FIELDS
+            )
+            for row in rows:
+                index = indices.get(row['field'])
+                if index is not None:
+                    index.keys.append(row['key'])
+                    index.values[row['key']] = [row['value'], row['n']]
+        finally:
+            db.commit()
+        self.indices = indices
+        self.seen = seen
+
+    def refresh(self, db):
+        """Apply the changes logged since the last refresh, or rebuild when
+        some of them have been pruned from the log already.
+        """
+        with self._lock:
+            if self.seen is None:
+                self.rebuild(db)
+                return
+            rows = db.execute(
+                'SELECT id, field, value, delta FROM suggest_log WHERE id > ? ORDER BY id',
+                (self.seen,)
+            ).fetchall()
+            if rows and rows[0]['id'] != self.seen + 1:
+                self.rebuild(db)
+                return
+            for row in rows:
+                index = self.indices.get(row['field'])
+                if index is not None:
+                    index.add(row['value'], row['delta'])
+            if rows:
+                self.seen = rows[-1]['id']
+
+    def lookup(self, field, prefix, limit=10, scan=1000):
+        with self._lock:
+            return self.indices[field].lookup(prefix, limit, scan)
+
+
+# one Suggester per database, its log positions mean nothing in another one
+_suggesters = {}
+
+
+def get_suggester():
+    database = current_app.config['DATABASE']
+    suggester = _suggesters.get(database)
+    if suggester is None:
+        suggester = _suggesters.setdefault(database, Suggester())
+    return suggester
+
+
+def header_values(json_out):
+    """The suggested header values of an extracted document by field."""
+    values = {}
+    for field in HEADER_FIELDS:
+        value = json_out.get(field)
+        if value is None:
+            continue
+        values[field] = value if isinstance(value, list) else [value]
+    return values
+
+
+def record(db, entry_id, values):
+    """Set the values of an entry for the fields in values, a dictionary of
+    field: list of values, replacing what was recorded for those fields
+    before. Not committed, the caller commits it with the change to the entry.
+    """
+    fields = list(values)
+    if not fields:
+        return
+    _forget(db, entry_id, fields)
+    rows = []
+    for field, items in values.items():
+        seen = set()
+        for value in items:
+            value = ' '.join(str(value).split())
+            key = normalize(value)
+            if key and key not in seen:
+                seen.add(key)
+                rows.append((entry_id, field, value, key))
+    db.executemany(
+        'INSERT INTO entry_headers (entry_id, field, value, key) VALUES (?, ?, ?, ?)', rows
+    )
+    _log(db, [(field, value, key) for entry_id, field, value, key in rows], 1)
+    _prune(db)
+
+
+def forget(db, entry_id):
+    """Remove every value of a deleted entry. Not committed."""
+    _forget(db, entry_id, FIELDS + HEADER_FIELDS)
+    _prune(db)
+
+
+def _forget(db, entry_id, fields):
+    fields = tuple(set(fields))
+    marks = ', '.join('?' * len(fields))
+    rows = db.execute(
+        'SELECT field, value, key FROM entry_headers'
+        ' WHERE entry_id = ? AND field IN ({})'.format(marks),
+        (entry_id,) + fields
+    ).fetchall()
+    _log(db, [tuple(row) for row in rows], -1)
+    db.execute(
+        'DELETE FROM entry_headers WHERE entry_id = ? AND field IN ({})'.format(marks),
+        (entry_id,) + fields
+    )
+
+
+def _log(db, rows, delta):
+    """Append the (field, value, key) rows added or removed to suggest_log
+    and to the facet counts.
+    """
+    db.executemany(
+        'INSERT INTO suggest_log (field, value, delta) VALUES (?, ?, ?)',
+        [(field, value, delta) for field, value, key in rows if field in FIELDS]
+    )
+    facets.count(db, rows, delta)
+
+
+def _prune(db):
+    db.execute(
+        'DELETE FROM suggest_log WHERE id <= (SELECT max(id) FROM suggest_log) - ?',
+        (current_app.config['SUGGEST_LOG_MAX'],)
+    )
+
+
+@bp.route('/suggest')
+@login_required
+def suggest():
+    """Suggest values starting with q, for one field or for every field."""
+    prefix = request.args.get('q', '')
+    field = request.args.get('field')
+    if field is not None and field not in FIELDS:
+        abort(400, 'field must be one of {}'.format(', '.join(FIELDS)))
+    try:
+        limit = min(max(int(request.args.get('limit', current_app.config['SUGGEST_LIMIT'])), 1),
+                    current_app.config['SUGGEST_MAX_LIMIT'])
+    except ValueError:
+        abort(400, 'limit must be an integer')
+    if not normalize(prefix):
+        abort(400, 'q must not be empty')
+
+    suggester = get_suggester()
+    suggester.refresh(get_db())
+    scan = current_app.config['SUGGEST_SCAN']
+    suggestions = dict(
+        (name, [{'value': value, 'count': count}
+                for value, count in suggester.lookup(name, prefix, limit, scan)])
+        for name in ([field] if field else FIELDS)
+    )
+    return jsonify({'q': prefix, 'suggestions': suggestions})
+
+
+@click.command('backfill-suggestions')
+@with_appcontext
+def backfill_suggestions_command():
+    """Record the titles of every entry and the headers of every indexed
+    document that have no suggestions yet, e.g. after an upgrade.
+    """
+    from searchapp.elastic_loader import ElasticLoader
+    from searchapp.word_to_elastic import INDEX_NAME
+
+    db = get_db()
+    recorded = set(row[0] for row in db.execute('SELECT DISTINCT entry_id FROM entry_headers'))
+    entries = dict((row['id'], row['title']) for row in db.execute('SELECT id, title FROM entries'))
+
+    el = ElasticLoader()
+    headers = {}
+    if el.exists(INDEX_NAME):
+        for docID, source in el.scan(INDEX_NAME):
+            if docID.isdigit() and int(docID) in entries:
+                headers[int(docID)] = header_values(source)
+
+    count = 0
+    for entry_id, title in entries.items():
+        if entry_id in recorded:
+            continue
+        values = dict(headers.get(entry_id, {}), title=[title])
+        record(db, entry_id, values)
+        count += 1
+    db.commit()
+    click.echo('Recorded the suggestions of {} entries'.format(count))
+
+
+def init_app(app):
+    app.cli.add_command(backfill_suggestions_command)
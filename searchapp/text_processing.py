@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Functions for extracting information from plain text and Markdown documents,
+and for turning the content of any document into the indexed JSON shape
+
+Every format reads its document as a stream of blocks, ('paragraph', text)
+or ('table', rows) in document order. collect builds the header dictionary
+and transcription from the blocks the same way for every format, and
+split_passages cuts the paragraphs into passages. split_transcription does the
+same for a document extracted earlier, from its transcription and the word
+offsets collect recorded for its paragraphs, so it is not read again.
+"""
+
+from __future__ import print_function, division
+
+import io
+import re
+from contextlib import contextmanager
+from datetime import datetime
+
+PARAGRAPH = 'paragraph'
+TABLE = 'table'
+
+# splits the values of the header keys listed in splitFields into words
+_SPLIT_RE = re.compile(r'\w+')
+
+# Markdown syntax that is dropped from the text of a paragraph
+_MD_IMAGE_RE = re.compile(r'!\[([^\]]*)\]\([^)]*\)')
+_MD_LINK_RE = re.compile(r'\[([^\]]*)\]\([^)]*\)')
+_MD_TAG_RE = re.compile(r'<[^>]+>')
+_MD_EMPHASIS_RE = re.compile(r'[*_`~]+')
+_MD_HEADING_RE = re.compile(r'^\s{0,3}#{1,6}\s')
+_MD_PREFIX_RE = re.compile(r'^\s{0,3}(?:#{1,6}\s+|>\s?|[-*+]\s+|\d+[.)]\s+)')
+_MD_RULE_RE = re.compile(r'^\s{0,3}(?:[-*_]\s*){3,}$')
+_MD_TABLE_RULE_RE = re.compile(r'^\s*\|?\s*:?-+:?\s*(?:\|\s*:?-+:?\s*)*\|?\s*$')
+
+
+def collect(blocks, splitFields=[], starts=None):
+    """Build the headers and transcription of a document from its blocks.
+
+    The first table is the header: its first column holds the keys, which are
+    lowercased, and its second the values. Rows with fewer than two cells are
+    skipped. The values of keys listed in
+    splitFields are split into arrays of words. A header gets a date key set
+    to today, the load date of the document. Every other table goes under
+    'tables' as a list of rows of cell text with whitespace collapsed, without
+    its empty rows. The transcription is the text of all paragraphs with
+    single spaces between words.
+
+    With a list as starts, the offset in words of every paragraph in the
+    transcription is appended to it, for split_transcription.
+
+    Args:
+        blocks (iterable): ('paragraph', text) and ('table', rows) tuples,
+            where rows is a list of lists of cell text
+        splitFields (list): array of header keys that should be treated as
+            array elements and not as a single string.
+        starts (list): None, or a list the paragraph offsets are appended to
+
+    Returns:
+        tuple of (headers, transcription)
+    """
+
+    headers = {}
+    text = []
+    header_rows = None
+    tables = []
+    offset = 0
+
+    for kind, content in blocks:
+        if kind == PARAGRAPH:
+            newwords = content.split()
+            if len(newwords) > 0:
+                text.append(' '.join(newwords))
+                if starts is not None:
+                    starts.append(offset)
+                    offset += len(newwords)
+        elif header_rows is None:
+            header_rows = content
+        else:
+            rows = [[' '.join(cell.split()) for cell in cells] for cells in content]
+            rows = [cells for cells in rows if any(cells)]
+            if rows:
+                tables.append(rows)
+
+    if header_rows is not None:
+        for cells in header_rows:
+            if len(cells) < 2:
+                continue
+            key = cells[0].lower()
+            value = cells[1]
+            if key in splitFields:
+                value = _SPLIT_RE.findall(value)
+            headers[key] = value
+        headers['date'] = datetime.today().strftime('%Y-%m-%d')
+    if tables:
+        headers['tables'] = tables
+
+    return headers, " ".join(text)
+
+
+def split_passages(paragraphs, maxTokens=200, overlapTokens=40):
+    """Split paragraphs into overlapping passages of whole paragraphs.
+
+    Paragraphs are added to a passage until the next one would take it over
+    maxTokens words. The next passage starts with the last paragraphs of the
+    previous one, as many as fit in overlapTokens words, so a match that
+    spans a passage boundary is still found in one passage. A paragraph longer
+    than maxTokens is cut into windows of maxTokens words that overlap by
+    overlapTokens. Passages are yielded as the paragraphs come in, so only
+    the current one is held in memory.
+
+    Args:
+        paragraphs (iterable): text of each paragraph
+        maxTokens (int): word budget of a passage
+        overlapTokens (int): words shared with the previous passage, less
+            than maxTokens
+
+    Yields:
+        dictionary with the passage number, counting from 0, and its text
+    """
+
+    step = maxTokens - overlapTokens
+    if step <= 0:
+        raise ValueError('overlapTokens must be less than maxTokens')
+
+    window = []
+    size = 0
+    fresh = False
+    number = 0
+
+    for paragraph in paragraphs:
+        words = paragraph.split()
+        if not words:
+            continue
+
+        if len(words) <= maxTokens:
+            pieces = [words]
+        else:
+            pieces = [words[i:i + maxTokens]
+                      for i in range(0, len(words) - overlapTokens, step)]
+
+        for piece in pieces:
+            if fresh and size + len(piece) > maxTokens:
+                yield {'passage': number,
+                       'text': ' '.join(' '.join(p) for p in window)}
+                number += 1
+                # carry the trailing paragraphs that fit in the overlap
+                kept = []
+                size = 0
+                for p in reversed(window):
+                    if size + len(p) > overlapTokens:
+                        break
+                    kept.insert(0, p)
+                    size += len(p)
+                window = kept
+                fresh = False
+            # the overlap gives way to a piece that would not fit with it
+            while not fresh and window and size + len(piece) > maxTokens:
+                size -= len(window.pop(0))
+            window.append(piece)
+            size += len(piece)
+            fresh = True
+
+    if fresh:
+        yield {'passage': number, 'text': ' '.join(' '.join(p) for p in window)}
+
+
+def split_transcription(transcription, starts, maxTokens=200, overlapTokens=40):
+    """Split a transcription into passages with split_passages, taking its
+    paragraphs to start at the word offsets in starts, as recorded by collect.
+
+    Yields:
+        dictionary with the passage number, counting from 0, and its text
+    """
+
+    words = transcription.split()
+    bounds = list(starts) + [len(words)]
+    return split_passages((' '.join(words[start:end])
+                           for start, end in zip(bounds, bounds[1:])),
+                          maxTokens, overlapTokens)
+
+
+@contextmanager
+def open_text(inputFile):
+    """Open a UTF-8 document given as a path, binary file object or bytes as
+    a text stream. Undecodable bytes are replaced rather than failing the
+    whole document. A file object passed in is left open.
+    """
+
+    if isinstance(inputFile, str):
+        with io.open(inputFile, encoding='utf-8-sig', errors='replace') as f:
+            yield f
+        return
+
+    if isinstance(inputFile, (bytes, bytearray, memoryview)):
+        inputFile = io.BytesIO(inputFile)
+    f = io.TextIOWrapper(inputFile, encoding='utf-8-sig', errors='replace')
+    try:
+        yield f
+    finally:
+        f.detach()
+
+
+def _lines(inputFile):
+    """Yield the lines of a text document without their line endings."""
+
+    with open_text(inputFile) as f:
+        for line in f:
+            yield line.rstrip('\r\n')
+
+
+def _front_matter(lines):
+    """Read the 'key: value' lines of a front matter block, up to the '---'
+    line that closes it, and return them as header table rows. The caller
+    has consumed the opening '---'; the lines after the block are left in the
+    iterator.
+    """
+
+    rows = []
+    for line in lines:
+        if line.strip() == '---':
+            return rows
+        key, sep, value = line.partition(':')
+        if sep:
+            rows.append([key.strip(), value.strip()])
+    return rows
+
+
+def text_blocks(inputFile):
+    """Yield the blocks of a plain text document. Paragraphs are separated by
+    blank lines. A front matter block at the start is the header table.
+
+    Args:
+        inputFile (file): the document to be read, as a path, binary file
+            object or bytes
+
+    Yields:
+        ('paragraph', text) and ('table', rows) tuples
+    """
+
+    lines = _lines(inputFile)
+    paragraph = []
+    first = True
+
+    for line in lines:
+        if first:
+            first = False
+            if line.strip() == '---':
+                yield TABLE, _front_matter(lines)
+                continue
+
+        if line.strip():
+            paragraph.append(line)
+        elif paragraph:
+            yield PARAGRAPH, ' '.join(paragraph)
+            paragraph = []
+
+    if paragraph:
+        yield PARAGRAPH, ' '.join(paragraph)
+
+
+def _markdown_text(line):
+    line = _MD_PREFIX_RE.sub('', line)
+    line = _MD_IMAGE_RE.sub(r'\1', line)
+    line = _MD_LINK_RE.sub(r'\1', line)
+    line = _MD_TAG_RE.sub(' ', line)
+    return _MD_EMPHASIS_RE.sub('', line)
+
+
+def _markdown_row(line):
+    cells = line.strip()
+    if cells.startswith('|'):
+        cells = cells[1:]
+    if cells.endswith('|'):
+        cells = cells[:-1]
+    return [_markdown_text(cell).strip() for cell in cells.split('|')]
+
+
+def markdown_blocks(inputFile):
+    """Yield the blocks of a Markdown document. Headings, list items and
+    paragraphs are paragraphs with their markup removed, keeping the text of
+    links and images. Pipe tables are tables, and a front matter block at the
+    start is the header table. Fenced code is kept as a paragraph of its own.
+
+    Args:
+        inputFile (file): the document to be read, as a path, binary file
+            object or bytes
+
+    Yields:
+        ('paragraph', text) and ('table', rows) tuples
+    """
+
+    lines = _lines(inputFile)
+    paragraph = []
+    table = []
+    fence = None
+    first = True
+
+    def flush():
+        if paragraph:
+            yield PARAGRAPH, ' '.join(paragraph)
+            del paragraph[:]
+        if table:
+            yield TABLE, list(table)
+            del table[:]
+
+    for line in lines:
+        stripped = line.strip()
+        if first:
+            first = False
+            if stripped == '---':
+                yield TABLE, _front_matter(lines)
+                continue
+
+        if fence is not None:
+            if stripped.startswith(fence):
+                fence = None
+                for block in flush():
+                    yield block
+            elif stripped:
+                paragraph.append(stripped)
+            continue
+        if stripped.startswith('```') or stripped.startswith('~~~'):
+            for block in flush():
+                yield block
+            fence = stripped[:3]
+            continue
+
+        if stripped.startswith('|'):
+            if paragraph:
+                for block in flush():
+                    yield block
+            if not _MD_TABLE_RULE_RE.match(stripped):
+                table.append(_markdown_row(stripped))
+            continue
+        if table:
+            for block in flush():
+                yield block
+
+        if not stripped or _MD_RULE_RE.match(stripped):
+            for block in flush():
+                yield block
+        elif _MD_HEADING_RE.match(line):
+            for block in flush():
+                yield block
+            yield PARAGRAPH, _markdown_text(line)
+        elif _MD_PREFIX_RE.match(line):
+            # a list item or quote starts a paragraph of its own
+            for block in flush():
+                yield block
+            paragraph.append(_markdown_text(line))
+        else:
+            paragraph.append(_markdown_text(stripped))
+
+    for block in flush():
+        yield block
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Request handling for uploaded documents
+
+By default Werkzeug writes every uploaded file over 500 KB to a temporary file.
+UploadRequest keeps an upload in memory up to UPLOAD_SPOOL_MAX_SIZE bytes and
+only spills larger ones to disk, so a typical transcript goes from the request
+to its job without touching the filesystem. Requests over MAX_CONTENT_LENGTH
+are rejected from their Content-Length header before the body is read.
+"""
+
+from tempfile import SpooledTemporaryFile
+
+from flask import Request, current_app, flash, redirect, url_for
+from werkzeug.exceptions import RequestEntityTooLarge
+
+
+class UploadRequest(Request):
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return SpooledTemporaryFile(
+            max_size=current_app.config['UPLOAD_SPOOL_MAX_SIZE'], mode='rb+')
+
+
+def too_large(e):
+    limit = current_app.config['MAX_CONTENT_LENGTH']
+    flash('Could not post file, uploads are limited to {} MB'.format(
+        limit // (1024 * 1024)))
+    return redirect(url_for('blog.index'))
+
+
+def init_app(app):
+    app.request_class = UploadRequest
+    app.register_error_handler(RequestEntityTooLarge, too_large)
@@ -16,86 +16,499 @@ from searchapp.word_to_json import yield_files
 
 # import the elastic loading function
 # that you just created in this exercise
-from searchapp.elastic_loader import ElasticLoader
+from searchapp.elastic_loader import (ElasticLoader, WriteError, configure,
+                                      is_retryable)
+
+# content hash keyed cache of extractions shared with the app
+from searchapp import extraction_cache
+
+# passages are split from the transcription when a document is indexed
+from searchapp.text_processing import split_transcription
+
+# per stage timings
+from searchapp import metrics
 
 # core libraries for processing the files
-import json
+import argparse
+import contextlib
+import functools
 import os
+import sqlite3
 import sys
-import glob
+import time
+from multiprocessing import Pool
+
+# documents are always read and written through the INDEX_NAME alias, which
+# points at the physical index transcript_v<MAPPING_VERSION>. The mapping is
+# stored as the index template of the alias, and a change to it bumps the
+# version and is rolled out with `flask reindex`.
+INDEX_NAME = DOC_TYPE = 'transcript'
+
+MAPPING_VERSION = 4
+
+# header values are only matched and filtered on, never ranked by how often or
+# where a word occurs, so only the documents are indexed and there are no
+# norms. The keyword subfield is what dynamic mapping gave the index before
+# the mapping was versioned.
+_HEADER_FIELD = {'type': 'text', 'index_options': 'docs', 'norms': False,
+                 'fields': {'keyword': {'type': 'keyword', 'ignore_above': 256}}}
+
+# tags are exact values filtered on and counted, matched without case
+_TAGS_FIELD = {'type': 'keyword', 'normalizer': 'lowercase_keyword',
+               'doc_values': True}
+
+# header keys a document may have beyond the mapped ones are indexed like the
+# mapped headers instead of being guessed by dynamic mapping
+_DYNAMIC_TEMPLATES = [
+    {'header_strings': {'match_mapping_type': 'string',
+                        'mapping': _HEADER_FIELD}},
+]
+
+TRANSCRIPT_MAPPING = {
+    DOC_TYPE: {
+        'dynamic_templates': _DYNAMIC_TEMPLATES,
+        'properties': {
+            'date': {'type': 'date'}
+            # user who uploaded the entry, absent for bulk loaded files
+            , 'author_id': {'type': 'integer'}
+            , 'researcher': _HEADER_FIELD
+            , 'filename': _HEADER_FIELD
+            , 'project': _HEADER_FIELD
+            , 'tags': _TAGS_FIELD
+            # every table but the header, as lists of rows of cell text
+            , 'tables': {'type': 'text', 'index_options': 'freqs'}
+            # offsets make highlighting the transcription cheap
+            , 'transcription': {'type': 'text', 'index_options': 'offsets'}
+        }
+    }
+}
+
+# index settings of the templates, next to the shard and replica counts
+TEMPLATE_SETTINGS = {
+    'analysis': {
+        'normalizer': {
+            'lowercase_keyword': {'type': 'custom', 'filter': ['lowercase']},
+        },
+    },
+}
+
 
-# useful for troubleshooting dictionary content
-from pprint import pprint
+# passages of a transcript are indexed as child documents of their own,
+# with the header fields of the transcript and the id of its entry
+PASSAGE_INDEX_NAME = PASSAGE_DOC_TYPE = 'transcript_passage'
 
-def word_to_elastic(fn, docID, splitFields=['tags']):
+PASSAGE_MAPPING_VERSION = 3
 
+# keys of an extraction that describe its passages and are not indexed with
+# the document; 'passages' is only found in extractions cached by earlier
+# versions
+PASSAGE_KEYS = ('paragraph_starts', 'passage_params', 'passages')
+
+PASSAGE_MAPPING = {
+    PASSAGE_DOC_TYPE: {
+        'dynamic_templates': _DYNAMIC_TEMPLATES,
+        'properties': {
+            'entry_id': {'type': 'integer'}
+            , 'passage': {'type': 'integer'}
+            , 'date': {'type': 'date'}
+            , 'author_id': {'type': 'integer'}
+            , 'researcher': _HEADER_FIELD
+            , 'filename': _HEADER_FIELD
+            , 'project': _HEADER_FIELD
+            , 'tags': _TAGS_FIELD
+            , 'text': {'type': 'text', 'index_options': 'offsets'}
+        }
+    }
+}
+
+
+def ensure_index(el):
+    '''
+    Create the transcript alias and its physical index from
+    the index template of the current mapping, unless the
+    alias already exists.
     '''
-    Given a Word document file name, fn, and specific
-    fields that will be split, create the JSON file 
-    to match the mapping definition and use the 
-    ElasticLoader to register the mapping
-    into the object, create an index, and load the document. 
+    el.create_versioned_index(INDEX_NAME, MAPPING_VERSION, TRANSCRIPT_MAPPING,
+                              TEMPLATE_SETTINGS)
+
+
+def ensure_passage_index(el):
+    '''
+    Create the passage alias and its physical index from the
+    index template of the current passage mapping, unless the
+    alias already exists.
+    '''
+    el.create_versioned_index(PASSAGE_INDEX_NAME, PASSAGE_MAPPING_VERSION,
+                              PASSAGE_MAPPING, TEMPLATE_SETTINGS)
+
+
+# documents can be routed to a shard by one of their fields, so searches for
+# a single author or project only ask that shard; routing mode: field
+ROUTING_FIELDS = {'author': 'author_id', 'project': 'project'}
+
+
+def routing_key(json_out, mode):
+    '''
+    Routing key of a document: the value of the field the
+    routing mode routes by, lowercased with its whitespace
+    collapsed, the first one of a list. Searches compute the
+    key of the value they filter on the same way.
 
     SIGNATURE:
-        INPUT: fn = word document file name
-            splitFields = array of fields that should be 
-            split when gathered from the header
-        OUPUT: Nothing returned, but loads the fn as a JSON
-            into the created elasticsearch index
-    '''
-
-    indexName = doctype = 'transcript'
-
-    transcript_mapping = {
-        doctype: {
-            'dynamic':'strict',
-            'properties': {
-                'date': {'type':'string'}
-                , 'researcher': {'type':'string'}
-                , 'filename': {'type':'string'}
-                , 'project': {'type':'string'}
-                , 'tags': {'type':'string', 'index_name':'tags'}
-                , 'transcription': {'type':'string'}
-            }
-        }
+        INPUT: json_out = the document, or a dictionary with
+            only the routing field
+            mode = None, or a key of ROUTING_FIELDS
+        OUTPUT: the key, or None when mode is None or the
+            document has no value, and it is routed by its id
+    '''
+
+    if not mode:
+        return None
+    if mode not in ROUTING_FIELDS:
+        raise ValueError('Unknown routing mode: {}'.format(mode))
+
+    value = json_out.get(ROUTING_FIELDS[mode])
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if value is None:
+        return None
+    return ' '.join(str(value).lower().split()) or None
+
+
+def index_action(docID, json_out, routing=None):
+    '''
+    Bulk action indexing an extracted document in the transcript
+    index, without the keys that describe its passages, which
+    are only kept for passage_actions.
+
+    SIGNATURE:
+        INPUT: docID = id of the document
+            json_out = the extracted document
+            routing = routing key of the document, or None
+        OUTPUT: bulk action dictionary
+    '''
+
+    action = {
+        '_index': INDEX_NAME,
+        '_type': DOC_TYPE,
+        '_id': docID,
+        '_source': dict((k, v) for k, v in json_out.items()
+                        if k not in PASSAGE_KEYS),
     }
+    if routing is not None:
+        action['_routing'] = routing
+    return action
+
+
+def passage_actions(docID, json_out, routing=None):
+    '''
+    Bulk actions for the passages of an extracted document,
+    split from its transcription at the paragraph offsets under
+    'paragraph_starts' with the settings under 'passage_params'.
+    Every passage is stored with the document's header fields
+    and its entry id, under the id <docID>_<passage number>,
+    with the routing key of the document.
+
+    SIGNATURE:
+        INPUT: docID = id of the entry the document belongs to
+            json_out = the extracted document
+            routing = routing key of the document, or None
+        OUTPUT: list of bulk action dictionaries
+    '''
+
+    header = dict((k, v) for k, v in json_out.items()
+                  if k not in ('transcription', 'tables') + PASSAGE_KEYS)
+    actions = []
+    for passage in split_transcription(json_out['transcription'],
+                                       json_out['paragraph_starts'],
+                                       *json_out['passage_params']):
+        source = dict(header, entry_id=int(docID), **passage)
+        action = {
+            '_index': PASSAGE_INDEX_NAME,
+            '_type': PASSAGE_DOC_TYPE,
+            '_id': '{}_{}'.format(docID, passage['passage']),
+            '_source': source,
+        }
+        if routing is not None:
+            action['_routing'] = routing
+        actions.append(action)
+    return actions
+
+
+def sync_documents(operations):
+
+    '''
+    Apply index and delete operations to the transcript index
+    with a single bulk request. A failed operation does not
+    raise, it is reported in the result so the others are
+    still applied. Deleting a document that is not in the
+    index counts as success. It returns once the changes are
+    visible to searches.
+
+    A document with 'passage_params' is split into passages,
+    which go to the passage index in the same request, after
+    the passages it had before are deleted, so none are left
+    over when it has fewer of them now.
+    Deleting a document also deletes its passages.
+    Every operation is routed by its routing key, which for a
+    delete must be the one the document was indexed with.
+
+    SIGNATURE:
+        INPUT: operations = list of (docID, json_out, routing)
+            tuples, where a json_out of None deletes the
+            document and a routing of None routes it by id
+        OUTPUT: dictionary of the WriteError of every operation
+            that failed, by docID, which tells whether it may
+            succeed when it is sent again
+    '''
+
+    errors = {}
+    if not operations:
+        return errors
 
-    
-    # STEP 1: Create a new instance of an ElasticLoader object
     el = ElasticLoader()
+    actions = []
+    for docID, json_out, routing in operations:
+        if json_out is None:
+            action = {'_op_type': 'delete', '_index': INDEX_NAME,
+                      '_type': DOC_TYPE, '_id': docID}
+            if routing is not None:
+                action['_routing'] = routing
+            actions.append(action)
+            continue
+        if 'passage_params' in json_out:
+            actions.extend(passage_actions(docID, json_out, routing))
+        actions.append(index_action(docID, json_out, routing))
+
+    with metrics.stage('es_bulk'):
+        try:
+            ensure_index(el)
+            if el.exists(PASSAGE_INDEX_NAME):
+                el.delete_by_query(PASSAGE_INDEX_NAME, {'terms': {
+                    'entry_id': [int(operation[0]) for operation in operations]}})
+            elif len(actions) > len(operations):
+                ensure_passage_index(el)
+            for ok, item in el.bulk(actions, chunkSize=len(actions),
+                                    refresh='wait_for'):
+                op, result = list(item.items())[0]
+                if not ok and not (op == 'delete' and result.get('status') == 404):
+                    # passage ids are <docID>_<passage number>
+                    docID = int(str(result['_id']).split('_')[0])
+                    errors.setdefault(docID, WriteError(
+                        str(result.get('error', result)),
+                        is_retryable(result.get('status'))))
+                    metrics.inc('es_errors_total', op='bulk', error='rejected')
+        except Exception as e:
+            metrics.inc('es_errors_total', op='bulk', error=type(e).__name__)
+            error = WriteError('{}: {}'.format(type(e).__name__, e),
+                               is_retryable(e))
+            for operation in operations:
+                errors.setdefault(operation[0], error)
 
-    # STEP 2: Create an index with the mapping
-    el.create_index_with_mapping(indexName, transcript_mapping)
+    return errors
 
-    # STEP 3: Create a JSON document that is the header, transcription, and filename, from the Word document.
-    #print(fn, file=sys.stderr)
-    json_out = docx_processing.header_extract(fn, splitFields)
-    json_out['transcription'] = docx_processing.paragraph_extract(fn)
-    
-    #print(json_out)
 
-    # STEP 4: Insert the document into the index.
-    el.try_insert(indexName, docID, doctype, json_out, False)
+def delete_from_index(docID, routing=None):
 
+    '''
+    Delete a document from the transcript index, routed by
+    the routing key it was indexed with. Errors are printed.
+
+    SIGNATURE:
+        INPUT: docID = id of the document
+            routing = routing key of the document, or None
+        OUTPUT: whether the document was deleted
+    '''
 
-def delete_from_index(docID):
     el = ElasticLoader()
-    indexName = doctype = 'transcript'
 
-    el.try_delete(indexName, docID, doctype, False)
+    with metrics.stage('es_delete'):
+        return el.try_delete(INDEX_NAME, docID, DOC_TYPE, False,
+                             refresh='wait_for', routing=routing)
+
+
+# connection to the extraction cache of each pool process
+_cache_db = None
+
+
+def _get_cache_db(cacheDB):
+    global _cache_db
+
+    if _cache_db is None:
+        _cache_db = sqlite3.connect(cacheDB, timeout=30)
+    return _cache_db
+
+
+def extract_document(fn, splitFields=['tags'], cacheDB=None,
+                     cacheMaxBytes=256 * 1024 * 1024):
+
+    '''
+    Process pool worker for bulk_word_to_elastic. Extract a single
+    Word document and never raise, so one bad file cannot stop a
+    backfill. With cacheDB, documents whose content was extracted
+    before are taken from the app's extraction cache.
+
+    SIGNATURE:
+        INPUT: fn = word document file name
+            splitFields = array of fields that should be
+            split when gathered from the header
+            cacheDB = path of the app's SQLite database, or None
+            to always extract
+            cacheMaxBytes = size bound of the extraction cache
+        OUTPUT: tuple of (fn, size in bytes, JSON document, error),
+            where exactly one of the document and error is None
+    '''
+
+    try:
+        size = os.path.getsize(fn)
+        json_out = key = None
+        if cacheDB is not None:
+            key = extraction_cache.content_hash(fn)
+            json_out = extraction_cache.get(_get_cache_db(cacheDB), key)
+
+        if json_out is None:
+            json_out, transcription = docx_processing.document_extract(fn, splitFields)
+            json_out['transcription'] = transcription
+            if key is not None:
+                extraction_cache.put(_get_cache_db(cacheDB), key, json_out,
+                                     cacheMaxBytes)
+
+        return fn, size, json_out, None
+    except Exception as e:
+        return fn, 0, None, '{}: {}'.format(type(e).__name__, e)
+
+
+def bulk_word_to_elastic(searchPath, splitFields=['tags'], workers=None,
+                         batchSize=500, threads=1, cacheDB=None,
+                         bulkLoad=False, routing=None, out=sys.stdout):
+
+    '''
+    Backfill loader. Word documents matching searchPath are
+    extracted in a process pool and streamed into the index
+    with the bulk API, with up to `threads` bulk requests in
+    flight. Each document is indexed under its file name
+    without the extension, so a rerun overwrites instead of
+    duplicating. In bulk load mode refreshes and replicas of
+    the index are turned off during the load and the index is
+    force merged at the end, which is faster for a large load
+    but leaves searches without new documents and without a
+    replica until it is done.
+
+    SIGNATURE:
+        INPUT: searchPath = glob of the Word documents to load
+            splitFields = array of fields that should be
+            split when gathered from the header
+            workers = number of extraction processes, defaults
+            to the number of CPUs
+            batchSize = number of documents per bulk request
+            threads = number of concurrent bulk requests
+            cacheDB = path of the app's SQLite database to share
+            its extraction cache, or None
+            bulkLoad = load in bulk load mode, see
+            ElasticLoader.bulk_load
+            routing = routing mode of the index, the app's
+            INDEX_ROUTING, see routing_key
+            out = stream the progress and summary is written to
+        OUTPUT: dictionary with the counts of indexed and failed
+            documents, the failures by file name, and the
+            throughput of the run
+    '''
+
+    el = ElasticLoader()
+    ensure_index(el)
+
+    failures = {}
+    pending = {}
+    totals = {'docs': 0, 'bytes': 0}
+    start = time.time()
+
+    def actions(extracted):
+        for fn, size, json_out, error in extracted:
+            if error is not None:
+                failures[fn] = error
+                print("FAILED %s: %s" % (fn, error), file=out)
+                continue
+            docID = os.path.splitext(os.path.basename(fn))[0]
+            pending[docID] = (fn, size)
+            yield index_action(docID, json_out, routing_key(json_out, routing))
+
+    pool = Pool(workers)
+    try:
+        extracted = pool.imap_unordered(
+            functools.partial(extract_document, splitFields=splitFields,
+                              cacheDB=cacheDB),
+            yield_files(searchPath), chunksize=8)
+
+        with contextlib.ExitStack() as stack:
+            if bulkLoad:
+                stack.enter_context(el.bulk_load(INDEX_NAME))
+            for ok, item in el.bulk(actions(extracted), chunkSize=batchSize,
+                                    threadCount=threads):
+                result = list(item.values())[0]
+                fn, size = pending.pop(str(result.get('_id')), (result.get('_id'), 0))
+                if ok:
+                    totals['docs'] += 1
+                    totals['bytes'] += size
+                else:
+                    failures[fn] = result.get('error', result.get('status'))
+                    print("FAILED %s: %s" % (fn, failures[fn]), file=out)
+    finally:
+        pool.close()
+        pool.join()
+
+    elapsed = max(time.time() - start, 1e-9)
+    summary = {
+        'indexed': totals['docs'],
+        'failed': len(failures),
+        'failures': failures,
+        'seconds': elapsed,
+        'docs_per_second': totals['docs'] / elapsed,
+        'mb_per_second': totals['bytes'] / elapsed / 1024 ** 2,
+    }
+
+    print("Indexed %d documents (%d failed) in %.1fs: %.1f docs/s, %.2f MB/s"
+          % (summary['indexed'], summary['failed'], elapsed,
+             summary['docs_per_second'], summary['mb_per_second']), file=out)
+
+    return summary
 
 
 if __name__ == '__main__':
 
     '''
-    This is the main function that uses yield_files to 
-    pass Word documents to the Word-to-Elastic loader.
-    No modification is required.
+    This is the main function that bulk loads Word documents
+    into the transcript index.
     '''
 
-    searchPath='./transcriptions/*.docx'
+    parser = argparse.ArgumentParser(
+        description='Bulk load Word documents into the transcript index.')
+    parser.add_argument('searchPath', nargs='?', default='./transcriptions/*.docx',
+                        help='glob of the Word documents to load')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='extraction processes (default: number of CPUs)')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='documents per bulk request')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='concurrent bulk requests')
+    parser.add_argument('--cache-db', default=None,
+                        help='app database whose extraction cache is used')
+    parser.add_argument('--bulk-load', action='store_true',
+                        help='turn off refreshes and replicas during the load '
+                             'and force merge the index afterwards')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='primary shards of the index if it is created')
+    parser.add_argument('--replicas', type=int, default=1,
+                        help='replicas of the index if it is created')
+    parser.add_argument('--routing', choices=sorted(ROUTING_FIELDS), default=None,
+                        help="route documents like the app's INDEX_ROUTING")
+    args = parser.parse_args()
 
-    for fn in yield_files(searchPath):
-        print("Adding file: %s" % fn)
-        word_to_elastic(fn)
+    configure(shards=args.shards, replicas=args.replicas)
+    summary = bulk_word_to_elastic(args.searchPath, workers=args.workers,
+                                   batchSize=args.batch_size,
+                                   threads=args.threads,
+                                   cacheDB=args.cache_db,
+                                   bulkLoad=args.bulk_load,
+                                   routing=args.routing)
+    sys.exit(1 if summary['failed'] else 0)
 
@@ -7,14 +7,20 @@ Functions for converting Word documents to JSON format
 from __future__ import print_function, division
 
 # core libraries for processing the files
+import argparse
 import glob
 import json
 import os
+from multiprocessing import Pool
 from pprint import pprint  # useful for troubleshooting dictionary content
-import re
+import tempfile
 
 # reference the docx_processing.py file functions
 import searchapp.docx_processing as docx_processing
+from searchapp.extraction_cache import content_hash
+
+# name of the manifest of converted documents kept in the target directory
+MANIFEST_NAME = '.manifest.json'
 
 
 def yield_files(searchPath):
@@ -37,17 +43,62 @@ def yield_files(searchPath):
         yield filename
 
 
+def _write_json(path, obj):
+    """Write obj as JSON to path atomically. The JSON goes to a temporary file
+    in the same directory that is then renamed over path, so readers and
+    interrupted runs never see a partial file.
+    """
+
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                   prefix='.tmp-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as outfile:
+            json.dump(obj, outfile)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmpname, path)
+    except BaseException:
+        os.remove(tmpname)
+        raise
+
+
+def _convert(job):
+    """Process pool worker for word_to_json. Converts one document and
+    returns (filename, manifest record, error) without raising.
+    """
+
+    filename, outfilename, splitFields, contentHash = job
+    try:
+        st = os.stat(filename)
+        if contentHash is None:
+            contentHash = content_hash(filename)
+        json_out, transcription = docx_processing.document_extract(filename,
+                                                                   splitFields)
+        json_out['transcription'] = transcription
+        _write_json(outfilename, json_out)
+    except Exception as e:
+        return filename, None, '{}: {}'.format(type(e).__name__, e)
+
+    return filename, {'mtime': st.st_mtime, 'size': st.st_size,
+                      'hash': contentHash, 'output': outfilename}, None
+
+
 def word_to_json(targetDir='./json_output/',
                  searchPath='./transcriptions/*.docx',
-                 splitFields=['tags']):
+                 splitFields=['tags'], incremental=True, workers=None,
+                 checkpointEvery=50):
     """This function is designed to extract the header and transcription from a
     Word document using the docx_processing functions and write the values as
     JSON to the specified targetDir using the same file name with a .json
     extension e.g. "transcript01.docx" will be stored as "transcript01.json".
 
-    You can either make the targetDirectory ahead of time, or add the
-    appropriate code to check if the directory exists and create it if it is
-    missing.
+    The target directory is created if it is missing. It also holds a
+    manifest with the path, mtime, size and content hash of every converted
+    source. In incremental mode only documents that are new or whose content
+    changed are converted again; a document that was only touched keeps its
+    output. Conversions run in a process pool and the manifest is
+    checkpointed every checkpointEvery documents, so a run that is
+    interrupted resumes where it stopped.
 
     The header keys can stay as the values specified in the document. The
     transcription key should be "Transcription" and the "Tags" field from the
@@ -56,28 +107,92 @@ def word_to_json(targetDir='./json_output/',
     Args:
         targetDir (str): the landing folder for the JSON files
         searchPath (str): the regex search path for source documents
+        splitFields (list): array of header keys that should be split
+        incremental (bool): skip documents the manifest shows as unchanged,
+            False converts everything again
+        workers (int): number of conversion processes, defaults to the
+            number of CPUs
+        checkpointEvery (int): documents converted between manifest writes
 
     Returns:
-        None from the function, but a file is written to the targetDir for each
-            file in searchPath
+        dictionary with the number of converted, skipped and failed documents
+            and the failures by file name. A file is written to the targetDir
+            for each converted file in searchPath
     """
 
     if not os.path.isdir(targetDir):
-        os.mkdir(targetDir)
-    
+        os.makedirs(targetDir)
+
+    manifestPath = os.path.join(targetDir, MANIFEST_NAME)
+    manifest = {}
+    if incremental and os.path.exists(manifestPath):
+        with open(manifestPath) as infile:
+            manifest = json.load(infile)
+
+    todo = []
+    current = {}
+    skipped = 0
     for filename in yield_files(searchPath):
-        print(filename)
-        json_out = docx_processing.header_extract(filename, splitFields)
-        json_out['transcription'] = docx_processing.paragraph_extract(filename)
-        
-        outfilename = targetDir + re.split('[/.\\\\]', filename)[-2] + '.json'
-        print(outfilename)
-        with open(outfilename, 'w') as outfile:
-            json.dump(json_out, outfile)
+        name = os.path.splitext(os.path.basename(filename))[0]
+        outfilename = os.path.join(targetDir, name + '.json')
+        record = manifest.get(filename)
+        contentHash = None
+
+        if record is not None and os.path.exists(outfilename):
+            st = os.stat(filename)
+            if record['mtime'] == st.st_mtime and record['size'] == st.st_size:
+                current[filename] = record
+                skipped += 1
+                continue
+
+            # touched but possibly not changed, compare the content
+            contentHash = content_hash(filename)
+            if record['hash'] == contentHash:
+                record.update(mtime=st.st_mtime, size=st.st_size)
+                current[filename] = record
+                skipped += 1
+                continue
+
+        todo.append((filename, outfilename, splitFields, contentHash))
+
+    failures = {}
+    converted = 0
+    if todo:
+        pool = Pool(workers)
+        try:
+            for filename, record, error in pool.imap_unordered(_convert, todo):
+                if error is not None:
+                    failures[filename] = error
+                    print('FAILED {}: {}'.format(filename, error))
+                    continue
+                current[filename] = record
+                converted += 1
+                if converted % checkpointEvery == 0:
+                    _write_json(manifestPath, dict(manifest, **current))
+        finally:
+            pool.close()
+            pool.join()
+
+    # sources that have gone away are dropped from the manifest
+    _write_json(manifestPath, current)
+
+    print('Converted {} documents, skipped {} unchanged, {} failed'.format(
+        converted, skipped, len(failures)))
+
+    return {'converted': converted, 'skipped': skipped,
+            'failed': len(failures), 'failures': failures}
 
 
 if __name__ == '__main__':
-    word_to_json()
-    
-    
-    
+    parser = argparse.ArgumentParser(
+        description='Convert Word documents to JSON files.')
+    parser.add_argument('--target-dir', default='./json_output/')
+    parser.add_argument('--search-path', default='./transcriptions/*.docx')
+    parser.add_argument('--full', action='store_true',
+                        help='convert every document, not only changed ones')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='conversion processes (default: number of CPUs)')
+    args = parser.parse_args()
+
+    word_to_json(args.target_dir, args.search_path,
+                 incremental=not args.full, workers=args.workers)
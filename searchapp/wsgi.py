@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""
+WSGI entry point for gunicorn
+
+    gunicorn -c gunicorn.conf.py
+
+The app is created when this module is imported. With preload_app, as in
+gunicorn.conf.py, that happens once in the master before the workers are
+forked, so the workers share the imported code and the app instead of each
+importing and building their own.
+"""
+
+from searchapp import create_app
+
+application = create_app()
@@ -0,0 +1,73 @@
+import io
+
+import pytest
+
+from searchapp import create_app
+from searchapp.db import get_db, init_db
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': str(tmp_path / 'searchapp.db'),
+        'SEARCH_BACKEND': 'local',
+        'LOCAL_INDEX_PATH': str(tmp_path / 'index'),
+        'METRICS_DIR': str(tmp_path / 'metrics'),
+        'JOB_WORKERS': 0,
+    })
+
+    with app.app_context():
+        init_db()
+
+    yield app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def db(app):
+    with app.app_context():
+        yield get_db()
+
+
+class AuthActions(object):
+    def __init__(self, client):
+        self._client = client
+
+    def register(self, username='test', password='test'):
+        return self._client.post(
+            '/auth/register',
+            data={'username': username, 'password': password}
+        )
+
+    def login(self, username='test', password='test'):
+        return self._client.post(
+            '/auth/login',
+            data={'username': username, 'password': password}
+        )
+
+
+@pytest.fixture
+def auth(client):
+    actions = AuthActions(client)
+    actions.register()
+    actions.login()
+    return actions
+
+
+def upload(client, filename, text):
+    """Post a text document to /create as filename."""
+    return client.post(
+        '/create', data={'file': (io.BytesIO(text.encode('utf-8')), filename)},
+        content_type='multipart/form-data'
+    )
+
+
+def markdown(tags, body, researcher='Jane'):
+    """A markdown transcript with a header of its researcher and tags."""
+    return '---\nResearcher: {}\nTags: {}\n---\n{}\n'.format(
+        researcher, ', '.join(tags), body)
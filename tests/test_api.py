@@ -0,0 +1,74 @@
+import pytest
+
+from conftest import markdown, upload
+from searchapp import api
+from searchapp.elastic_loader import CircuitOpenError, ElasticLoader
+
+
+@pytest.fixture
+def uploads(client, auth):
+    upload(client, 'farming.md', markdown(['farming'], 'Talk about the farm and the harvest'))
+    upload(client, 'fishing.md', markdown(['fishing'], 'Talk about the sea', researcher='Jo'))
+
+
+def search(client, query):
+    response = client.get('/api/search?' + query)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_search_requires_login(client):
+    assert client.get('/api/search?q=farm').status_code == 302
+
+
+def test_search_and_filters(client, uploads):
+    result = search(client, 'q=harvest')
+    assert result['total'] == 1
+    [hit] = result['hits']
+    assert hit['source']['researcher'] == 'Jane'
+    assert 'transcription' not in hit['source']
+    assert hit['highlight']
+
+    assert search(client, 'q=talk')['total'] == 2
+    assert search(client, 'q=talk&tags=Fishing')['hits'][0]['source']['researcher'] == 'Jo'
+    assert search(client, 'researcher=jo')['total'] == 1
+    assert search(client, 'q=talk&size=1&page=2')['hits'][0]['id']
+
+
+def test_search_by_date(client, uploads):
+    from datetime import date
+    today = date.today().isoformat()
+    assert search(client, 'date_from={0}&date_to={0}'.format(today))['total'] == 2
+    assert search(client, 'date_to=2000-01-01')['total'] == 0
+
+
+@pytest.mark.parametrize('query', (
+    'page=first', 'size=ten', 'mode=sentences', 'date_from=yesterday',
+    'date_to=2020-13-01', 'date_from=01/02/2020',
+))
+def test_search_rejects_invalid_arguments(client, auth, query):
+    assert client.get('/api/search?q=a&' + query).status_code == 400
+
+
+def test_search_without_an_index_is_unavailable(client, auth):
+    assert client.get('/api/search?q=farm').status_code == 503
+
+
+def test_search_backend_errors_are_unavailable(client, uploads, monkeypatch):
+    def down(self, idxName, body, routing=None):
+        raise ConnectionRefusedError('connection refused')
+
+    monkeypatch.setattr(ElasticLoader, 'search', down)
+    assert client.get('/api/search?q=talk').status_code == 503
+
+
+def test_search_is_unavailable_while_the_breaker_is_open(client, uploads, monkeypatch):
+    class Breaker(object):
+        state = 'open'
+
+    def searched(self, idxName, body, routing=None):
+        raise CircuitOpenError('should not be asked')
+
+    monkeypatch.setattr(api, 'get_breaker', Breaker)
+    monkeypatch.setattr(ElasticLoader, 'search', searched)
+    assert client.get('/api/search?q=sea').status_code == 503
@@ -0,0 +1,73 @@
+import io
+import zipfile
+
+from werkzeug.datastructures import FileStorage
+
+from searchapp.batch import collect_uploads
+
+
+def storage(filename, data):
+    return FileStorage(io.BytesIO(data), filename)
+
+
+def archive(members, compression=zipfile.ZIP_DEFLATED):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression) as zf:
+        for name, data in members:
+            zf.writestr(name, data)
+    return buffer.getvalue()
+
+
+def results(uploads):
+    return [(u['filename'], u['format'], u['error']) for u in uploads]
+
+
+def test_zip_members_replace_the_archive():
+    data = archive([('a.txt', b'one'), ('dir/b.md', b'two'), ('__MACOSX/._a.txt', b'x'),
+                    ('~$lock.docx', b'x'), ('notes.py', b'print(1)')])
+    uploads = collect_uploads([storage('batch.zip', data)], 10, 100)
+    assert results(uploads) == [('a.txt', 'txt', None), ('b.md', 'md', None)]
+    assert [u['document'] for u in uploads] == [b'one', b'two']
+
+
+def test_member_larger_than_the_limit():
+    data = archive([('big.txt', b'a' * 1000), ('small.txt', b'ok')])
+    uploads = collect_uploads([storage('batch.zip', data)], 10, 100)
+    assert results(uploads) == [
+        ('big.txt', None, 'Document is larger than the upload limit'),
+        ('small.txt', 'txt', None)]
+
+
+def test_member_lying_about_its_size_is_not_decompressed_past_the_limit():
+    data = bytearray(archive([('bomb.txt', b'a' * 100000)]))
+    # shrink the uncompressed size recorded in the central directory
+    central = data.index(b'PK\x01\x02')
+    data[central + 24:central + 28] = (10).to_bytes(4, 'little')
+    uploads = collect_uploads([storage('bomb.zip', bytes(data))], 10, 100)
+    assert uploads[0]['document'] is None
+    assert uploads[0]['status'] == 'failed'
+
+
+def test_file_limit():
+    data = archive([('{}.txt'.format(n), b'text') for n in range(3)])
+    uploads = collect_uploads([storage('batch.zip', data), storage('d.txt', b'more')], 2, 100)
+    assert [u['error'] for u in uploads] == [
+        None, None, 'Batches are limited to 2 documents',
+        'Batches are limited to 2 documents']
+
+
+def test_total_bytes_limit():
+    data = archive([('a.txt', b'a' * 60), ('b.txt', b'b' * 60), ('c.txt', b'c')])
+    uploads = collect_uploads([storage('batch.zip', data)], 10, 100, 100)
+    assert results(uploads) == [
+        ('a.txt', 'txt', None),
+        ('b.txt', None, 'Batches are limited to 100 bytes'),
+        ('c.txt', None, 'Batches are limited to 100 bytes')]
+
+
+def test_invalid_archive_and_unknown_files():
+    uploads = collect_uploads([storage('broken.zip', b'PK not really'),
+                               storage('data.csv', b'a,b'), storage('', b'skipped')], 10, 100)
+    assert [u['filename'] for u in uploads] == ['broken.zip', 'data.csv']
+    assert uploads[0]['error'] == 'Not a valid .zip archive'
+    assert uploads[1]['error'].startswith('Only ')
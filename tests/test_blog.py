@@ -0,0 +1,23 @@
+from conftest import markdown, upload
+
+
+def test_upload_when_the_queue_is_full(app, client, auth, db):
+    app.config['JOB_QUEUE_MAX'] = 1
+    entry_id = db.execute("INSERT INTO entries (title, body, author_id) VALUES ('a', 'a', 1)"
+                          ).lastrowid
+    db.execute('INSERT INTO jobs (entry_id, document, format) VALUES (?, ?, ?)',
+               (entry_id, b'waiting', 'txt'))
+    db.commit()
+
+    response = upload(client, 'b.md', markdown(['tag'], 'Talk'))
+    assert response.status_code == 302
+    page = client.get('/').data
+    assert b'Too many uploads are waiting to be indexed, please try again later' in page
+    assert db.execute('SELECT count(*) FROM entries').fetchone()[0] == 1
+
+
+def test_upload_is_queued_and_indexed(client, auth, db):
+    upload(client, 'b.md', markdown(['tag'], 'Talk'))
+    assert b'New entry was queued for indexing' in client.get('/').data
+    job = db.execute('SELECT status FROM jobs').fetchone()
+    assert job['status'] == 'done'
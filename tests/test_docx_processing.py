@@ -0,0 +1,102 @@
+import io
+import zipfile
+
+from searchapp import docx_processing
+
+W = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+
+
+def docx(body):
+    """Return the bytes of a DOCX document whose w:body holds body."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('word/document.xml',
+                         '<w:document xmlns:w="{}"><w:body>{}</w:body></w:document>'
+                         .format(W, body))
+    return buffer.getvalue()
+
+
+def p(*runs):
+    return '<w:p>{}</w:p>'.format(''.join(runs))
+
+
+def r(*texts):
+    return '<w:r>{}</w:r>'.format(''.join(
+        text if text.startswith('<') else '<w:t xml:space="preserve">{}</w:t>'.format(text)
+        for text in texts))
+
+
+def tc(text, properties=''):
+    return '<w:tc>{}{}</w:tc>'.format(
+        '<w:tcPr>{}</w:tcPr>'.format(properties) if properties else '', p(r(text)))
+
+
+def tbl(*rows):
+    return '<w:tbl>{}</w:tbl>'.format(''.join(
+        '<w:tr>{}</w:tr>'.format(''.join(cells)) for cells in rows))
+
+
+HEADER = tbl([tc('Researcher'), tc('Jane')], [tc('Tags'), tc('a, b')])
+
+
+def test_header_and_transcription():
+    headers, transcription = docx_processing.document_extract(
+        docx(HEADER + p(r('First ', 'paragraph')) + p() + p(r('Second'))), ['tags'])
+    assert headers['researcher'] == 'Jane'
+    assert headers['tags'] == ['a', 'b']
+    assert 'date' in headers
+    assert transcription == 'First paragraph Second'
+
+
+def test_hyperlink_runs_are_text():
+    document = docx(p(r('See '), '<w:hyperlink r:id="rId1" xmlns:r="urn:r">{}</w:hyperlink>'
+                      .format(r('the site')), r(' now')))
+    assert docx_processing.document_extract(document)[1] == 'See the site now'
+
+
+def test_tabs_and_breaks_separate_words():
+    header = tbl([tc('Researcher'), '<w:tc>{}</w:tc>'.format(p(r('Jane', '<w:tab/>', 'Doe')))],
+                 ['<w:tc>{}</w:tc>'.format(p(r('Tags'))),
+                  '<w:tc>{}</w:tc>'.format(p(r('one', '<w:tab/>', 'two', '<w:br/>', 'three')))])
+    headers, transcription = docx_processing.document_extract(
+        docx(header + p(r('tab', '<w:tab/>', 'separated', '<w:br/>', 'words'))), ['tags'])
+    assert headers['researcher'] == 'Jane Doe'
+    assert headers['tags'] == ['one', 'two', 'three']
+    assert transcription == 'tab separated words'
+
+
+def test_merged_cells_follow_the_grid():
+    table = tbl([tc('wide', '<w:gridSpan w:val="2"/>'), tc('top', '<w:vMerge w:val="restart"/>')],
+                [tc('a'), tc('b'), tc('', '<w:vMerge/>')])
+    assert list(docx_processing.blocks(docx(table))) == [
+        ('table', [['wide', 'wide', 'top'], ['a', 'b', 'top']])]
+
+
+def test_only_top_level_blocks_are_read():
+    nested = tbl([tc('outer'), '<w:tc>{}{}</w:tc>'.format(
+        tbl([tc('inner')]), p(r('after')))])
+    assert list(docx_processing.blocks(docx(nested + p(r('text'))))) == [
+        ('table', [['outer', 'after']]), ('paragraph', 'text')]
+
+
+def test_generated_corpus_document(tmp_path):
+    from benchmarks.corpus import generate_docx
+    fn = str(tmp_path / 'transcript.docx')
+    generate_docx(fn, paragraphs=20, seed=1)
+    headers, transcription = docx_processing.document_extract(fn, ['tags'])
+    assert set(headers) >= {'tags', 'researcher', 'date'}
+    assert len(transcription.split()) >= 20 * 5
+
+
+def test_tables_after_the_header():
+    coding = tbl([tc('Code'), tc('  Theme   one ')], [tc(''), tc('')], [tc('A1'), tc('Work')])
+    headers, transcription = docx_processing.document_extract(
+        docx(HEADER + p(r('Talk')) + coding + tbl([tc('')])))
+    assert headers['researcher'] == 'Jane'
+    assert headers['tables'] == [[['Code', 'Theme one'], ['A1', 'Work']]]
+    assert transcription == 'Talk'
+
+
+def test_no_tables_key_without_other_tables():
+    headers, _ = docx_processing.document_extract(docx(HEADER + p(r('Talk'))))
+    assert 'tables' not in headers
@@ -0,0 +1,131 @@
+import io
+import zipfile
+
+import pytest
+
+from searchapp import extractors
+from searchapp.text_processing import collect
+
+MARKDOWN = b'''---
+Researcher: Jane
+Tags: a, b
+---
+# Title
+
+Some *emphasis* and a [link](http://example.com).
+
+| Question | Answer |
+|----------|--------|
+| Where    | Here   |
+
+- item one
+'''
+
+HTML = (b'<!DOCTYPE html><html><head><title>Ignored</title><script>var a;</script>'
+        b'</head><body><table><tr><td>Researcher</td><td>Jane</td></tr></table>'
+        b'<p>Hello <b>there</b></p><div>second<br>third</div>'
+        b'<table><tr><td>a</td><td>b <table><tr><td>nested</td></tr></table></td></tr>'
+        b'</table></body></html>')
+
+ODT_CONTENT = '''<?xml version="1.0" encoding="UTF-8"?>
+<office:document-content
+    xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0"
+    xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0"
+    xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0">
+  <office:body><office:text>
+    <table:table>
+      <table:table-row>
+        <table:table-cell><text:p>Researcher</text:p></table:table-cell>
+        <table:table-cell><text:p>Jane</text:p></table:table-cell>
+      </table:table-row>
+    </table:table>
+    <text:h>Interview</text:h>
+    <text:p>Two<text:s text:c="3"/>spaces<text:tab/>and a<text:note><text:p>note</text:p></text:note> tab</text:p>
+    <text:list><text:list-item><text:p>listed</text:p></text:list-item></text:list>
+    <table:table>
+      <table:table-row>
+        <table:table-cell table:number-columns-repeated="2"><text:p>x</text:p></table:table-cell>
+      </table:table-row>
+    </table:table>
+  </office:text></office:body>
+</office:document-content>'''
+
+
+def _zip(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def _odt():
+    return _zip([('mimetype', extractors.ODT_MIMETYPE), ('content.xml', ODT_CONTENT)])
+
+
+def test_markdown_front_matter_tables_and_markup():
+    headers, transcription = extractors.get('md').extract(MARKDOWN, ['tags'])
+    assert headers['researcher'] == 'Jane'
+    assert headers['tags'] == ['a', 'b']
+    assert headers['tables'] == [[['Question', 'Answer'], ['Where', 'Here']]]
+    assert transcription == 'Title Some emphasis and a link. item one'
+
+
+def test_text_front_matter():
+    headers, transcription = extractors.get('txt').extract(
+        b'---\nResearcher: Jane\n---\nline one\n\nline two\n')
+    assert headers['researcher'] == 'Jane'
+    assert transcription == 'line one line two'
+
+
+def test_html_paragraphs_and_tables():
+    headers, transcription = extractors.get('html').extract(HTML)
+    assert headers['researcher'] == 'Jane'
+    assert headers['tables'] == [[['a', 'b nested']]]
+    assert transcription == 'Hello there second third'
+
+
+def test_odt_paragraphs_and_tables():
+    assert list(extractors.get('odt').blocks(_odt())) == [
+        ('table', [['Researcher', 'Jane']]),
+        ('paragraph', 'Interview'),
+        ('paragraph', 'Two   spaces and a tab'),
+        ('paragraph', 'listed'),
+        ('table', [['x', 'x']]),
+    ]
+    headers, transcription = collect(extractors.get('odt').blocks(_odt()))
+    assert transcription == 'Interview Two spaces and a tab listed'
+
+
+@pytest.mark.parametrize(('filename', 'name'), (
+    ('a.docx', 'docx'), ('a.ODT', 'odt'), ('a.htm', 'html'), ('a.markdown', 'md'),
+    ('a.txt', 'txt'),
+))
+def test_find_by_extension(filename, name):
+    assert extractors.find(filename).name == name
+
+
+def test_find_sniffs_formats_with_a_signature():
+    docx = _zip([('word/document.xml', '<w:document/>')])
+    assert extractors.find('upload', docx).name == 'docx'
+    assert extractors.find('upload.bin', _odt()).name == 'odt'
+    assert extractors.find('page.php', HTML).name == 'html'
+
+
+@pytest.mark.parametrize(('filename', 'document'), (
+    ('script.py', b'import os\nprint(os.getcwd())\n'),
+    ('data.csv', b'a,b\n1,2\n'),
+    ('data.json', b'{"a": 1}'),
+    ('notes', b'plain words without an extension'),
+    ('image.png', b'\x89PNG\r\n\x1a\n\x00\x00'),
+    ('archive.jar', _zip([('META-INF/MANIFEST.MF', 'x')])),
+))
+def test_find_rejects_unknown_files(filename, document):
+    assert extractors.find(filename, document) is None
+
+
+def test_upload_of_unknown_text_is_rejected(client, auth):
+    response = client.post('/create', data={
+        'file': (io.BytesIO(b'import os\n'), 'script.py')
+    }, content_type='multipart/form-data', follow_redirects=True)
+    assert b'Could not post file' in response.data
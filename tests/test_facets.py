@@ -0,0 +1,40 @@
+import json
+
+from searchapp import facets
+
+from conftest import markdown, upload
+
+
+def _tags(client):
+    body = json.loads(client.get('/api/facets?field=tags').data)
+    return dict((item['value'], item['count']) for item in body['facets']['tags'])
+
+
+def test_delete_updates_the_counts(client, auth):
+    upload(client, 'a.md', markdown(['alpha', 'beta'], 'first interview'))
+    upload(client, 'b.md', markdown(['alpha'], 'second interview'))
+    assert _tags(client) == {'alpha': 2, 'beta': 1}
+
+    client.post('/1/delete')
+    assert _tags(client) == {'alpha': 1}
+
+
+def test_reconcile_after_delete(app, client, auth, db):
+    upload(client, 'a.md', markdown(['alpha', 'beta'], 'first interview'))
+    upload(client, 'b.md', markdown(['alpha'], 'second interview'))
+
+    # an entry removed without its headers being forgotten leaves its counts
+    db.execute('DELETE FROM entries WHERE id = 1')
+    db.commit()
+    assert _tags(client) == {'alpha': 2, 'beta': 1}
+
+    # alpha, beta, the researcher and the load date
+    assert facets.reconcile(db) == 4
+    assert _tags(client) == {'alpha': 1}
+    assert facets.reconcile(db) == 0
+
+
+def test_reconcile_due_claims_the_interval(app, db):
+    app.config['FACETS_RECONCILE_INTERVAL'] = 3600
+    assert facets.reconcile_due(db) == 0
+    assert facets.reconcile_due(db) is None
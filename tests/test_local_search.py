@@ -0,0 +1,46 @@
+import pytest
+
+from searchapp.local_search import LocalBackend
+
+MAPPING = {'doc': {'properties': {
+    'tags': {'type': 'keyword', 'normalizer': 'lowercase_keyword'},
+    'project': {'type': 'text', 'fields': {'keyword': {'type': 'keyword'}}},
+    'author_id': {'type': 'integer'},
+}}}
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = LocalBackend(str(tmp_path))
+    backend.create_index('t', MAPPING)
+    backend.insert('t', '1', 'doc', {'tags': ['Machine Vision'], 'project': 'Alpha Beta',
+                                     'author_id': 3}, refresh=True)
+    backend.insert('t', '2', 'doc', {'tags': ['machine learning'], 'project': 'Alpha',
+                                     'author_id': 4}, refresh=True)
+    return backend
+
+
+def ids(backend, query):
+    hits = backend.search('t', {'query': query})['hits']['hits']
+    return sorted(hit['_id'] for hit in hits)
+
+
+@pytest.mark.parametrize(('query', 'expected'), (
+    ({'terms': {'tags': ['machine learning']}}, ['2']),
+    ({'terms': {'tags': ['machine vision', 'deep learning']}}, ['1']),
+    ({'term': {'tags': 'machine'}}, []),
+    ({'term': {'project.keyword': 'Alpha'}}, ['2']),
+    ({'term': {'project.keyword': 'alpha'}}, []),
+    ({'term': {'author_id': 3}}, ['1']),
+))
+def test_term_matches_whole_values(backend, query, expected):
+    assert ids(backend, query) == expected
+
+
+@pytest.mark.parametrize(('query', 'expected'), (
+    ({'match': {'project': 'alpha'}}, ['1', '2']),
+    ({'match': {'project': 'beta'}}, ['1']),
+    ({'match': {'project': {'query': 'alpha beta', 'operator': 'and'}}}, ['1']),
+))
+def test_match_matches_words(backend, query, expected):
+    assert ids(backend, query) == expected
@@ -0,0 +1,71 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from searchapp import metrics
+
+
+@pytest.fixture
+def metrics_dir(app):
+    return app.config['METRICS_DIR']
+
+
+def _dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def _snapshot(metrics_dir, pid, count):
+    key = metrics._key('jobs_total', {'outcome': 'done'})
+    with open(os.path.join(metrics_dir, 'metrics-{}.json'.format(pid)), 'w') as f:
+        json.dump({'counters': {key: count}, 'histograms': {}}, f)
+
+
+def _done(total):
+    return total['counters'].get(metrics._key('jobs_total', {'outcome': 'done'}), 0)
+
+
+def test_collect_adds_up_processes_and_archives_exited_ones(metrics_dir):
+    # the counts of this process are kept across tests
+    before = _done(metrics.collect())
+    metrics.inc('jobs_total', 2, outcome='done')
+    pid = _dead_pid()
+    _snapshot(metrics_dir, pid, 3)
+
+    assert _done(metrics.collect()) == before + 5
+    assert not os.path.exists(os.path.join(metrics_dir, 'metrics-{}.json'.format(pid)))
+    # the exited process is counted once, from the archive
+    assert _done(metrics.collect()) == before + 5
+
+    text = metrics.render(metrics.collect())
+    assert 'jobs_total{{outcome="done"}} {}'.format(before + 5) in text
+
+
+def test_concurrent_scrapes_fold_each_snapshot_once(metrics_dir):
+    before = _done(metrics.collect())
+    errors = []
+    start = threading.Barrier(8)
+
+    def scrape():
+        start.wait()
+        try:
+            metrics.collect()
+        except Exception as e:
+            errors.append(e)
+
+    # above the largest pid Linux hands out, so no such process is alive
+    for pid in range(10 ** 7, 10 ** 7 + 200):
+        _snapshot(metrics_dir, pid, 1)
+    threads = [threading.Thread(target=scrape) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert _done(metrics.collect()) == before + 200
@@ -0,0 +1,86 @@
+import random
+
+import pytest
+
+from searchapp import near_duplicates
+
+pytest.importorskip('numpy')
+
+
+def _words(seed, count=400):
+    rng = random.Random(seed)
+    return ['w{}'.format(rng.randrange(3000)) for n in range(count)]
+
+
+def _revise(words, *positions):
+    words = list(words)
+    for position in positions:
+        words[position] = 'edited'
+    return ' '.join(words)
+
+
+@pytest.fixture
+def entries(app, db):
+    """Record four entries: an interview, two revisions of it and an
+    unrelated one.
+    """
+    base = _words(1)
+    texts = [' '.join(base), _revise(base, 100), _revise(base, 200, 300),
+             ' '.join(_words(2))]
+    for text in texts:
+        entry_id = db.execute('INSERT INTO entries (title, body, author_id)'
+                              " VALUES ('t', 't', 1)").lastrowid
+        near_duplicates.record(db, entry_id, near_duplicates.document_signature(
+            {'transcription': text}))
+    db.commit()
+
+
+def _groups(db):
+    return dict((row['id'], row['duplicate_of'])
+                for row in db.execute('SELECT id, duplicate_of FROM entries'))
+
+
+def test_revisions_join_the_group_of_the_first(db, entries):
+    assert _groups(db) == {1: None, 2: 1, 3: 1, 4: None}
+    similarity = db.execute('SELECT similarity FROM entries WHERE id = 2').fetchone()[0]
+    assert similarity >= 0.8
+
+
+def test_forget_promotes_the_oldest_member(db, entries):
+    near_duplicates.forget(db, 1)
+    db.execute('DELETE FROM entries WHERE id = 1')
+    db.commit()
+
+    assert _groups(db) == {2: None, 3: 2, 4: None}
+    assert db.execute('SELECT similarity FROM entries WHERE id = 2').fetchone()[0] is None
+    for table in ('signatures', 'lsh_bands'):
+        assert db.execute('SELECT count(*) FROM {} WHERE entry_id = 1'.format(table)
+                          ).fetchone()[0] == 0
+
+
+def test_record_again_replaces_the_signature(app, db, entries):
+    near_duplicates.record(db, 2, near_duplicates.document_signature(
+        {'transcription': ' '.join(_words(3))}))
+    db.commit()
+
+    assert _groups(db)[2] is None
+    bands = db.execute('SELECT count(*) FROM lsh_bands WHERE entry_id = 2').fetchone()[0]
+    assert bands == app.config['NEAR_DUP_BANDS']
+
+
+def test_bands_must_split_the_signature_evenly(tmp_path):
+    from searchapp import create_app
+
+    config = {'TESTING': True, 'DATABASE': str(tmp_path / 'searchapp.db'),
+              'SEARCH_BACKEND': 'local', 'LOCAL_INDEX_PATH': str(tmp_path / 'index'),
+              'METRICS_DIR': str(tmp_path / 'metrics'), 'JOB_WORKERS': 0,
+              'NEAR_DUP_PERMUTATIONS': 128, 'NEAR_DUP_BANDS': 10}
+    with pytest.raises(ValueError, match=r'NEAR_DUP_PERMUTATIONS \(128\) must be a multiple'
+                                         r' of NEAR_DUP_BANDS \(10\)'):
+        create_app(config)
+    create_app(dict(config, NEAR_DUP_THRESHOLD=0))
+
+    sig = near_duplicates.signature('some words of a text', 128)
+    with pytest.raises(ValueError):
+        near_duplicates.bands(sig, 0)
+    assert len(near_duplicates.bands(sig, 32)) == 32
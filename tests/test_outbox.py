@@ -0,0 +1,143 @@
+import pytest
+
+from searchapp import outbox
+from searchapp.elastic_loader import WriteError
+
+
+def _entry(db, title='a.md'):
+    entry_id = db.execute(
+        'INSERT INTO entries (title, body, author_id) VALUES (?, ?, 1)', (title, title)
+    ).lastrowid
+    db.commit()
+    return entry_id
+
+
+class Backend(object):
+    """Stands in for sync_documents, recording the operations of every call
+    and failing the entries in fail with their WriteError.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.fail = {}
+
+    def __call__(self, operations):
+        self.calls.append(list(operations))
+        return dict((op[0], self.fail[op[0]]) for op in operations if op[0] in self.fail)
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = Backend()
+    monkeypatch.setattr(outbox, 'sync_documents', backend)
+    return backend
+
+
+def test_latest_operation_of_an_entry_is_sent(db, backend):
+    entry_id = _entry(db)
+    outbox.add(db, entry_id, 'index', {'transcription': 'first'})
+    outbox.add(db, entry_id, 'index', {'transcription': 'second'})
+    db.commit()
+
+    assert outbox.drain(db) == 1
+    assert len(backend.calls) == 1
+    [(docID, body, routing)] = backend.calls[0]
+    assert docID == entry_id
+    assert body['transcription'] == 'second'
+    assert db.execute('SELECT count(*) FROM outbox').fetchone()[0] == 0
+
+
+def test_delete_supersedes_index(db, backend):
+    entry_id = _entry(db)
+    outbox.add(db, entry_id, 'index', {'transcription': 'text'})
+    outbox.add(db, entry_id, 'delete')
+    db.commit()
+
+    outbox.drain(db)
+    assert backend.calls == [[(entry_id, None, None)]]
+
+
+def test_permanent_failure_is_dead_lettered_and_replayed(app, db, backend):
+    entry_id = _entry(db)
+    outbox.add(db, entry_id, 'index', {'transcription': 'text'})
+    db.commit()
+
+    backend.fail[entry_id] = WriteError('mapper_parsing_exception', False)
+    assert outbox.drain(db) == 0
+    assert db.execute('SELECT count(*) FROM outbox').fetchone()[0] == 0
+    letter = db.execute('SELECT entry_id, op, attempts, error FROM dead_letters').fetchone()
+    assert tuple(letter) == (entry_id, 'index', 1, 'mapper_parsing_exception')
+
+    del backend.fail[entry_id]
+    result = app.test_cli_runner().invoke(args=['replay-dead-letters'])
+    assert 'Replayed 1 operations' in result.output
+    assert 'Delivered 1 operations' in result.output
+    assert backend.calls[-1][0][1]['transcription'] == 'text'
+    assert db.execute('SELECT count(*) FROM dead_letters').fetchone()[0] == 0
+
+
+def test_replay_drops_index_of_deleted_entry(db, backend):
+    entry_id = _entry(db)
+    outbox.add(db, entry_id, 'index', {'transcription': 'text'})
+    db.commit()
+    backend.fail[entry_id] = WriteError('rejected', False)
+    outbox.drain(db)
+
+    db.execute('DELETE FROM entries WHERE id = ?', (entry_id,))
+    db.commit()
+    assert outbox.replay_dead_letters(db) == 0
+    assert db.execute('SELECT count(*) FROM outbox').fetchone()[0] == 0
+
+
+def _lease(db):
+    return db.execute('SELECT value FROM index_state WHERE name = ?',
+                      (outbox.LEASE,)).fetchone()[0]
+
+
+def test_lease_is_renewed_after_each_batch(app, db, backend, monkeypatch):
+    app.config['OUTBOX_BATCH_SIZE'] = 1
+    for title in ('a.md', 'b.md'):
+        outbox.add(db, _entry(db, title), 'index', {'transcription': title})
+    db.commit()
+
+    leases = []
+
+    def send(operations):
+        leases.append(_lease(db))
+        return backend(operations)
+
+    monkeypatch.setattr(outbox, 'sync_documents', send)
+    assert outbox.drain(db) == 2
+    # the second batch runs under the lease the first one renewed
+    assert len(leases) == 2 and leases[1] > leases[0]
+    assert _lease(db) == 0
+
+
+def test_drain_stops_when_the_lease_is_lost(app, db, backend, monkeypatch):
+    app.config['OUTBOX_BATCH_SIZE'] = 1
+    first, second = _entry(db, 'a.md'), _entry(db, 'b.md')
+    outbox.add(db, first, 'index', {'transcription': 'a'})
+    outbox.add(db, second, 'index', {'transcription': 'b'})
+    db.commit()
+
+    def taken(operations):
+        # the lease ran out during the request and another process took it
+        db.execute('UPDATE index_state SET value = 12345 WHERE name = ?', (outbox.LEASE,))
+        return backend(operations)
+
+    monkeypatch.setattr(outbox, 'sync_documents', taken)
+    assert outbox.drain(db) == 1
+    assert [call[0][0] for call in backend.calls] == [first]
+    assert _lease(db) == 12345
+    assert db.execute('SELECT entry_id FROM outbox').fetchall()[0][0] == second
+
+
+def test_dead_letter_is_logged(app, db, backend, caplog):
+    entry_id = _entry(db)
+    outbox.add(db, entry_id, 'index', {'transcription': 'text'})
+    db.commit()
+    backend.fail[entry_id] = WriteError('rejected', False)
+
+    outbox.drain(db)
+    assert 'Outbox gave up on index of entry {} after 1 attempts: rejected'.format(
+        entry_id) in caplog.text
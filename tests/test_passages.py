@@ -0,0 +1,88 @@
+import pytest
+
+from searchapp import extractors, jobs
+from searchapp.elastic_loader import ElasticLoader
+from searchapp.text_processing import split_passages, split_transcription
+from searchapp.word_to_elastic import (
+    PASSAGE_DOC_TYPE, PASSAGE_INDEX_NAME, sync_documents
+)
+
+MARKDOWN = b'''---
+Researcher: Jane
+---
+one two three four
+
+five six seven
+
+eight nine ten eleven twelve
+'''
+
+
+def _texts(passages):
+    return [passage['text'] for passage in passages]
+
+
+def test_split_passages_overlaps_whole_paragraphs():
+    paragraphs = ['a b c', 'd e', 'f g']
+    passages = list(split_passages(paragraphs, maxTokens=5, overlapTokens=2))
+    assert [p['passage'] for p in passages] == [0, 1]
+    assert _texts(passages) == ['a b c d e', 'd e f g']
+
+
+def test_split_passages_cuts_long_paragraphs_into_windows():
+    words = ' '.join(str(n) for n in range(10))
+    assert _texts(split_passages([words], maxTokens=4, overlapTokens=1)) == [
+        '0 1 2 3', '3 4 5 6', '6 7 8 9']
+
+
+def test_split_passages_rejects_overlap_of_whole_passage():
+    with pytest.raises(ValueError):
+        list(split_passages(['a b'], maxTokens=2, overlapTokens=2))
+
+
+def test_split_transcription_matches_split_passages():
+    starts = []
+    headers, transcription = extractors.get('md').extract(MARKDOWN, starts=starts)
+    assert starts == [0, 4, 7]
+    paragraphs = ['one two three four', 'five six seven', 'eight nine ten eleven twelve']
+    assert (list(split_transcription(transcription, starts, 8, 3))
+            == list(split_passages(paragraphs, 8, 3)))
+
+
+def test_extract_reads_the_document_once(monkeypatch):
+    reads = []
+    blocks = extractors.Extractor.blocks
+
+    def counted(self, document):
+        reads.append(self.name)
+        return blocks(self, document)
+
+    monkeypatch.setattr(extractors.Extractor, 'blocks', counted)
+    json_out = jobs.extract(MARKDOWN, 'md', 8, 3)
+    assert reads == ['md']
+    assert json_out['paragraph_starts'] == [0, 4, 7]
+    assert json_out['passage_params'] == [8, 3]
+    assert 'passages' not in json_out
+
+
+def test_add_passages_reads_a_legacy_extraction_again_for_its_offsets():
+    json_out = {'transcription': 'one two three four five six seven',
+                'passages': [{'passage': 0, 'text': 'stale'}]}
+    jobs.add_passages(json_out, MARKDOWN, 'md', 8, 3)
+    assert json_out['paragraph_starts'] == [0, 4, 7]
+    assert 'passages' not in json_out
+
+    jobs.add_passages(json_out, MARKDOWN, 'md', 0, 0)
+    assert 'passage_params' not in json_out
+
+
+def test_reindexing_replaces_the_passages(app):
+    el = ElasticLoader()
+    assert sync_documents([(1, jobs.extract(MARKDOWN, 'md', 4, 1), None)]) == {}
+    assert el.get(PASSAGE_INDEX_NAME, '1_2', PASSAGE_DOC_TYPE)['text'] == (
+        'eight nine ten eleven')
+    assert el.get(PASSAGE_INDEX_NAME, '1_3', PASSAGE_DOC_TYPE) is not None
+
+    assert sync_documents([(1, jobs.extract(MARKDOWN, 'md', 8, 3), None)]) == {}
+    assert el.get(PASSAGE_INDEX_NAME, '1_1', PASSAGE_DOC_TYPE) is not None
+    assert el.get(PASSAGE_INDEX_NAME, '1_2', PASSAGE_DOC_TYPE) is None
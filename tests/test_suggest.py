@@ -0,0 +1,102 @@
+import pytest
+
+from conftest import markdown, upload
+from searchapp import suggest
+
+
+def test_prefix_index_counts_and_ranking():
+    index = suggest.PrefixIndex()
+    for value in ('Work', 'work', 'Workshop', 'Family', 'Workshop', 'Workshop'):
+        index.add(value)
+    assert index.lookup('wo') == [('Workshop', 3), ('Work', 2)]
+    assert index.lookup('  WORKS ') == [('Workshop', 3)]
+    assert index.lookup('wo', limit=1) == [('Workshop', 3)]
+    index.add('work', -2)
+    assert index.lookup('wo') == [('Workshop', 3)]
+    assert len(index) == 2
+    index.add('absent', -1)
+    assert len(index) == 2
+
+
+def test_suggest_requires_login(client):
+    assert client.get('/api/suggest?q=a').status_code == 302
+
+
+@pytest.mark.parametrize(('query', 'status'), (
+    ('q=a&field=body', 400),
+    ('q=a&limit=many', 400),
+    ('q=%20', 400),
+    ('q=a', 200),
+))
+def test_suggest_validates_arguments(client, auth, query, status):
+    assert client.get('/api/suggest?' + query).status_code == status
+
+
+def test_suggest_uploaded_titles_and_headers(client, auth):
+    upload(client, 'farming.md', markdown(['farming', 'family'], 'Talk about the farm'))
+    upload(client, 'fishing.md', markdown(['fishing'], 'Talk about the sea', researcher='Jo'))
+
+    suggestions = client.get('/api/suggest?q=fa').get_json()['suggestions']
+    assert suggestions['tags'] == [{'value': 'family', 'count': 1},
+                                   {'value': 'farming', 'count': 1}]
+    assert suggestions['title'] == [{'value': 'farming.md', 'count': 1}]
+    researchers = client.get('/api/suggest?q=j&field=researcher').get_json()['suggestions']
+    assert researchers == {'researcher': [{'value': 'Jane', 'count': 1},
+                                          {'value': 'Jo', 'count': 1}]}
+
+    client.post('/1/delete')
+    suggestions = client.get('/api/suggest?q=f').get_json()['suggestions']
+    assert suggestions['tags'] == [{'value': 'fishing', 'count': 1}]
+    assert suggestions['title'] == [{'value': 'fishing.md', 'count': 1}]
+
+
+def test_workers_apply_each_others_changes(app, db):
+    first, second = suggest.Suggester(), suggest.Suggester()
+    first.refresh(db)
+    second.refresh(db)
+
+    db.execute("INSERT INTO user (username, password) VALUES ('u', 'p')")
+    db.execute("INSERT INTO entries (title, body, author_id) VALUES ('t', 'b', 1)")
+    suggest.record(db, 1, {'tags': ['Oral history', 'oral  HISTORY']})
+    db.commit()
+    first.refresh(db)
+    assert first.lookup('tags', 'oral') == [('Oral history', 1)]
+
+    suggest.record(db, 1, {'tags': ['memory']})
+    db.commit()
+    second.refresh(db)
+    assert second.lookup('tags', 'oral') == []
+    assert second.lookup('tags', 'mem') == [('memory', 1)]
+
+
+def test_worker_behind_the_pruned_log_rebuilds(app, db):
+    app.config['SUGGEST_LOG_MAX'] = 1
+    suggester = suggest.Suggester()
+    suggester.refresh(db)
+
+    db.execute("INSERT INTO user (username, password) VALUES ('u', 'p')")
+    db.execute("INSERT INTO entries (title, body, author_id) VALUES ('t', 'b', 1)")
+    suggest.record(db, 1, {'tags': ['one', 'two', 'three']})
+    db.commit()
+    suggester.refresh(db)
+    assert [value for value, count in suggester.lookup('tags', 't')] == ['three', 'two']
+    assert suggester.lookup('tags', 'o') == [('one', 1)]
+
+
+def test_each_database_has_its_own_suggester(tmp_path, client, auth):
+    from searchapp import create_app
+    from searchapp.db import init_db
+
+    upload(client, 'farming.md', markdown(['farming'], 'Talk about the farm'))
+    assert client.get('/api/suggest?q=farm&field=tags').get_json()['suggestions']['tags']
+
+    other = create_app({'TESTING': True, 'DATABASE': str(tmp_path / 'other.db'),
+                        'SEARCH_BACKEND': 'local', 'LOCAL_INDEX_PATH': str(tmp_path / 'other'),
+                        'METRICS_DIR': str(tmp_path / 'metrics'), 'JOB_WORKERS': 0})
+    with other.app_context():
+        init_db()
+    other_client = other.test_client()
+    other_client.post('/auth/register', data={'username': 'test', 'password': 'test'})
+    other_client.post('/auth/login', data={'username': 'test', 'password': 'test'})
+    response = other_client.get('/api/suggest?q=farm&field=tags')
+    assert response.get_json()['suggestions']['tags'] == []
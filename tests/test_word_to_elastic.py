@@ -0,0 +1,53 @@
+import io
+
+from searchapp import extraction_cache
+from searchapp.elastic_loader import ElasticLoader
+from searchapp.local_search import LocalBackend
+from searchapp.word_to_elastic import (
+    DOC_TYPE, INDEX_NAME, bulk_word_to_elastic, delete_from_index, passage_actions,
+    sync_documents
+)
+
+
+def test_bulk_load_indexes_cached_extraction_without_passages(app, db, tmp_path):
+    path = tmp_path / 'interview.docx'
+    path.write_bytes(b'not parsed, the extraction is cached')
+    extraction_cache.put(db, extraction_cache.content_hash(str(path)), {
+        'researcher': 'Jane', 'transcription': 'cached text',
+        'paragraph_starts': [0], 'passage_params': [200, 40],
+    }, app.config['EXTRACTION_CACHE_MAX_BYTES'])
+
+    summary = bulk_word_to_elastic(str(tmp_path / '*.docx'), workers=1,
+                                   cacheDB=app.config['DATABASE'], out=io.StringIO())
+
+    assert summary['indexed'] == 1
+    source = ElasticLoader().get(INDEX_NAME, 'interview', DOC_TYPE)
+    assert source['transcription'] == 'cached text'
+    assert 'paragraph_starts' not in source and 'passage_params' not in source
+
+
+def test_delete_from_index_is_routed(app, monkeypatch):
+    assert sync_documents([(7, {'project': 'Proj X', 'transcription': 'text'},
+                            'proj x')]) == {}
+    routed = []
+    delete = LocalBackend.delete
+
+    def record(self, idxName, docID, docType, refresh=False, routing=None):
+        routed.append(routing)
+        return delete(self, idxName, docID, docType, refresh, routing)
+
+    monkeypatch.setattr(LocalBackend, 'delete', record)
+    assert delete_from_index(7, 'proj x')
+    assert routed == ['proj x']
+    assert ElasticLoader().get(INDEX_NAME, 7, DOC_TYPE) is None
+
+
+def test_passages_do_not_copy_tables():
+    document = {'researcher': 'Jane', 'tables': [[['Code', 'Theme']]],
+                'transcription': 'one two three', 'paragraph_starts': [0],
+                'passage_params': [200, 40]}
+    actions = passage_actions(3, document)
+    assert len(actions) == 1
+    source = actions[0]['_source']
+    assert source['researcher'] == 'Jane' and source['entry_id'] == 3
+    assert 'tables' not in source and 'transcription' not in source